@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Назначение один к одному (или не больше capacity товаров сайта на позицию
+программы учета) по разреженному графу кандидатов после обычного поиска
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import process, fuzz
+
+from matching_engine import auto_chunk_size
+
+ASSIGN_SOLVERS = ('greedy', 'hungarian')
+DEFAULT_ASSIGN_CANDIDATES = 5
+# Компоненты больше этого (строк x мест) венгерским методом не решаются, для них жадный
+MAX_COMPONENT_CELLS = 20_000_000
+# Совпадения по артикулу/штрихкоду не уступают позицию нечетким
+PINNED_BONUS = 1000.0
+# Раунды добора кандидатов для товаров, вытесненных со своего варианта
+MAX_ROUNDS = 5
+
+
+def assignment_path(output_file):
+    """Файл отчета об изменениях назначения рядом с файлом результата, в том же формате"""
+    base, ext = os.path.splitext(output_file)
+    return base + "_назначения" + (ext or ".xlsx")
+
+
+def _import_linear_sum_assignment():
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        raise ImportError("Для венгерского метода установите scipy: pip install scipy")
+    return linear_sum_assignment
+
+
+def candidate_edges(queries, choices, rows, top_c, threshold=0, workers=-1, index=None):
+    """Ребра графа для строк rows: до top_c лучших вариантов каждой по WRatio
+    не ниже порога. Возвращает массивы (строка, вариант, оценка)"""
+    edge_rows, edge_cols, edge_scores = [], [], []
+    if index is not None:
+        for row, candidate_ids in zip(rows, index.candidates_many([queries[row] for row in rows], workers)):
+            found = process.extract(queries[row], [choices[i] for i in candidate_ids], scorer=fuzz.WRatio,
+                                    limit=top_c, score_cutoff=threshold)
+            for _, score, position in found:
+                edge_rows.append(row)
+                edge_cols.append(int(candidate_ids[position]))
+                edge_scores.append(score)
+    else:
+        k = min(top_c, len(choices))
+        chunk_size = auto_chunk_size(len(choices))
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            matrix = process.cdist([queries[row] for row in chunk], choices, scorer=fuzz.WRatio,
+                                   score_cutoff=threshold, dtype=np.float32, workers=workers)
+            if k < len(choices):
+                top = np.argpartition(-matrix, k - 1, axis=1)[:, :k]
+            else:
+                top = np.tile(np.arange(len(choices)), (len(chunk), 1))
+            for row, ids, values in zip(chunk, top, np.take_along_axis(matrix, top, axis=1)):
+                for col in ids[values > 0]:
+                    edge_rows.append(row)
+                    edge_cols.append(int(col))
+                    # Точная оценка в float64, как в результате
+                    edge_scores.append(fuzz.WRatio(queries[row], choices[col]))
+    return (np.array(edge_rows, dtype=np.int64), np.array(edge_cols, dtype=np.int64),
+            np.array(edge_scores, dtype=np.float64))
+
+
+def _solve_greedy(edge_rows, edge_cols, weights, capacity, n_rows):
+    """Ребра по убыванию веса (при равенстве - по строке и варианту): ребро берется,
+    если строка свободна и у варианта остались места"""
+    assigned = [-1] * n_rows
+    used = {}
+    order = np.lexsort((edge_cols, edge_rows, -weights))
+    for row, col in zip(edge_rows[order].tolist(), edge_cols[order].tolist()):
+        if assigned[row] < 0 and used.get(col, 0) < capacity:
+            assigned[row] = col
+            used[col] = used.get(col, 0) + 1
+    return np.array(assigned, dtype=np.int64)
+
+
+def _components(edge_rows, edge_cols, n_rows):
+    """Номер связной компоненты для каждого ребра (система непересекающихся множеств).
+    Узлы: строки сайта 0..n_rows-1 и варианты n_rows + индекс"""
+    parent = {}
+
+    def find(node):
+        root = node
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for row, col in zip(edge_rows.tolist(), (edge_cols + n_rows).tolist()):
+        a, b = find(row), find(col)
+        if a != b:
+            parent[a] = b
+    return pd.factorize(np.array([find(row) for row in edge_rows.tolist()]))[0]
+
+
+def _solve_hungarian(edge_rows, edge_cols, weights, capacity, n_rows, stats):
+    """Максимум суммарного веса венгерским методом по каждой связной компоненте.
+    Позиция с capacity местами превращается в capacity одинаковых колонок"""
+    linear_sum_assignment = _import_linear_sum_assignment()
+    assigned = np.full(n_rows, -1, dtype=np.int64)
+    labels = _components(edge_rows, edge_cols, n_rows)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for part in np.split(order, bounds):
+        rows, row_pos = np.unique(edge_rows[part], return_inverse=True)
+        cols, col_pos = np.unique(edge_cols[part], return_inverse=True)
+        stats['components'] += 1
+        if len(rows) == 1 or len(rows) * len(cols) * capacity > MAX_COMPONENT_CELLS:
+            if len(rows) > 1:
+                stats['greedy_components'] += 1
+            sub = _solve_greedy(row_pos, col_pos, weights[part], capacity, len(rows))
+        else:
+            matrix = np.zeros((len(rows), len(cols)), dtype=np.float64)
+            np.maximum.at(matrix, (row_pos, col_pos), weights[part])
+            matrix = np.repeat(matrix, capacity, axis=1)
+            sub_rows, sub_cols = linear_sum_assignment(matrix, maximize=True)
+            sub = np.full(len(rows), -1, dtype=np.int64)
+            # Пара без ребра (вес 0) означает, что строка осталась без назначения
+            has_edge = matrix[sub_rows, sub_cols] > 0
+            sub[sub_rows[has_edge]] = sub_cols[has_edge] // capacity
+        found = sub >= 0
+        assigned[rows[found]] = cols[sub[found]]
+    return assigned
+
+
+def assign(queries, choices, match_idx, scores, threshold=0, solver='greedy', capacity=1,
+           top_c=DEFAULT_ASSIGN_CANDIDATES, pinned=None, index=None, workers=-1):
+    """Назначение с ограничением capacity товаров сайта на позицию программы учета.
+
+    Граф строится из лучшего варианта каждой строки; строкам, чей вариант
+    заняли больше capacity строк, добавляются top_c альтернатив. Строки,
+    вытесненные со своего варианта, получают альтернативы в следующем раунде.
+    Возвращает (match_idx, scores, stats) того же вида, что и на входе.
+    """
+    if solver not in ASSIGN_SOLVERS:
+        raise ValueError(f"Неизвестный метод назначения: {solver}")
+    queries = list(queries)
+    choices = list(choices)
+    match_idx = np.asarray(match_idx)
+    scores = np.asarray(scores, dtype=np.float64)
+    n_rows = len(match_idx)
+    pinned = np.zeros(n_rows, dtype=bool) if pinned is None else np.asarray(pinned, dtype=bool)
+
+    matched = np.flatnonzero(match_idx >= 0)
+    edge_rows, edge_cols, edge_scores = matched, match_idx[matched], scores[matched]
+    claims = np.bincount(match_idx[matched], minlength=len(choices)) if len(matched) else np.zeros(0, int)
+    stats = {'conflicts': int((claims > capacity).sum()), 'expanded': 0, 'rounds': 0,
+             'components': 0, 'greedy_components': 0}
+
+    expanded = pinned.copy()
+    pending = matched[(claims[match_idx[matched]] > capacity) & ~expanded[matched]] if len(matched) else matched
+    assigned = match_idx.copy()
+    while stats['conflicts']:
+        if len(pending):
+            stats['rounds'] += 1
+            stats['expanded'] += len(pending)
+            expanded[pending] = True
+            rows, cols, values = candidate_edges(queries, choices, pending, top_c, threshold, workers, index)
+            # Повторы ребер (лучший вариант найден и среди альтернатив) убираем
+            edges = pd.DataFrame({'row': np.concatenate([edge_rows, rows]),
+                                  'col': np.concatenate([edge_cols, cols]),
+                                  'score': np.concatenate([edge_scores, values])})
+            edges = edges.groupby(['row', 'col'], sort=True, as_index=False)['score'].max()
+            edge_rows, edge_cols, edge_scores = (edges['row'].to_numpy(), edges['col'].to_numpy(),
+                                                 edges['score'].to_numpy())
+        weights = edge_scores + PINNED_BONUS * pinned[edge_rows]
+        if solver == 'hungarian':
+            stats['components'] = stats['greedy_components'] = 0
+            assigned = _solve_hungarian(edge_rows, edge_cols, weights, capacity, n_rows, stats)
+        else:
+            assigned = _solve_greedy(edge_rows, edge_cols, weights, capacity, n_rows)
+        # Вытесненные без своих альтернатив: добираем кандидатов и решаем заново
+        pending = np.flatnonzero((match_idx >= 0) & (assigned != match_idx) & ~expanded)
+        if not len(pending) or stats['rounds'] >= MAX_ROUNDS:
+            break
+
+    # Оценка назначенного варианта: ребра упорядочены по (строка, вариант)
+    new_scores = np.zeros(n_rows, dtype=np.float64)
+    found = np.flatnonzero(assigned >= 0)
+    keys = edge_rows * len(choices) + edge_cols
+    new_scores[found] = edge_scores[np.searchsorted(keys, found * len(choices) + assigned[found])]
+    stats['changed'] = int((assigned != match_idx).sum())
+    stats['unassigned'] = int(((match_idx >= 0) & (assigned < 0)).sum())
+    return assigned, new_scores, stats
+
+
+def assignment_report(site_ids, site_names, erp_ids, erp_names, old_idx, old_scores, new_idx, new_scores):
+    """Товары сайта, у которых назначение изменилось, с причиной"""
+    site_ids, site_names = list(site_ids), list(site_names)
+    erp_ids, erp_names = list(erp_ids), list(erp_names)
+    holders = {}
+    for row in np.flatnonzero(new_idx >= 0):
+        holders.setdefault(int(new_idx[row]), []).append(row)
+
+    records = []
+    for row in np.flatnonzero(new_idx != old_idx):
+        old, new = int(old_idx[row]), int(new_idx[row])
+        taken_by = holders.get(old, [])
+        if taken_by:
+            winners = ", ".join(f"{site_ids[r]} ({round(new_scores[r], 1)}%)" for r in taken_by[:3])
+            reason = f"вариант отдан товарам сайта {winners}" + (" и др." if len(taken_by) > 3 else "")
+        else:
+            reason = "перераспределение для большей суммарной схожести"
+        if new < 0:
+            reason += "; других вариантов выше порога нет"
+        records.append({
+            'id сайт': site_ids[row],
+            'наименование сайт': site_names[row],
+            'было id программа': erp_ids[old],
+            'было наименование программа': erp_names[old],
+            'было схожесть %': round(float(old_scores[row]), 1),
+            'стало id программа': erp_ids[new] if new >= 0 else None,
+            'стало наименование программа': erp_names[new] if new >= 0 else None,
+            'стало схожесть %': round(float(new_scores[row]), 1) if new >= 0 else None,
+            'причина': reason,
+        })
+    return pd.DataFrame(records, columns=['id сайт', 'наименование сайт', 'было id программа',
+                                          'было наименование программа', 'было схожесть %', 'стало id программа',
+                                          'стало наименование программа', 'стало схожесть %', 'причина'])
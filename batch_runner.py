@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Пакетное сопоставление нескольких каталогов сайта с одним каталогом
+программы учета: каталог программы учета загружается и индексируется
+один раз, файлы сайтов читаются и записываются параллельно со сравнением
+"""
+
+import argparse
+import glob
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from normalizer import clean_series
+from matching_engine import PREFILTER_SCORERS, match_chunks
+from catalog_io import OUTPUT_FORMATS, build_results, load_catalog, shared_strings, write_table
+from erp_cache import DEFAULT_CACHE_DIR, load_erp_catalog, load_candidate_index
+from exact_match import TIER_EXACT, TIER_FUZZY, TIER_KEY, build_exact_matcher
+from product_matcher_cli import ENGINES, detect_columns, open_memo
+from tfidf_index import DEFAULT_TFIDF_CANDIDATES, TfidfIndex
+from score_store import make_score_store, save_score_store, score_store_path
+
+DEFAULT_JOBS = 2
+DEFAULT_OUTPUT_DIR = "результаты"
+SUMMARY_FILE = "сводка.csv"
+
+
+def read_manifest(path):
+    """Файлы сайта из манифеста: по одному пути на строку, # - комментарий.
+    Относительные пути считаются от каталога манифеста"""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8-sig') as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+
+
+def collect_site_files(patterns, manifest=None):
+    """Файлы сайта из путей, масок и манифеста без повторов, в порядке перечисления.
+    Путь без совпадений остается в списке: ошибка попадет в сводку"""
+    files = []
+    for pattern in patterns:
+        files += sorted(glob.glob(pattern)) or [pattern]
+    if manifest:
+        files += read_manifest(manifest)
+    return list(dict.fromkeys(os.path.normpath(path) for path in files))
+
+
+def output_paths(site_files, output_dir, fmt):
+    """Файлы результата в output_dir; одноименным файлам из разных каталогов
+    добавляется номер"""
+    paths = []
+    seen = {}
+    for site_file in site_files:
+        stem = os.path.splitext(os.path.basename(site_file))[0]
+        seen[stem] = seen.get(stem, 0) + 1
+        suffix = f"_{seen[stem]}" if seen[stem] > 1 else ""
+        paths.append(os.path.join(output_dir, f"{stem}{suffix}_результат.{fmt}"))
+    return paths
+
+
+class BatchRunner:
+    """Каталог программы учета в памяти и одно место сравнения на всех.
+
+    Сравнение и так использует все ядра, поэтому одновременно сравнивается
+    один файл сайта; остальные в это время читаются, очищаются и записываются.
+    Общая память результатов (MatchMemo) позволяет не пересчитывать названия,
+    повторяющиеся в разных каталогах.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.columnar_cache_dir = args.cache_dir if args.columnar_cache else None
+        self.score_slot = threading.Lock()
+
+        self.df_erp, self.erp_id_col, self.erp_name_col, erp_key, from_cache = load_erp_catalog(
+            args.erp_file,
+            lambda df: detect_columns(df, "программы учета"),
+            cache_dir=args.cache_dir,
+            use_cache=not args.no_cache,
+            columnar_cache=args.columnar_cache
+        )
+        print(f"Загружен файл программы учета: {len(self.df_erp)} товаров" + (" (из кэша)" if from_cache else ""))
+        self.choices = shared_strings(self.df_erp['clean'])
+
+        self.index = None
+        if args.engine == 'tfidf':
+            print("Строю TF-IDF матрицу программы учета...")
+            self.index = TfidfIndex(self.choices, args.tfidf_candidates, rescore=not args.no_rescore)
+        elif args.blocking and args.top_k <= 1:
+            print("Строю индекс кандидатов...")
+            self.index = load_candidate_index(erp_key, self.choices, args.max_candidates, args.cache_dir)
+        self.memo = open_memo(args, args.erp_file, erp_key, args.threshold) if args.top_k <= 1 else None
+
+    def run_one(self, site_file, output_file):
+        """Сопоставление одного файла сайта; возвращает строку сводки.
+        Ошибка в одном файле не останавливает остальные"""
+        args = self.args
+        name = os.path.basename(site_file)
+        row = {'файл сайта': site_file, 'товаров': 0, 'найдено': 0, 'найдено %': 0.0,
+               'средняя схожесть': None, 'по ключу': 0, 'по названию': 0, 'нечетко': 0,
+               'загрузка, с': 0.0, 'ожидание, с': 0.0, 'сравнение, с': 0.0, 'запись, с': 0.0,
+               'файл результата': output_file, 'ошибка': ''}
+        try:
+            start = time.perf_counter()
+            df_site, site_id_col, site_name_col = load_catalog(
+                site_file, lambda df: detect_columns(df, f"сайта {name}"), self.columnar_cache_dir)
+            site_clean = shared_strings(clean_series(df_site[site_name_col]))
+            exact, key_pairs = None, []
+            if not args.no_fast_path and args.top_k <= 1:
+                exact, key_pairs = build_exact_matcher(self.choices, self.df_erp, df_site.columns)
+            row['товаров'] = len(df_site)
+            row['загрузка, с'] = round(time.perf_counter() - start, 3)
+
+            start = time.perf_counter()
+            with self.score_slot:
+                row['ожидание, с'] = round(time.perf_counter() - start, 3)
+                start = time.perf_counter()
+                match_indices, scores = self._score(site_clean, exact, [df_site[col] for col, _ in key_pairs])
+                row['сравнение, с'] = round(time.perf_counter() - start, 3)
+            print(f"{name}: сопоставлено {len(df_site)} товаров за {row['сравнение, с']:.1f} с")
+
+            start = time.perf_counter()
+            results = build_results(df_site[site_id_col], df_site[site_name_col], self.df_erp[self.erp_id_col],
+                                    self.df_erp[self.erp_name_col], match_indices, scores)
+            write_table(results, output_file)
+            pinned = None
+            if exact is not None:
+                pinned = exact.key_matched(site_clean, [df_site[col] for col, _ in key_pairs], exact.tiers)
+            save_score_store(score_store_path(output_file), make_score_store(
+                df_site[site_id_col], df_site[site_name_col], self.df_erp[self.erp_id_col],
+                self.df_erp[self.erp_name_col], match_indices, scores, args.threshold, pinned))
+            row['запись, с'] = round(time.perf_counter() - start, 3)
+
+            row['найдено'] = len(results)
+            row['найдено %'] = round(len(results) / len(df_site) * 100, 1) if len(df_site) else 0.0
+            if len(results):
+                row['средняя схожесть'] = round(float(results['схожесть %'].mean()), 1)
+            if exact is not None:
+                row['по ключу'] = exact.tier_counts[TIER_KEY]
+                row['по названию'] = exact.tier_counts[TIER_EXACT]
+                row['нечетко'] = exact.tier_counts[TIER_FUZZY]
+            print(f"{name}: найдено {row['найдено']} из {row['товаров']}, результат: {output_file}")
+        except Exception as e:
+            row['ошибка'] = str(e)
+            print(f"{name}: ошибка: {e}")
+        return row
+
+    def _score(self, site_clean, exact, site_key_values):
+        args = self.args
+        shape = (len(site_clean), args.top_k) if args.top_k > 1 else len(site_clean)
+        match_indices = np.full(shape, -1, dtype=np.int64)
+        scores = np.zeros(shape, dtype=np.float64)
+        for start, chunk_indices, chunk_scores in match_chunks(
+                site_clean, self.choices, args.threshold, self.index, args.top_k, args.prefilter,
+                exact=exact, site_key_values=site_key_values, memo=self.memo):
+            match_indices[start:start + len(chunk_indices)] = chunk_indices
+            scores[start:start + len(chunk_indices)] = chunk_scores
+        return match_indices, scores
+
+    def close(self):
+        if self.memo is not None:
+            self.memo.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Пакетное сопоставление нескольких каталогов сайта с одним каталогом программы учета")
+    parser.add_argument('erp_file', help="файл программы учета")
+    parser.add_argument('sites', nargs='*', help="файлы сайта или маски в кавычках, например 'регионы/*.xlsx'")
+    parser.add_argument('--manifest', metavar='FILE', help="текстовый файл со списком файлов сайта, по одному на строку")
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR,
+                        help=f"каталог результатов (по умолчанию {DEFAULT_OUTPUT_DIR})")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='xlsx',
+                        help="формат файлов результата (по умолчанию xlsx)")
+    parser.add_argument('--summary', metavar='FILE',
+                        help=f"файл сводки (по умолчанию {SUMMARY_FILE} в каталоге результатов)")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help=f"сколько файлов сайта обрабатывать одновременно (по умолчанию {DEFAULT_JOBS})")
+    parser.add_argument('--threshold', type=int, default=60, help="минимальный порог схожести (по умолчанию 60)")
+    parser.add_argument('--engine', choices=ENGINES, default='wratio',
+                        help="алгоритм поиска: wratio или tfidf (нужен scipy); по умолчанию wratio")
+    parser.add_argument('--tfidf-candidates', type=int, default=DEFAULT_TFIDF_CANDIDATES, metavar='N',
+                        help=f"число кандидатов TF-IDF на товар (по умолчанию {DEFAULT_TFIDF_CANDIDATES})")
+    parser.add_argument('--no-rescore', action='store_true',
+                        help="не пересчитывать кандидатов TF-IDF через WRatio")
+    parser.add_argument('--blocking', action='store_true', help="сравнивать только с кандидатами из индекса")
+    parser.add_argument('--max-candidates', type=int, default=200,
+                        help="число кандидатов на товар в быстром режиме (по умолчанию 200)")
+    parser.add_argument('--top-k', type=int, default=1, metavar='K',
+                        help="сохранять K лучших вариантов на товар (по умолчанию 1)")
+    parser.add_argument('--prefilter', choices=sorted(PREFILTER_SCORERS), default='ratio',
+                        help="алгоритм первого прохода в режиме --top-k (по умолчанию ratio)")
+    parser.add_argument('--no-fast-path', action='store_true',
+                        help="не искать сначала по артикулу/штрихкоду и точному названию")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="не использовать кэш очищенного каталога программы учета")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f"каталог кэша (по умолчанию {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--columnar-cache', action='store_true',
+                        help="читать Excel-файлы через их копию в Parquet в каталоге кэша")
+    parser.add_argument('--memo', nargs='?', const='', default=None, metavar='FILE',
+                        help="запоминать результаты для названий между запусками в SQLite")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    site_files = collect_site_files(args.sites, args.manifest)
+    if not site_files:
+        print("Ошибка: не указаны файлы сайта")
+        return
+    if not os.path.exists(args.erp_file):
+        print(f"Ошибка: Файл {args.erp_file} не найден")
+        return
+
+    start = time.perf_counter()
+    os.makedirs(args.output_dir, exist_ok=True)
+    runner = BatchRunner(args)
+    print(f"Файлов сайта: {len(site_files)}, одновременно: {args.jobs}, порог {args.threshold}%")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            rows = list(pool.map(runner.run_one, site_files,
+                                 output_paths(site_files, args.output_dir, args.format)))
+    finally:
+        runner.close()
+    elapsed = time.perf_counter() - start
+
+    summary = pd.DataFrame(rows)
+    summary_file = args.summary or os.path.join(args.output_dir, SUMMARY_FILE)
+    write_table(summary, summary_file)
+
+    failed = int((summary['ошибка'] != '').sum())
+    total, matched = int(summary['товаров'].sum()), int(summary['найдено'].sum())
+    print(f"\nГотово за {elapsed:.1f} с: файлов {len(rows) - failed} из {len(rows)}, "
+          f"найдено {matched} совпадений из {total} товаров")
+    if runner.memo is not None:
+        print(f"Посчитано названий: {runner.memo.scored}, взято готовых результатов: {runner.memo.reused}")
+    if failed:
+        print(f"С ошибками: {failed}, подробности в сводке")
+    print(f"Сводка сохранена в файл: {summary_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение алгоритмов поиска на синтетических каталогах: WRatio полным
+перебором, индекс кандидатов (--blocking) и TF-IDF с пересчетом через WRatio
+и без него. Для каждого - время, скорость, совпадение с полным перебором
+и точность по эталону
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+
+from generate_catalog import generate
+from normalizer import clean_series
+from matching_engine import best_matches
+from candidate_index import CandidateIndex
+from tfidf_index import DEFAULT_TFIDF_CANDIDATES, TfidfIndex
+
+
+def run_engine(site_clean, erp_clean, threshold, make_index):
+    """Построение индекса и сопоставление: (match_idx, scores, секунды индекса, секунды поиска)"""
+    start = time.perf_counter()
+    index = make_index()
+    index_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    match_idx, scores = best_matches(site_clean, erp_clean, threshold, index=index)
+    return match_idx, scores, index_seconds, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение алгоритмов поиска по скорости и совпадению с WRatio")
+    parser.add_argument('--site-rows', type=int, default=2000)
+    parser.add_argument('--erp-rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threshold', type=int, default=60)
+    parser.add_argument('--tfidf-candidates', type=int, default=DEFAULT_TFIDF_CANDIDATES)
+    parser.add_argument('--output', default=None, help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    df_site, df_erp, df_truth = generate(args.site_rows, args.erp_rows, args.seed)
+    site_clean = clean_series(df_site['Наименование']).tolist()
+    erp_clean = clean_series(df_erp['наименование']).tolist()
+    erp_ids = df_erp['id'].to_numpy()
+    truth = df_truth['id']
+    has_pair = truth.notna().to_numpy()
+
+    engines = [
+        ('wratio', lambda: None),
+        ('blocking', lambda: CandidateIndex(erp_clean)),
+        ('tfidf', lambda: TfidfIndex(erp_clean, args.tfidf_candidates)),
+        ('tfidf --no-rescore', lambda: TfidfIndex(erp_clean, args.tfidf_candidates, rescore=False)),
+    ]
+
+    print(f"Сайт {args.site_rows} x программа учета {args.erp_rows}, порог {args.threshold}%")
+    runs = []
+    baseline = None
+    for name, make_index in engines:
+        match_idx, scores, index_seconds, score_seconds = run_engine(site_clean, erp_clean, args.threshold,
+                                                                     make_index)
+        if baseline is None:
+            baseline = (match_idx, scores)
+        # Совпадение с полным перебором: тот же вариант или та же оценка WRatio
+        agreed = (match_idx == baseline[0]) | (scores == baseline[1])
+        found = np.where(match_idx >= 0, erp_ids[np.maximum(match_idx, 0)], -1)
+        accuracy = float((found[has_pair] == truth[has_pair].to_numpy()).mean()) if has_pair.any() else None
+        total = index_seconds + score_seconds
+        run = {
+            'engine': name,
+            'index_seconds': round(index_seconds, 3),
+            'score_seconds': round(score_seconds, 3),
+            'rows_per_sec': round(len(site_clean) / total, 1) if total else None,
+            'matched': int((match_idx >= 0).sum()),
+            # Без пересчета оценки - косинусы, поэтому сравнивается только выбранный вариант
+            'agreement': round(float((match_idx == baseline[0]).mean() if 'no-rescore' in name
+                                     else agreed.mean()), 4),
+            'accuracy': round(accuracy, 4) if accuracy is not None else None,
+        }
+        runs.append(run)
+        print(f"{name:<20} индекс {run['index_seconds']:7.3f}s | поиск {run['score_seconds']:7.3f}s | "
+              f"{run['rows_per_sec']:>9} строк/с | найдено {run['matched']:>6} | "
+              f"совпадает с WRatio {run['agreement'] * 100:5.1f}% | точность {run['accuracy']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'params': vars(args), 'runs': runs}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Генератор синтетических каталогов товаров для бенчмарков
+"""
+
+import argparse
+import os
+import random
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog_io import write_table
+
+PRODUCT_TYPES = [
+    'Краска', 'Эмаль', 'Грунтовка', 'Шпатлевка', 'Клей плиточный', 'Гипсокартон', 'Плитка керамическая',
+    'Герметик', 'Пена монтажная', 'Саморезы', 'Дюбель', 'Штукатурка', 'Ламинат', 'Обои', 'Лак',
+    'Кисть', 'Валик', 'Перфоратор', 'Дрель', 'Шуруповерт', 'Уровень', 'Рулетка', 'Смеситель', 'Кабель',
+]
+
+# Бренды в двух написаниях: латиницей и кириллицей
+BRANDS = [
+    ('Sniezka', 'Снежка'), ('Knauf', 'Кнауф'), ('Ceresit', 'Церезит'), ('Tikkurila', 'Тиккурила'),
+    ('Bosch', 'Бош'), ('Makita', 'Макита'), ('Dulux', 'Дюлакс'), ('Caparol', 'Капарол'),
+    ('Volma', 'Волма'), ('Bergauf', 'Бергауф'), ('Makroflex', 'Макрофлекс'), ('Tytan', 'Титан'),
+    ('Grohe', 'Грое'), ('Stayer', 'Стайер'), ('Zubr', 'Зубр'), ('Kerama Marazzi', 'Керама Марацци'),
+]
+
+ADJECTIVES = [
+    'белая', 'интерьерная', 'фасадная', 'латексная', 'влагостойкий', 'матовая', 'глянцевая',
+    'морозостойкий', 'универсальный', 'профессиональный', 'серый', 'бесцветный', 'акриловая',
+    'алкидная', 'эластичный', 'быстросохнущая', 'для ванной', 'для наружных работ',
+]
+
+COLORS = ['белый', 'черный', 'серый', 'бежевый', 'коричневый', 'синий', 'зеленый', 'красный']
+
+COUNTRIES = ['Польша', 'Германия', 'Беларусь', 'Россия', 'Финляндия', 'Италия', 'Китай', 'Турция']
+
+
+def _volume(rng):
+    """Объем или вес в разных записях: (для программы учета, для сайта)"""
+    kind = rng.choice(['l', 'kg', 'ml', 'size', 'pcs'])
+    if kind == 'l':
+        value = rng.choice([0.9, 1, 2.5, 3, 5, 9, 10])
+        text = f"{value:g}".replace('.', ',')
+        return f"{text}л", rng.choice([f"{text} л", f"{value:g} l", f"{text}л"])
+    if kind == 'kg':
+        value = rng.choice([1, 5, 10, 20, 25, 30])
+        return f"{value}кг", rng.choice([f"{value} кг", f"{value}kg", f"{value} kg"])
+    if kind == 'ml':
+        value = rng.choice([250, 300, 400, 500, 750])
+        return f"{value}мл", rng.choice([f"{value} мл", f"{value}ml", f"{value / 1000:g} л"])
+    if kind == 'size':
+        a, b, c = rng.choice([(12.5, 1200, 3000), (9.5, 1200, 2500), (300, 300, 8), (600, 600, 10)])
+        text = f"{a:g}х{b}х{c}".replace('.', ',')
+        return text, rng.choice([f"{text} мм", f"{a:g}x{b}x{c}", f"{a:g}*{b}*{c} мм"])
+    value = rng.choice([10, 50, 100, 200, 500])
+    return f"{value}шт", rng.choice([f"{value} шт", f"{value}шт.", f"упаковка {value} шт"])
+
+
+def _typo(rng, text):
+    """Одна опечатка: пропуск, перестановка или замена буквы"""
+    positions = [i for i, ch in enumerate(text) if ch.isalpha()]
+    if len(positions) < 4:
+        return text
+    i = rng.choice(positions[1:-1])
+    kind = rng.choice(['drop', 'swap', 'replace'])
+    if kind == 'drop':
+        return text[:i] + text[i + 1:]
+    if kind == 'swap' and i + 1 < len(text):
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    return text[:i] + rng.choice('аеиоуыэяюabcdeo') + text[i + 1:]
+
+
+def generate(site_rows, erp_rows, seed=0, unmatched_share=0.1, typo_share=0.3):
+    """Пара каталогов (сайт, программа учета) и эталонное соответствие.
+
+    Товары сайта строятся из позиций программы учета с другой записью
+    бренда (RU/EN), единиц измерения, порядка слов, с опечатками и без
+    страны; часть товаров сайта не имеет пары в программе учета.
+    Возвращает (df_site, df_erp, df_truth).
+    """
+    rng = random.Random(seed)
+
+    erp = []
+    for i in range(erp_rows):
+        product = rng.choice(PRODUCT_TYPES)
+        brand = rng.choice(BRANDS)
+        adjectives = rng.sample(ADJECTIVES, rng.randint(0, 2))
+        color = [rng.choice(COLORS)] if rng.random() < 0.3 else []
+        erp_unit, site_unit = _volume(rng)
+        article = f"арт.{rng.randint(10000, 99999)}" if rng.random() < 0.2 else None
+        words = [product, brand[1] if rng.random() < 0.5 else brand[0]] + adjectives + color + [erp_unit]
+        name = " ".join(words)
+        if rng.random() < 0.4:
+            name += f" /{rng.choice(COUNTRIES)}/"
+        if article:
+            name += f" {article}"
+        erp.append({
+            'id': 100000 + i,
+            'наименование': name,
+            '_parts': (product, brand, adjectives, color, site_unit),
+        })
+
+    site = []
+    truth = []
+    for i in range(site_rows):
+        site_id = i + 1
+        if rng.random() < unmatched_share or not erp:
+            product = rng.choice(PRODUCT_TYPES)
+            name = f"{product} {rng.choice(BRANDS)[0]} {_volume(rng)[1]}"
+            truth_id = None
+        else:
+            item = rng.choice(erp)
+            product, brand, adjectives, color, site_unit = item['_parts']
+            # Бренд обычно в другом написании, чем в программе учета
+            words = [product, brand[0] if brand[1] in item['наименование'] else brand[1]]
+            words += rng.sample(adjectives, len(adjectives)) + color + [site_unit]
+            if rng.random() < 0.3:
+                words[0], words[1] = words[1], words[0]
+            name = " ".join(words)
+            if rng.random() < typo_share:
+                name = _typo(rng, name)
+            truth_id = item['id']
+        site.append({'_ID_': site_id, 'Наименование': name})
+        truth.append({'_ID_': site_id, 'id': truth_id})
+
+    df_erp = pd.DataFrame([{'id': item['id'], 'наименование': item['наименование']} for item in erp])
+    return pd.DataFrame(site), df_erp, pd.DataFrame(truth).astype({'id': 'Int64'})
+
+
+def write_catalogs(out_dir, df_site, df_erp, df_truth, fmt='csv'):
+    """Запись каталогов в out_dir; возвращает пути (сайт, программа учета, эталон)"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for name, df in (('site', df_site), ('erp', df_erp)):
+        path = os.path.join(out_dir, f"{name}.{fmt}")
+        write_table(df, path)
+        paths.append(path)
+    truth_path = os.path.join(out_dir, "truth.csv")
+    df_truth.to_csv(truth_path, index=False)
+    return paths[0], paths[1], truth_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетических каталогов товаров")
+    parser.add_argument('--site-rows', type=int, default=10_000, help="товаров на сайте")
+    parser.add_argument('--erp-rows', type=int, default=None, help="позиций в программе учета (по умолчанию как на сайте)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['csv', 'xlsx', 'parquet', 'feather'], default='csv')
+    parser.add_argument('--out-dir', default=os.path.join(os.path.dirname(__file__), 'data'))
+    args = parser.parse_args()
+
+    erp_rows = args.erp_rows if args.erp_rows is not None else args.site_rows
+    df_site, df_erp, df_truth = generate(args.site_rows, erp_rows, args.seed)
+    site_path, erp_path, truth_path = write_catalogs(args.out_dir, df_site, df_erp, df_truth, args.format)
+    print(f"Сайт: {site_path} ({len(df_site)} товаров)")
+    print(f"Программа учета: {erp_path} ({len(df_erp)} товаров)")
+    print(f"Эталон: {truth_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест сервера сопоставления: задержки и пропускная способность
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+
+from generate_catalog import generate
+
+
+def load_names(path, count, seed):
+    """Названия товаров из файла каталога сайта или синтетические"""
+    if path:
+        from catalog_io import iter_catalog_chunks
+        from product_matcher_cli import detect_columns
+
+        names = []
+        for chunk in iter_catalog_chunks(path):
+            _, name_col = detect_columns(chunk, "сайта")
+            names += chunk[name_col].astype(str).tolist()
+            if len(names) >= count:
+                break
+    else:
+        names = generate(count, 1, seed)[0]['Наименование'].tolist()
+    return [names[i % len(names)] for i in range(count)]
+
+
+def post(url, payload, timeout):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = None
+    return time.perf_counter() - start, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера сопоставления")
+    parser.add_argument('--url', default="http://127.0.0.1:8765", help="адрес сервера")
+    parser.add_argument('--site-file', help="файл каталога сайта с названиями для запросов")
+    parser.add_argument('--requests', type=int, default=500, help="число запросов (по умолчанию 500)")
+    parser.add_argument('--concurrency', type=int, default=8, help="одновременных клиентов (по умолчанию 8)")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="названий в запросе; 1 - POST /match, больше - POST /match/batch")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    names = load_names(args.site_file, args.requests * args.batch_size, args.seed)
+    if args.batch_size > 1:
+        url = args.url.rstrip('/') + '/match/batch'
+        payloads = [{'names': names[i:i + args.batch_size]} for i in range(0, len(names), args.batch_size)]
+    else:
+        url = args.url.rstrip('/') + '/match'
+        payloads = [{'name': name} for name in names]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        responses = list(pool.map(lambda payload: post(url, payload, args.timeout), payloads))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, status in responses if status == 200]) * 1000
+    errors = {}
+    for _, status in responses:
+        if status != 200:
+            errors[status] = errors.get(status, 0) + 1
+
+    print(f"Запросов: {len(payloads)}, названий: {len(names)}, клиентов: {args.concurrency}")
+    print(f"Время: {elapsed:.2f} с, {len(payloads) / elapsed:.1f} запросов/с, {len(names) / elapsed:.1f} названий/с")
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"Задержка, мс: p50 {p50:.1f}, p95 {p95:.1f}, p99 {p99:.1f}, макс {latencies.max():.1f}")
+    if errors:
+        print("Ошибки: " + ", ".join(f"{status or 'нет соединения'}: {count}" for status, count in errors.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк конвейера сопоставления по этапам на синтетических каталогах
+
+Каждый размер каталога запускается в отдельном процессе, чтобы пиковая
+память (RSS) относилась только к нему. Результаты сохраняются в JSON
+для сравнения запусков между собой.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+import pandas as pd
+
+from generate_catalog import generate, write_catalogs
+from normalizer import clean_series
+from matching_engine import best_matches, iter_top_matches
+from candidate_index import CandidateIndex
+from catalog_io import build_results, read_catalog, write_table
+from instrumentation import peak_rss_mb
+
+STAGES = ['load', 'normalize', 'index', 'score', 'write']
+
+
+def prepare_data(site_rows, erp_rows, seed, fmt):
+    """Каталоги нужного размера: генерируются один раз и хранятся в benchmarks/data"""
+    out_dir = os.path.join(BENCH_DIR, 'data', f"{site_rows}x{erp_rows}_s{seed}_{fmt}")
+    paths = (os.path.join(out_dir, f"site.{fmt}"), os.path.join(out_dir, f"erp.{fmt}"),
+             os.path.join(out_dir, "truth.csv"))
+    if not all(os.path.isfile(path) for path in paths):
+        df_site, df_erp, df_truth = generate(site_rows, erp_rows, seed)
+        paths = write_catalogs(out_dir, df_site, df_erp, df_truth, fmt)
+    return paths
+
+
+def run_single(site_rows, erp_rows, seed, fmt, threshold, blocking, top_k):
+    """Один прогон конвейера с замером времени каждого этапа"""
+    site_path, erp_path, truth_path = prepare_data(site_rows, erp_rows, seed, fmt)
+    stages = {}
+
+    def timed(name, func):
+        start = time.perf_counter()
+        value = func()
+        stages[name] = time.perf_counter() - start
+        return value
+
+    df_site, df_erp = timed('load', lambda: (read_catalog(site_path), read_catalog(erp_path)))
+    site_clean, erp_clean = timed('normalize', lambda: (clean_series(df_site['Наименование']).tolist(),
+                                                        clean_series(df_erp['наименование']).tolist()))
+    index = timed('index', lambda: CandidateIndex(erp_clean) if blocking else None)
+
+    def score():
+        if top_k > 1:
+            parts = list(iter_top_matches(site_clean, erp_clean, top_k, threshold))
+            return np.concatenate([part[1] for part in parts]), np.concatenate([part[2] for part in parts])
+        return best_matches(site_clean, erp_clean, threshold, index=index)
+
+    match_idx, scores = timed('score', score)
+
+    def write():
+        results = build_results(df_site['_ID_'], df_site['Наименование'], df_erp['id'], df_erp['наименование'],
+                                match_idx, scores)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_table(results, os.path.join(tmp_dir, f"result.{fmt}"))
+        return results
+
+    timed('write', write)
+
+    # Точность по эталону: доля товаров с парой, для которых найдена именно она
+    best = match_idx[:, 0] if match_idx.ndim > 1 else match_idx
+    truth = pd.read_csv(truth_path)['id']
+    erp_ids = df_erp['id'].to_numpy()
+    found = pd.Series([erp_ids[i] if i >= 0 else None for i in best], dtype='float64')
+    has_pair = truth.notna()
+    accuracy = float((found[has_pair] == truth[has_pair]).mean()) if has_pair.any() else None
+
+    total = sum(stages.values())
+    peak_rss = peak_rss_mb()
+    return {
+        'site_rows': site_rows,
+        'erp_rows': erp_rows,
+        'stages': {name: {'seconds': round(stages.get(name, 0.0), 4),
+                          'rows_per_sec': round(site_rows / stages[name], 1) if stages.get(name) else None}
+                   for name in STAGES},
+        'total_seconds': round(total, 4),
+        'rows_per_sec': round(site_rows / total, 1) if total else None,
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+        'matched': int((best >= 0).sum()),
+        'accuracy': round(accuracy, 4) if accuracy is not None else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(run, previous=None):
+    """Строка таблицы с результатами прогона и изменением относительно прошлого"""
+    parts = [f"{run['site_rows']:>8} x {run['erp_rows']:<8}"]
+    for name in STAGES:
+        parts.append(f"{name} {run['stages'][name]['seconds']:8.3f}s")
+    parts.append(f"итого {run['total_seconds']:8.3f}s ({run['rows_per_sec']} строк/с)")
+    parts.append(f"RSS {run['peak_rss_mb']} МБ")
+    parts.append(f"точность {run['accuracy']}")
+    if previous:
+        change = (run['total_seconds'] / previous['total_seconds'] - 1) * 100 if previous['total_seconds'] else 0
+        parts.append(f"[{change:+.1f}% к прошлому]")
+    print(" | ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера сопоставления товаров")
+    parser.add_argument('--sizes', default="1000,10000",
+                        help="размеры каталога сайта через запятую (по умолчанию 1000,10000)")
+    parser.add_argument('--erp-ratio', type=float, default=1.0,
+                        help="размер программы учета относительно сайта (по умолчанию 1.0)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['csv', 'xlsx', 'parquet', 'feather'], default='csv',
+                        help="формат входных файлов и результата (по умолчанию csv)")
+    parser.add_argument('--threshold', type=int, default=60)
+    parser.add_argument('--blocking', action='store_true', help="использовать индекс кандидатов")
+    parser.add_argument('--top-k', type=int, default=1, help="режим нескольких вариантов")
+    parser.add_argument('--output', default=None,
+                        help="файл JSON с результатами (по умолчанию benchmarks/results/bench_<время>.json)")
+    parser.add_argument('--compare', default=None, help="JSON прошлого запуска для сравнения")
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+
+    if args.single:
+        site_rows = sizes[0]
+        run = run_single(site_rows, max(1, int(site_rows * args.erp_ratio)), args.seed, args.format,
+                         args.threshold, args.blocking, args.top_k)
+        print(json.dumps(run))
+        return
+
+    previous = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = {(run['site_rows'], run['erp_rows']): run for run in json.load(f)['runs']}
+
+    runs = []
+    for size in sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--single', '--sizes', str(size),
+                   '--erp-ratio', str(args.erp_ratio), '--seed', str(args.seed), '--format', args.format,
+                   '--threshold', str(args.threshold), '--top-k', str(args.top_k)]
+        if args.blocking:
+            command.append('--blocking')
+        output = subprocess.check_output(command, text=True)
+        run = json.loads(output.strip().splitlines()[-1])
+        runs.append(run)
+        print_run(run, previous.get((run['site_rows'], run['erp_rows'])))
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': {'erp_ratio': args.erp_ratio, 'seed': args.seed, 'format': args.format,
+                   'threshold': args.threshold, 'blocking': args.blocking, 'top_k': args.top_k},
+        'runs': runs,
+    }
+    output_file = args.output or os.path.join(BENCH_DIR, 'results',
+                                              f"bench_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output_file}")
+
+
+if __name__ == "__main__":
+    main()
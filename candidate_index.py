@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Индекс кандидатов (blocking) для сокращения числа сравнений WRatio
+"""
+
+import math
+import random
+from collections import defaultdict
+
+import numpy as np
+from rapidfuzz import process, fuzz
+
+from normalizer import numeric_tokens
+
+# Вес признаков: совпадение числа (объем, размер, артикул) важнее слова,
+# слово важнее отдельной триграммы
+NUMBER_WEIGHT = 2.0
+TOKEN_WEIGHT = 1.0
+TRIGRAM_WEIGHT = 0.5
+
+
+def extract_features(clean):
+    """Признаки очищенного названия: слова, триграммы символов и числа"""
+    features = set()
+    for token in clean.split():
+        features.add(('w', token))
+        padded = f" {token} "
+        for i in range(len(padded) - 2):
+            features.add(('g', padded[i:i + 3]))
+    for number in numeric_tokens(clean):
+        features.add(('n', number))
+    return features
+
+
+class CandidateIndex:
+    """Инвертированный индекс по очищенным названиям программы учета"""
+
+    KIND_WEIGHTS = {'n': NUMBER_WEIGHT, 'w': TOKEN_WEIGHT, 'g': TRIGRAM_WEIGHT}
+
+    def __init__(self, choices, max_candidates=200, max_postings=5000):
+        self.size = len(choices)
+        self.max_candidates = max_candidates
+        self.max_postings = max_postings
+
+        postings = defaultdict(list)
+        for idx, clean in enumerate(choices):
+            for feature in extract_features(clean):
+                postings[feature].append(idx)
+
+        self.postings = {feature: np.asarray(ids, dtype=np.int32) for feature, ids in postings.items()}
+
+    def to_arrays(self):
+        """Компактное представление индекса: (признаки, смещения, индексы)"""
+        features = list(self.postings)
+        lengths = [len(self.postings[feature]) for feature in features]
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = (np.concatenate([self.postings[feature] for feature in features])
+               if features else np.empty(0, dtype=np.int32))
+        return features, offsets, ids
+
+    @classmethod
+    def from_arrays(cls, size, features, offsets, ids, max_candidates=200, max_postings=5000):
+        """Восстановление индекса из to_arrays() без повторного построения"""
+        index = cls.__new__(cls)
+        index.size = size
+        index.max_candidates = max_candidates
+        index.max_postings = max_postings
+        index.postings = {feature: ids[offsets[i]:offsets[i + 1]] for i, feature in enumerate(features)}
+        return index
+
+    def feature_weight(self, feature, df):
+        """Вес признака: тип признака x IDF"""
+        return self.KIND_WEIGHTS[feature[0]] * math.log(1 + self.size / df)
+
+    def candidates(self, clean):
+        """Индексы наиболее похожих названий, отсортированные по возрастанию"""
+        found = [(feature, self.postings[feature]) for feature in extract_features(clean)
+                 if feature in self.postings]
+        if not found:
+            return np.empty(0, dtype=np.int32)
+
+        # Слишком частые признаки почти ничего не отсекают, но дорого обходятся;
+        # если редких нет совсем, берем самый редкий из имеющихся
+        selected = [(feature, ids) for feature, ids in found if len(ids) <= self.max_postings]
+        if not selected:
+            selected = [min(found, key=lambda item: len(item[1]))]
+
+        all_ids = np.concatenate([ids for _, ids in selected])
+        weights = np.concatenate([
+            np.full(len(ids), self.feature_weight(feature, len(ids)), dtype=np.float32)
+            for feature, ids in selected
+        ])
+        unique_ids, inverse = np.unique(all_ids, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+
+        if len(unique_ids) > self.max_candidates:
+            top = np.argpartition(-totals, self.max_candidates - 1)[:self.max_candidates]
+            unique_ids = np.sort(unique_ids[top])
+        return unique_ids
+
+    def candidates_many(self, queries, workers=-1):
+        """Кандидаты для списка запросов"""
+        return [self.candidates(query) for query in queries]
+
+    def best_match(self, clean, choices, threshold=0):
+        """Лучшее совпадение среди кандидатов: (индекс, оценка) или (-1, 0.0)"""
+        candidate_ids = self.candidates(clean)
+        extract = process.extractOne(
+            clean,
+            [choices[i] for i in candidate_ids],
+            scorer=fuzz.WRatio,
+            score_cutoff=threshold
+        )
+        if not extract:
+            return -1, 0.0
+        return int(candidate_ids[extract[2]]), extract[1]
+
+    def match_many(self, queries, choices, threshold=0, workers=-1):
+        """Лучшее совпадение для каждого запроса: список (индекс, оценка)"""
+        return [self.best_match(query, choices, threshold) for query in queries]
+
+
+def recall_check(queries, choices, index, threshold=0, sample_size=200, seed=0):
+    """Сравнение поиска по индексу с полным перебором extractOne на выборке.
+
+    Совпадением считается тот же вариант или вариант с той же оценкой.
+    Полнота считается только по товарам, для которых полный перебор нашел
+    вариант; товары без варианта учитываются отдельно (unmatched,
+    unmatched_agreed - индекс тоже ничего не нашел).
+    Возвращает словарь со статистикой выборки.
+    """
+    queries = list(queries)
+    rng = random.Random(seed)
+    sample = rng.sample(range(len(queries)), min(sample_size, len(queries)))
+
+    agreed = 0
+    baseline_matched = 0
+    unmatched_agreed = 0
+    missed = []
+    for i in sample:
+        extract = process.extractOne(queries[i], choices, scorer=fuzz.WRatio, score_cutoff=threshold)
+        match_idx, score = index.best_match(queries[i], choices, threshold)
+        if not extract:
+            unmatched_agreed += match_idx < 0
+            continue
+        baseline_matched += 1
+        if match_idx == extract[2] or score == extract[1]:
+            agreed += 1
+        else:
+            missed.append((i, extract[2], match_idx))
+
+    return {
+        'sample': len(sample),
+        'baseline_matched': baseline_matched,
+        'agreed': agreed,
+        'recall': agreed / baseline_matched if baseline_matched else 1.0,
+        'unmatched': len(sample) - baseline_matched,
+        'unmatched_agreed': unmatched_agreed,
+        'missed': missed,
+    }
+
+
+def format_recall_check(check):
+    """Строка с итогом recall_check для вывода"""
+    return (f"Проверка полноты индекса: совпало {check['agreed']}/{check['baseline_matched']} "
+            f"({check['recall'] * 100:.1f}%) с полным перебором; без варианта при полном переборе "
+            f"{check['unmatched']}, из них индекс тоже ничего не нашел: {check['unmatched_agreed']}")
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Чтение каталогов и запись результата сопоставления
+"""
+
+import csv
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from exact_match import key_columns
+from matching_engine import top_k_columns
+
+DEFAULT_STREAM_CHUNK = 10_000
+OUTPUT_FORMATS = ['xlsx', 'csv', 'parquet', 'feather']
+# Подкаталог кэша с колоночными копиями Excel-файлов
+COLUMNAR_CACHE_SUBDIR = "columnar"
+RESULT_COLUMNS = ['id сайт', 'наименование сайт', 'id программа', 'наименование программа', 'схожесть %']
+
+
+def file_format(path):
+    """Формат файла по расширению: 'excel', 'csv', 'parquet' или 'feather'"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.xlsx', '.xlsm', '.xls'):
+        return 'excel'
+    if ext in ('.csv', '.txt'):
+        return 'csv'
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+    if ext in ('.feather', '.arrow', '.ipc'):
+        return 'feather'
+    raise ValueError(f"Неподдерживаемый формат файла: {path}")
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Для работы с Parquet и Feather установите pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def columnar_copy_path(path, cache_dir):
+    """Путь колоночной (Parquet) копии Excel-файла: привязан к содержимому файла"""
+    return os.path.join(cache_dir, COLUMNAR_CACHE_SUBDIR, f"{file_hash(path)[:32]}.parquet")
+
+
+def catalog_columns(path):
+    """Названия колонок каталога без чтения данных"""
+    fmt = file_format(path)
+    if fmt == 'csv':
+        return pd.read_csv(path, nrows=0).columns.tolist()
+    if fmt == 'parquet':
+        pyarrow = _import_pyarrow()
+        names = pyarrow.parquet.read_schema(path).names
+    elif fmt == 'feather':
+        pyarrow = _import_pyarrow()
+        names = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).schema.names
+    else:
+        return pd.read_excel(path, nrows=0).columns.tolist()
+    # Сохраненный pandas индекс колонкой каталога не считается
+    return [name for name in names if not name.startswith('__index_level_')]
+
+
+def read_catalog(path, cache_dir=None, columns=None):
+    """Чтение каталога целиком (или только колонок columns), формат по расширению.
+
+    Если задан cache_dir, Excel-файл при первом чтении сохраняется в кэш
+    копией в Parquet, и следующие запуски читают ее вместо Excel.
+    """
+    fmt = file_format(path)
+    if fmt == 'csv':
+        return pd.read_csv(path, usecols=columns)
+    if fmt == 'parquet':
+        _import_pyarrow()
+        return pd.read_parquet(path, columns=columns)
+    if fmt == 'feather':
+        _import_pyarrow()
+        return pd.read_feather(path, columns=columns)
+
+    copy_path = None
+    if cache_dir:
+        _import_pyarrow()
+        copy_path = columnar_copy_path(path, cache_dir)
+        if os.path.isfile(copy_path):
+            try:
+                return pd.read_parquet(copy_path, columns=columns)
+            except Exception:
+                # Поврежденную копию просто пересоздаем
+                pass
+
+    df = pd.read_excel(path)
+    if copy_path:
+        os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+        # Свой временный файл у каждого потока: в GUI каталог могут читать
+        # одновременно предзагрузка и сопоставление
+        tmp_path = f"{copy_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, copy_path)
+        except Exception:
+            # Колонки, которые Arrow не может сохранить без потерь (например,
+            # вперемешку числа и строки), оставляют файл без копии
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return df[columns] if columns is not None else df
+
+
+def load_catalog(path, detect_func, cache_dir=None):
+    """Каталог только с нужными колонками: ID, название и ключи (артикул, штрихкод).
+
+    Колонки определяются по заголовку, и остальные колонки файла
+    (описания, цены и т.п.) не читаются в память, если формат это позволяет.
+    Возвращает (df, id_col, name_col).
+    """
+    columns = catalog_columns(path)
+    id_col, name_col = detect_func(pd.DataFrame(columns=columns))
+    needed = list(dict.fromkeys([id_col, name_col, *key_columns(columns).values()]))
+    return read_catalog(path, cache_dir, needed), id_col, name_col
+
+
+def shared_strings(values):
+    """Список строк, в котором одинаковые значения - один и тот же объект Python.
+
+    Очищенные названия повторяются (варианты цвета, размера), а списки
+    для rapidfuzz держат по объекту на строку каталога.
+    """
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=False)
+    return np.asarray(uniques, dtype=object)[codes].tolist()
+
+
+def write_table(df, path):
+    """Запись DataFrame целиком, формат по расширению"""
+    fmt = file_format(path)
+    if fmt == 'csv':
+        # utf-8-sig, чтобы Excel правильно открывал кириллицу
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+    elif fmt in ('parquet', 'feather'):
+        _import_pyarrow()
+        df = _arrow_compatible(df.reset_index(drop=True))
+        if fmt == 'parquet':
+            df.to_parquet(path, index=False)
+        else:
+            df.to_feather(path)
+    else:
+        df.to_excel(path, index=False)
+
+
+def _arrow_compatible(df):
+    """Колонки с разнотипными значениями (ID из Excel: числа и строки) приводятся к строкам"""
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        values = df[col]
+        if values.dropna().map(type).nunique() > 1:
+            df[col] = values.map(str).where(values.notna(), None)
+    return df
+
+
+def iter_catalog_chunks(path, chunk_size=DEFAULT_STREAM_CHUNK):
+    """Чтение каталога порциями DataFrame по chunk_size строк"""
+    fmt = file_format(path)
+
+    if fmt == 'csv':
+        yield from pd.read_csv(path, chunksize=chunk_size)
+        return
+
+    if fmt == 'parquet':
+        pyarrow = _import_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+        return
+
+    if fmt == 'feather':
+        pyarrow = _import_pyarrow()
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r'))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for start in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(start, chunk_size).to_pandas()
+        return
+
+    if os.path.splitext(path)[1].lower() == '.xls':
+        # Старый формат openpyxl не читает: загружаем целиком и отдаем порциями
+        df = pd.read_excel(path)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+        return
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(col) if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+
+        batch = []
+        for values in rows:
+            if values is None or all(value is None for value in values):
+                continue
+            batch.append(values[:len(columns)])
+            if len(batch) >= chunk_size:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+
+def build_results(site_ids, site_names, erp_ids, erp_names, match_indices, scores):
+    """Таблица результата для найденных совпадений (массивы 1D или (n, top_k)).
+
+    Сопоставление хранит только массивы индексов и оценок; значения
+    каталогов подставляются по ним здесь, при выводе. site_ids и site_names
+    выровнены с match_indices.
+    """
+    match_indices = np.asarray(match_indices)
+    scores = np.asarray(scores)
+    multiple = match_indices.ndim > 1
+    best_idx = match_indices[:, 0] if multiple else match_indices
+    rows = np.flatnonzero(best_idx >= 0)
+
+    result = {
+        'id сайт': _take(site_ids, rows),
+        'наименование сайт': _take(site_names, rows),
+        'id программа': _take(erp_ids, best_idx[rows]),
+        'наименование программа': _take(erp_names, best_idx[rows]),
+        'схожесть %': np.round(scores[rows, 0] if multiple else scores[rows], 1),
+    }
+    columns = list(RESULT_COLUMNS)
+    if multiple:
+        top_k = match_indices.shape[1]
+        match_idx, score = match_indices[rows], scores[rows]
+        columns += top_k_columns(top_k)
+        result['отрыв от 2-го %'] = (_masked(np.round(score[:, 0] - score[:, 1], 1), match_idx[:, 1] >= 0)
+                                     if top_k > 1 else np.full(len(rows), None, dtype=object))
+        for rank in range(2, top_k + 1):
+            idx = match_idx[:, rank - 1]
+            found = idx >= 0
+            result[f'id программа {rank}'] = _masked(_take(erp_ids, np.where(found, idx, 0)), found)
+            result[f'наименование программа {rank}'] = _masked(_take(erp_names, np.where(found, idx, 0)), found)
+            result[f'схожесть {rank} %'] = _masked(np.round(score[:, rank - 1], 1), found)
+    return pd.DataFrame(result, columns=columns)
+
+
+def _take(values, positions):
+    """Значения колонки (Series или списка) по позициям, без индекса исходной таблицы"""
+    if not isinstance(values, pd.Series):
+        values = pd.Series(values)
+    return values.iloc[positions].reset_index(drop=True)
+
+
+def _masked(values, found):
+    """Значения там, где вариант найден, и None в остальных строках"""
+    values = np.asarray(values, dtype=object)
+    values[~found] = None
+    return values
+
+
+class ResultWriter:
+    """Запись результата порциями в Excel (write-only), CSV, Parquet или Feather.
+
+    CSV дописывается и сбрасывается на диск после каждой порции, поэтому
+    уже записанные строки переживают аварийное завершение. Excel, Parquet
+    и Feather становятся читаемыми только после close().
+
+    Схема Parquet/Feather задается заранее: колонки схожести - float64,
+    остальные (ID и наименования) - строки. Тип из первой порции не
+    годится: в ней колонки вариантов могут быть пустыми, а ID следующих
+    порций - другого типа.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.format = file_format(path)
+        self.rows_written = 0
+        self._file = None
+        self._writer = None
+
+        if self.format == 'csv':
+            # utf-8-sig, чтобы Excel правильно открывал кириллицу
+            self._file = open(path, 'w', newline='', encoding='utf-8-sig')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.columns)
+        elif self.format in ('parquet', 'feather'):
+            self._pyarrow = _import_pyarrow()
+            self._score_columns = [col for col in self.columns if col.endswith('%')]
+            self._schema = self._pyarrow.schema([
+                (col, self._pyarrow.float64() if col in self._score_columns
+                 else self._pyarrow.string())
+                for col in self.columns
+            ])
+        else:
+            from openpyxl import Workbook
+
+            self._workbook = Workbook(write_only=True)
+            self._sheet = self._workbook.create_sheet()
+            self._sheet.append(self.columns)
+
+    def write(self, results):
+        """Запись порции результата: DataFrame с колонками columns"""
+        if not len(results):
+            return
+        results = results[self.columns]
+
+        if self.format == 'csv':
+            results.to_csv(self._file, header=False, index=False, lineterminator='\r\n')
+            self._file.flush()
+        elif self.format in ('parquet', 'feather'):
+            table = self._arrow_table(results)
+            if self._writer is None:
+                if self.format == 'parquet':
+                    self._writer = self._pyarrow.parquet.ParquetWriter(self.path, self._schema)
+                else:
+                    self._writer = self._pyarrow.ipc.new_file(self.path, self._schema)
+            self._writer.write_table(table)
+        else:
+            for row in results.itertuples(index=False, name=None):
+                self._sheet.append([_excel_value(item) for item in row])
+        self.rows_written += len(results)
+
+    def close(self):
+        if self.format == 'csv':
+            self._file.close()
+        elif self.format in ('parquet', 'feather'):
+            if self._writer is None:
+                self._write_empty()
+            else:
+                self._writer.close()
+        else:
+            self._workbook.save(self.path)
+
+    def _arrow_table(self, results):
+        """Порция результата в таблицу Arrow со схемой писателя"""
+        arrays = []
+        for col in self.columns:
+            values = results[col]
+            if col in self._score_columns:
+                values = pd.to_numeric(values, errors='coerce').astype('float64')
+            else:
+                values = values.astype(object)
+                values = values.map(str).where(values.notna(), None)
+            arrays.append(self._pyarrow.array(values, type=self._schema.field(col).type, from_pandas=True))
+        return self._pyarrow.Table.from_arrays(arrays, schema=self._schema)
+
+    def _write_empty(self):
+        """Пустой файл с заголовком, если не было ни одной порции"""
+        table = self._schema.empty_table()
+        if self.format == 'parquet':
+            self._pyarrow.parquet.write_table(table, self.path)
+        else:
+            with self._pyarrow.ipc.new_file(self.path, self._schema) as writer:
+                writer.write_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _excel_value(value):
+    """Значения numpy в обычные типы Python для openpyxl"""
+    return value.item() if hasattr(value, 'item') else value
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Контрольные точки длительного сопоставления для продолжения после остановки
+"""
+
+import os
+import pickle
+import time
+
+import numpy as np
+
+from catalog_io import file_hash
+from normalizer import CLEAN_NAME_VERSION
+
+CHECKPOINT_FORMAT_VERSION = 1
+DEFAULT_CHECKPOINT_INTERVAL = 60
+
+
+def checkpoint_path(output_file):
+    """Файл контрольной точки рядом с файлом результата"""
+    return os.path.splitext(output_file)[0] + ".checkpoint.pkl"
+
+
+def run_fingerprint(site_file, erp_file, threshold, **options):
+    """Отпечаток запуска: содержимое входных файлов и настройки сопоставления"""
+    return {
+        'site': file_hash(site_file),
+        'erp': file_hash(erp_file),
+        'threshold': threshold,
+        'clean_version': CLEAN_NAME_VERSION,
+        **options,
+    }
+
+
+class Checkpoint:
+    """Периодическое сохранение обработанного диапазона и частичных результатов"""
+
+    def __init__(self, path, fingerprint, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.last_saved = time.monotonic()
+
+    def load(self, total):
+        """(match_idx, scores, next_index) из контрольной точки или None"""
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return None
+        if (data.get('version') != CHECKPOINT_FORMAT_VERSION or data.get('fingerprint') != self.fingerprint
+                or data.get('total') != total):
+            return None
+
+        # В режиме нескольких вариантов массивы двумерные: (total, top_k)
+        shape = (total,) + data['match_idx'].shape[1:]
+        match_idx = np.full(shape, -1, dtype=np.int64)
+        scores = np.zeros(shape, dtype=np.float64)
+        next_index = data['next_index']
+        match_idx[:next_index] = data['match_idx']
+        scores[:next_index] = data['scores']
+        return match_idx, scores, next_index
+
+    def save(self, match_idx, scores, next_index):
+        """Запись обработанного префикса [0, next_index) с атомарной заменой файла"""
+        data = {
+            'version': CHECKPOINT_FORMAT_VERSION,
+            'fingerprint': self.fingerprint,
+            'total': len(match_idx),
+            'next_index': next_index,
+            'match_idx': np.asarray(match_idx[:next_index]),
+            'scores': np.asarray(scores[:next_index]),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.last_saved = time.monotonic()
+
+    def maybe_save(self, match_idx, scores, next_index):
+        """Сохранение, если с прошлой записи прошло больше interval секунд"""
+        if time.monotonic() - self.last_saved >= self.interval:
+            self.save(match_idx, scores, next_index)
+            return True
+        return False
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
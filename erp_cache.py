@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш очищенного каталога программы учета на диске
+"""
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from candidate_index import CandidateIndex
+from catalog_io import file_hash, load_catalog
+from normalizer import CLEAN_NAME_VERSION, clean_series
+
+DEFAULT_CACHE_DIR = ".matcher_cache"
+# Версия формата кэша: меняется при изменении состава сохраняемых данных
+CACHE_FORMAT_VERSION = 2
+
+
+def cache_key(path):
+    """Ключ кэша: содержимое файла + версия правил очистки + версия формата"""
+    return f"{file_hash(path)[:32]}_c{CLEAN_NAME_VERSION}_f{CACHE_FORMAT_VERSION}"
+
+
+def _write_atomic(entry_dir, write_files):
+    """Запись файлов во временный каталог и его атомарное переименование"""
+    parent = os.path.dirname(entry_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+    try:
+        write_files(tmp_dir)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_erp_catalog(path, detect_func, cache_dir=DEFAULT_CACHE_DIR, use_cache=True, columnar_cache=False):
+    """Загрузка каталога программы учета с очисткой названий.
+
+    При наличии кэша для того же содержимого файла и той же версии очистки
+    чтение файла и нормализация пропускаются. С columnar_cache Excel-файл
+    читается через его Parquet-копию в cache_dir (см. read_catalog).
+    Читаются только колонки ID, названия, артикула/штрихкода (если есть),
+    к ним добавляется 'clean'.
+    Возвращает (df, id_col, name_col, key, from_cache).
+    """
+    key = cache_key(path) if use_cache else None
+    entry_dir = os.path.join(cache_dir, key) if key else None
+
+    if entry_dir and os.path.isfile(os.path.join(entry_dir, 'meta.json')):
+        try:
+            with open(os.path.join(entry_dir, 'meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            df = pd.read_pickle(os.path.join(entry_dir, 'catalog.pkl'))
+            return df, meta['id_col'], meta['name_col'], key, True
+        except Exception:
+            # Поврежденный кэш просто пересобираем
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    df, id_col, name_col = load_catalog(path, detect_func, cache_dir if columnar_cache else None)
+    df['clean'] = clean_series(df[name_col])
+
+    if entry_dir:
+        def write_files(tmp_dir):
+            df.to_pickle(os.path.join(tmp_dir, 'catalog.pkl'), protocol=pickle.HIGHEST_PROTOCOL)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump({'source': os.path.abspath(path), 'id_col': id_col, 'name_col': name_col,
+                           'rows': len(df)}, f, ensure_ascii=False)
+
+        try:
+            _write_atomic(entry_dir, write_files)
+        except OSError:
+            pass
+
+    return df, id_col, name_col, key, False
+
+
+def load_candidate_index(key, choices, max_candidates=200, cache_dir=DEFAULT_CACHE_DIR):
+    """Индекс кандидатов из кэша (через memory-map) или построение и сохранение нового"""
+    if key is None:
+        return CandidateIndex(choices, max_candidates=max_candidates)
+
+    index_dir = os.path.join(cache_dir, key, 'index')
+    if os.path.isfile(os.path.join(index_dir, 'features.pkl')):
+        try:
+            with open(os.path.join(index_dir, 'features.pkl'), 'rb') as f:
+                size, features = pickle.load(f)
+            offsets = np.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r')
+            ids = np.load(os.path.join(index_dir, 'ids.npy'), mmap_mode='r')
+            if size == len(choices):
+                return CandidateIndex.from_arrays(size, features, offsets, ids, max_candidates=max_candidates)
+        except Exception:
+            pass
+
+    index = CandidateIndex(choices, max_candidates=max_candidates)
+    features, offsets, ids = index.to_arrays()
+
+    def write_files(tmp_dir):
+        with open(os.path.join(tmp_dir, 'features.pkl'), 'wb') as f:
+            pickle.dump((index.size, features), f, protocol=pickle.HIGHEST_PROTOCOL)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, 'ids.npy'), ids)
+
+    if os.path.isdir(os.path.join(cache_dir, key)):
+        try:
+            _write_atomic(index_dir, write_files)
+        except OSError:
+            pass
+    return index
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Быстрый проход перед нечетким поиском: совпадения по артикулу/штрихкоду
+и по точному совпадению очищенного названия
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz
+
+from matching_engine import auto_chunk_size, best_matches
+
+# Колонки с ключами товара; пара колонок сайта и программы учета
+# сопоставляется по одному виду ключа
+KEY_COLUMN_PATTERNS = {
+    'article': re.compile(r'артикул|\barticle\b|\bsku\b'),
+    'barcode': re.compile(r'штрих|\bean(13)?\b|\bgtin\b|\bbarcode\b'),
+}
+KEY_JUNK_RE = re.compile(r'[\s\-_./\\]+')
+
+# Способы, которыми найдено совпадение; TIER_UNKNOWN - строка еще не обработана
+TIER_UNKNOWN = -1
+TIER_NONE = 0
+TIER_KEY = 1
+TIER_EXACT = 2
+TIER_FUZZY = 3
+TIER_NAMES = {
+    TIER_KEY: "по артикулу/штрихкоду",
+    TIER_EXACT: "по точному совпадению названия",
+    TIER_FUZZY: "нечетким поиском",
+}
+
+
+def key_columns(columns):
+    """Колонки ключей по видам: {'article': колонка, 'barcode': колонка}"""
+    found = {}
+    for col in columns:
+        name = str(col).lower()
+        for kind, pattern in KEY_COLUMN_PATTERNS.items():
+            if kind not in found and pattern.search(name):
+                found[kind] = col
+    return found
+
+
+def pair_key_columns(site_columns, erp_columns):
+    """Пары (колонка сайта, колонка программы учета) с ключами одного вида"""
+    site_keys = key_columns(site_columns)
+    erp_keys = key_columns(erp_columns)
+    return [(site_keys[kind], erp_keys[kind]) for kind in KEY_COLUMN_PATTERNS
+            if kind in site_keys and kind in erp_keys]
+
+
+def normalize_key(value):
+    """Ключ для сравнения: без пробелов и разделителей, без ведущих нулей
+    у чисел (штрихкод из Excel часто читается как 4600000000000.0)"""
+    if value is None or (np.isscalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = KEY_JUNK_RE.sub('', str(value).lower())
+    if text.isdigit():
+        text = text.lstrip('0')
+    return text or None
+
+
+def _unique_lookup(keys):
+    """Ключ -> позиция; ключи, встречающиеся несколько раз, неоднозначны и пропускаются"""
+    lookup = {}
+    for idx, key in enumerate(keys):
+        if key is None:
+            continue
+        lookup[key] = -1 if key in lookup else idx
+    return {key: idx for key, idx in lookup.items() if idx >= 0}
+
+
+def build_exact_matcher(choices, df_erp, site_columns):
+    """ExactMatcher по каталогу программы учета и пары колонок ключей
+    для каталога сайта с колонками site_columns"""
+    key_pairs = pair_key_columns(site_columns, df_erp.columns)
+    return ExactMatcher(choices, [df_erp[erp_col].tolist() for _, erp_col in key_pairs]), key_pairs
+
+
+class ExactMatcher:
+    """Хеш-таблицы по очищенным названиям и ключам программы учета"""
+
+    def __init__(self, choices, erp_key_values=()):
+        # Из одинаковых названий берем первое: так же поступает полный перебор
+        self.by_name = {}
+        for idx, clean in enumerate(choices):
+            if clean:
+                self.by_name.setdefault(clean, idx)
+        self.choices = choices
+        self.by_key = [_unique_lookup(normalize_key(value) for value in values) for values in erp_key_values]
+        self.tier_counts = dict.fromkeys([TIER_KEY, TIER_EXACT, TIER_FUZZY, TIER_NONE], 0)
+        # Способ по каждой строке последнего iter_matches
+        self.tiers = None
+
+    def resolve(self, queries, site_key_values=()):
+        """(match_idx, scores, tiers) для всех запросов; -1 и TIER_NONE - не найдено.
+
+        Сначала ключи (артикул, штрихкод), затем точное совпадение очищенного
+        названия. Для совпадений по ключу оценка - фактическая схожесть названий.
+        """
+        match_idx = np.full(len(queries), -1, dtype=np.int64)
+        scores = np.zeros(len(queries), dtype=np.float64)
+        tiers = np.full(len(queries), TIER_NONE, dtype=np.int8)
+
+        site_keys = [[normalize_key(value) for value in values] for values in site_key_values]
+        for i, query in enumerate(queries):
+            for lookup, keys in zip(self.by_key, site_keys):
+                idx = lookup.get(keys[i]) if keys[i] is not None else None
+                if idx is not None:
+                    match_idx[i] = idx
+                    scores[i] = fuzz.WRatio(query, self.choices[idx])
+                    tiers[i] = TIER_KEY
+                    break
+            else:
+                idx = self.by_name.get(query) if query else None
+                if idx is not None:
+                    match_idx[i] = idx
+                    scores[i] = 100.0
+                    tiers[i] = TIER_EXACT
+        return match_idx, scores, tiers
+
+    def key_matched(self, queries, site_key_values=(), tiers=None):
+        """Маска товаров, найденных по артикулу/штрихкоду: порог к ним не применяется.
+
+        tiers - уже известные способы по строкам (self.tiers после iter_matches);
+        заново проверяются только строки с TIER_UNKNOWN.
+        """
+        if not self.by_key:
+            return np.zeros(len(queries), dtype=bool)
+        if tiers is None:
+            return self.resolve(queries, site_key_values)[2] == TIER_KEY
+        queries = list(queries)
+        tiers = np.array(tiers, dtype=np.int8)
+        unknown = np.flatnonzero(tiers == TIER_UNKNOWN)
+        if len(unknown):
+            values = [list(values) for values in site_key_values]
+            tiers[unknown] = self.resolve([queries[i] for i in unknown],
+                                          [[column[i] for i in unknown] for column in values])[2]
+        return tiers == TIER_KEY
+
+    def iter_matches(self, queries, site_key_values=(), threshold=0, chunk_size=None, workers=-1, index=None,
+                     start_at=0, memo=None):
+        """Порции (start, match_idx, scores), как у iter_best_matches, но в нечеткий
+        поиск попадают только товары, не найденные быстрым проходом.
+
+        Точное совпадение очищенного названия дает WRatio 100 и первый такой
+        вариант в каталоге, поэтому без ключей результат совпадает с полным
+        перебором. Число товаров по способам накапливается в tier_counts.
+        """
+        queries = list(queries)
+        known = memo if memo is not None else {}
+        site_key_values = [list(values) for values in site_key_values]
+        if chunk_size is None:
+            chunk_size = auto_chunk_size(len(self.choices))
+        self.tiers = np.full(len(queries), TIER_UNKNOWN, dtype=np.int8)
+
+        for start in range(start_at, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            match_idx, scores, tiers = self.resolve(chunk, [values[start:start + chunk_size]
+                                                            for values in site_key_values])
+            pending = np.flatnonzero(match_idx < 0)
+            if len(pending):
+                fuzzy_idx, fuzzy_scores = best_matches([chunk[i] for i in pending], self.choices, threshold,
+                                                       workers=workers, index=index, memo=known)
+                match_idx[pending] = fuzzy_idx
+                scores[pending] = fuzzy_scores
+                tiers[pending[fuzzy_idx >= 0]] = TIER_FUZZY
+
+            for tier, count in zip(*np.unique(tiers, return_counts=True)):
+                self.tier_counts[int(tier)] += int(count)
+            self.tiers[start:start + len(chunk)] = tiers
+            yield start, match_idx, scores
+
+    def summary(self):
+        """Строка с числом товаров, найденных каждым способом"""
+        return format_tier_counts(self.tier_counts)
+
+
+def format_tier_counts(tier_counts):
+    """Строка с числом товаров по способам из словаря {способ: число}"""
+    return ", ".join(f"{TIER_NAMES[tier]}: {tier_counts.get(tier, 0)}" for tier in TIER_NAMES)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Инкрементальное пересопоставление по изменениям относительно прошлого запуска
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from matching_engine import best_matches
+
+STATE_FORMAT_VERSION = 2
+
+
+def state_path(output_file):
+    """Файл состояния рядом с файлом результата"""
+    return os.path.splitext(output_file)[0] + ".state.pkl"
+
+
+def changes_path(output_file):
+    """Файл отчета об изменениях рядом с файлом результата, в том же формате"""
+    base, ext = os.path.splitext(output_file)
+    return base + "_изменения" + (ext or ".xlsx")
+
+
+def save_state(path, site_ids, site_clean, erp_ids, erp_clean, match_idx, scores, threshold, clean_version,
+               pinned=None, options=None):
+    """Сохранение снимка входных данных и лучших совпадений всех товаров сайта.
+    pinned - маска товаров, найденных по артикулу/штрихкоду; options - настройки
+    поиска, от которых зависят оценки"""
+    erp_ids = list(erp_ids)
+    if pinned is None:
+        pinned = np.zeros(len(match_idx), dtype=bool)
+    state = {
+        'version': STATE_FORMAT_VERSION,
+        'threshold': threshold,
+        'clean_version': clean_version,
+        'options': dict(options or {}),
+        'site': pd.DataFrame({
+            'id': list(site_ids),
+            'clean': list(site_clean),
+            'erp_id': pd.Series([erp_ids[i] if i >= 0 else None for i in match_idx], dtype=object),
+            'score': np.asarray(scores, dtype=np.float64),
+            'pinned': np.asarray(pinned, dtype=bool),
+        }),
+        'erp': pd.DataFrame({'id': erp_ids, 'clean': list(erp_clean)}),
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_state(path, threshold, clean_version, options=None):
+    """Снимок прошлого запуска или None, если он отсутствует или несовместим
+    (другой порог, версия очистки или настройки поиска)"""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception:
+        return None
+    if (state.get('version') != STATE_FORMAT_VERSION or state.get('threshold') != threshold
+            or state.get('clean_version') != clean_version or state.get('options') != dict(options or {})):
+        return None
+    return state
+
+
+def _diff(prev_ids, prev_clean, ids, clean):
+    """Сравнение двух версий каталога по ID: (добавлены, удалены, переименованы)"""
+    prev = dict(zip(prev_ids, prev_clean))
+    current = dict(zip(ids, clean))
+    added = [key for key in current if key not in prev]
+    removed = [key for key in prev if key not in current]
+    renamed = [key for key in current if key in prev and prev[key] != current[key]]
+    return added, removed, renamed
+
+
+def incremental_match(state, site_ids, site_clean, erp_ids, erp_clean, threshold, index=None, key_matches=None):
+    """Пересчет совпадений только для затронутых пар.
+
+    - товары, найденные по артикулу/штрихкоду (key_matches - (match_idx,
+      scores, маска) текущего быстрого прохода), берут совпадение по ключу;
+    - новые и переименованные товары сайта сравниваются со всем каталогом;
+    - товары, чье совпадение удалено или переименовано в программе учета,
+      а также потерявшие совпадение по ключу, тоже;
+    - остальные товары сравниваются только с новыми и переименованными
+      позициями программы учета.
+    Возвращает (match_idx, scores, stats) либо None, если ID в каталогах не уникальны.
+    """
+    site_ids = list(site_ids)
+    site_clean = list(site_clean)
+    erp_ids = list(erp_ids)
+    erp_clean = list(erp_clean)
+    if len(set(site_ids)) != len(site_ids) or len(set(erp_ids)) != len(erp_ids):
+        return None
+
+    prev_site = state['site']
+    prev_erp = state['erp']
+    site_added, site_removed, site_renamed = _diff(prev_site['id'], prev_site['clean'], site_ids, site_clean)
+    erp_added, erp_removed, erp_renamed = _diff(prev_erp['id'], prev_erp['clean'], erp_ids, erp_clean)
+
+    erp_pos = {key: pos for pos, key in enumerate(erp_ids)}
+    prev_best = dict(zip(prev_site['id'], zip(prev_site['clean'], prev_site['erp_id'], prev_site['score'],
+                                             prev_site['pinned'])))
+    lost_erp = set(erp_removed) | set(erp_renamed)
+
+    match_idx = np.full(len(site_ids), -1, dtype=np.int64)
+    scores = np.zeros(len(site_ids), dtype=np.float64)
+    pinned = np.zeros(len(site_ids), dtype=bool)
+    if key_matches is not None:
+        pinned = np.asarray(key_matches[2], dtype=bool)
+        match_idx[pinned] = np.asarray(key_matches[0])[pinned]
+        scores[pinned] = np.asarray(key_matches[1])[pinned]
+    full_rows = []
+    for row, (key, clean) in enumerate(zip(site_ids, site_clean)):
+        if pinned[row]:
+            continue
+        prev = prev_best.get(key)
+        if (prev is None or prev[0] != clean or prev[3]
+                or (prev[1] is not None and prev[1] in lost_erp)):
+            full_rows.append(row)
+            continue
+        if prev[1] is not None:
+            match_idx[row] = erp_pos[prev[1]]
+            scores[row] = prev[2]
+
+    # Полный поиск для новых товаров и товаров, потерявших совпадение
+    if full_rows:
+        found_idx, found_scores = best_matches([site_clean[row] for row in full_rows], erp_clean,
+                                               threshold, index=index)
+        match_idx[full_rows] = found_idx
+        scores[full_rows] = found_scores
+
+    # Остальные товары сравниваются только с новыми позициями программы учета
+    new_erp = sorted(erp_pos[key] for key in set(erp_added) | set(erp_renamed))
+    kept_rows = sorted(set(range(len(site_ids))) - set(full_rows) - set(np.flatnonzero(pinned).tolist()))
+    rescored = 0
+    if new_erp and kept_rows:
+        found_idx, found_scores = best_matches([site_clean[row] for row in kept_rows],
+                                               [erp_clean[pos] for pos in new_erp], threshold)
+        for row, local_idx, score in zip(kept_rows, found_idx, found_scores):
+            if local_idx < 0:
+                continue
+            candidate = new_erp[local_idx]
+            # При равной оценке полный проход выбрал бы позицию с меньшим номером
+            if (match_idx[row] < 0 or score > scores[row]
+                    or (score == scores[row] and candidate < match_idx[row])):
+                match_idx[row] = candidate
+                scores[row] = score
+                rescored += 1
+
+    stats = {
+        'site_added': len(site_added),
+        'site_removed': len(site_removed),
+        'site_renamed': len(site_renamed),
+        'erp_added': len(erp_added),
+        'erp_removed': len(erp_removed),
+        'erp_renamed': len(erp_renamed),
+        'full_rows': len(full_rows),
+        'partial_rows': len(kept_rows) if new_erp else 0,
+        'improved_rows': rescored,
+        'key_rows': int(pinned.sum()),
+    }
+    return match_idx, scores, stats
+
+
+def change_report(state, site_ids, site_names, site_clean, erp_ids, erp_names, match_idx, scores):
+    """Отчет об изменениях совпадений относительно прошлого запуска"""
+    prev_site = state['site']
+    prev_best = dict(zip(prev_site['id'], zip(prev_site['erp_id'], prev_site['score'])))
+    prev_clean = dict(zip(prev_site['id'], prev_site['clean']))
+    erp_ids = list(erp_ids)
+    erp_name_by_id = dict(zip(erp_ids, erp_names))
+    current_ids = set()
+
+    rows = []
+    for key, name, clean, idx, score in zip(site_ids, site_names, site_clean, match_idx, scores):
+        current_ids.add(key)
+        erp_id = erp_ids[idx] if idx >= 0 else None
+        if key not in prev_best:
+            change = 'добавлен товар'
+            prev_erp_id, prev_score = None, None
+        else:
+            prev_erp_id, prev_score = prev_best[key]
+            if prev_erp_id == erp_id:
+                if erp_id is not None and round(prev_score, 1) != round(score, 1):
+                    change = 'изменилась схожесть'
+                elif prev_clean[key] != clean:
+                    change = 'переименован товар'
+                else:
+                    continue
+            elif prev_erp_id is None:
+                change = 'найдено совпадение'
+            elif erp_id is None:
+                change = 'совпадение потеряно'
+            else:
+                change = 'совпадение изменено'
+        rows.append({
+            'id сайт': key,
+            'наименование сайт': name,
+            'изменение': change,
+            'было id программа': prev_erp_id,
+            'стало id программа': erp_id,
+            'стало наименование программа': erp_name_by_id.get(erp_id) if erp_id is not None else None,
+            'было схожесть %': round(prev_score, 1) if prev_erp_id is not None else None,
+            'стало схожесть %': round(score, 1) if erp_id is not None else None,
+        })
+
+    for key, (prev_erp_id, prev_score) in prev_best.items():
+        if key not in current_ids:
+            rows.append({
+                'id сайт': key,
+                'наименование сайт': None,
+                'изменение': 'удален товар',
+                'было id программа': prev_erp_id,
+                'стало id программа': None,
+                'стало наименование программа': None,
+                'было схожесть %': round(prev_score, 1) if prev_erp_id is not None else None,
+                'стало схожесть %': None,
+            })
+    return pd.DataFrame(rows)
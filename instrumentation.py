@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Замеры этапов сопоставления и машиночитаемый отчет о запуске
+"""
+
+import cProfile
+import csv
+import heapq
+import io
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+from rapidfuzz import process, fuzz
+
+SCORE_BINS = list(range(0, 101, 10))
+SLOW_QUERIES_KEPT = 10
+
+
+def peak_rss_mb():
+    """Пиковое потребление памяти процессом, МБ (None, если узнать нельзя)"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Текущее потребление памяти процессом, МБ (None, если узнать нельзя)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+def _round(value, digits=4):
+    return round(value, digits) if value is not None else None
+
+
+class RunReport:
+    """Время, процессорное время и память по этапам, гистограмма оценок
+    и самые медленные товары одного запуска
+
+    Этапы могут быть вложенными (detect_columns внутри загрузки), поэтому
+    общее время считается от создания отчета, а не суммой этапов.
+    """
+
+    def __init__(self, **params):
+        self.started = datetime.now()
+        self.params = params
+        self.stages = {}
+        self._clock = time.perf_counter()
+        self.counters = {}
+        self.score_counts = np.zeros(len(SCORE_BINS) - 1, dtype=np.int64)
+        self.no_match = 0
+        self._slow = []
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """Замер этапа: with report.stage('score', rows=len(queries)): ...
+
+        Повторные замеры с тем же именем (например, по порциям) суммируются.
+        """
+        rss_before = current_rss_mb()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            rss_after = current_rss_mb()
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'rows': None, 'rss_delta': None})
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            if rows is not None:
+                stage['rows'] = (stage['rows'] or 0) + rows
+            if rss_before is not None and rss_after is not None:
+                stage['rss_delta'] = (stage['rss_delta'] or 0.0) + rss_after - rss_before
+            stage['rss'] = rss_after
+            stage['peak_rss'] = peak_rss_mb()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_scores(self, match_indices, scores):
+        """Добавление оценок лучших вариантов в гистограмму"""
+        match_indices = np.asarray(match_indices)
+        scores = np.asarray(scores)
+        if match_indices.ndim > 1:
+            match_indices, scores = match_indices[:, 0], scores[:, 0]
+        found = match_indices >= 0
+        self.no_match += int((~found).sum())
+        self.score_counts += np.histogram(scores[found], bins=SCORE_BINS)[0]
+
+    def record_query(self, seconds, index, query):
+        """Учет времени одного товара; хранятся только самые медленные"""
+        item = (seconds, index, query)
+        if len(self._slow) < SLOW_QUERIES_KEPT:
+            heapq.heappush(self._slow, item)
+        elif item > self._slow[0]:
+            heapq.heapreplace(self._slow, item)
+
+    def stage_rows(self):
+        """Этапы в порядке первого замера в виде плоских записей"""
+        return [{
+            'stage': name,
+            'rows': stage['rows'],
+            'wall_seconds': _round(stage['wall']),
+            'cpu_seconds': _round(stage['cpu']),
+            'rows_per_sec': _round(stage['rows'] / stage['wall'], 1) if stage['rows'] and stage['wall'] else None,
+            'rss_mb': _round(stage['rss'], 1),
+            'rss_delta_mb': _round(stage['rss_delta'], 1),
+            'peak_rss_mb': _round(stage['peak_rss'], 1),
+        } for name, stage in self.stages.items()]
+
+    def to_dict(self):
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'params': self.params,
+            'stages': self.stage_rows(),
+            'total_wall_seconds': _round(time.perf_counter() - self._clock),
+            'peak_rss_mb': _round(peak_rss_mb(), 1),
+            'counters': self.counters,
+            'score_histogram': [
+                {'from': low, 'to': high, 'count': int(count)}
+                for low, high, count in zip(SCORE_BINS, SCORE_BINS[1:], self.score_counts)
+            ],
+            'no_match': self.no_match,
+            'slowest_queries': [
+                {'index': index, 'query': query, 'seconds': _round(seconds, 6)}
+                for seconds, index, query in sorted(self._slow, reverse=True)
+            ],
+        }
+
+    def write(self, path):
+        """Запись отчета в JSON или, для .csv, таблицы этапов в CSV"""
+        if os.path.splitext(path)[1].lower() == '.csv':
+            rows = self.stage_rows()
+            with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ['stage'])
+                writer.writeheader()
+                writer.writerows(rows)
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def summary(self):
+        """Краткая таблица этапов для вывода в консоль"""
+        lines = []
+        for stage in self.stage_rows():
+            speed = f", {stage['rows_per_sec']} строк/с" if stage['rows_per_sec'] else ""
+            lines.append(f"  {stage['stage']:<16} {stage['wall_seconds']:9.3f} с "
+                         f"(CPU {stage['cpu_seconds']:.3f} с{speed}), RSS {stage['rss_mb']} МБ")
+        return "\n".join(lines)
+
+
+def sample_query_times(report, queries, choices, threshold=0, index=None, sample_size=200, seed=0):
+    """Время поиска лучшего варианта для случайной выборки товаров.
+
+    Движок сравнивает товары порциями, поэтому время отдельного товара
+    замеряется повторным поиском на выборке тем же способом (индекс или
+    полный перебор).
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(queries), size=min(sample_size, len(queries)), replace=False)
+    with report.stage('query_sample', rows=len(sample)):
+        for i in sorted(sample.tolist()):
+            start = time.perf_counter()
+            if index is not None:
+                index.best_match(queries[i], choices, threshold)
+            else:
+                process.extractOne(queries[i], choices, scorer=fuzz.WRatio, score_cutoff=threshold)
+            report.record_query(time.perf_counter() - start, i, queries[i])
+
+
+@contextmanager
+def profiled(path, top=20):
+    """cProfile всего блока с записью статистики в path (None - без профилирования)"""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        print(stream.getvalue())
+        print(f"Профиль сохранен в файл: {path}")
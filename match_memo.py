@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Память результатов сопоставления: одинаковые очищенные названия
+считаются один раз за запуск и, по желанию, между запусками (SQLite)
+"""
+
+import os
+import sqlite3
+
+MEMO_FILE = "memo.sqlite"
+
+
+class MatchMemo:
+    """Очищенное название -> (индекс в каталоге программы учета, оценка).
+
+    Результат зависит от каталога программы учета, алгоритма и порога,
+    поэтому они входят в ключ записи. Без path память живет только
+    в течение запуска. Интерфейс get/update как у dict, движок принимает
+    и то, и другое.
+    """
+
+    def __init__(self, erp_fingerprint, scorer, threshold, path=None):
+        self.key = (erp_fingerprint, scorer, float(threshold))
+        self.entries = {}
+        self.reused = 0
+        self.scored = 0
+        self.connection = None
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # Пакетный режим обращается к памяти из разных потоков, но по очереди
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS memo ("
+                "erp TEXT, scorer TEXT, threshold REAL, query TEXT, idx INTEGER, score REAL, "
+                "PRIMARY KEY (erp, scorer, threshold, query))"
+            )
+            rows = self.connection.execute(
+                "SELECT query, idx, score FROM memo WHERE erp = ? AND scorer = ? AND threshold = ?", self.key)
+            self.entries = {query: (idx, score) for query, idx, score in rows}
+        self.loaded = len(self.entries)
+
+    def get(self, query, default=None):
+        result = self.entries.get(query)
+        if result is None:
+            return default
+        self.reused += 1
+        return result
+
+    def update(self, results):
+        """Добавление новых результатов {название: (индекс, оценка)}"""
+        self.entries.update(results)
+        self.scored += len(results)
+        if self.connection is not None and results:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?, ?)",
+                    [(*self.key, query, int(idx), float(score)) for query, (idx, score) in results.items()]
+                )
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Общий движок пакетного сопоставления названий товаров
+"""
+
+import os
+
+import numpy as np
+from rapidfuzz import process, fuzz
+
+from normalizer import numeric_tokens
+
+# Ограничение на размер одной матрицы оценок (строк x колонок),
+# 16 млн ячеек float32 ~ 64 МБ независимо от размера каталогов
+MAX_CHUNK_CELLS = 16_000_000
+
+# Дешевые алгоритмы первого прохода для режима нескольких вариантов
+PREFILTER_SCORERS = {
+    'ratio': fuzz.ratio,
+    'token_set': fuzz.token_set_ratio,
+}
+# Максимальный штраф второго прохода за несовпадение чисел (объем, вес, размер)
+NUMERIC_PENALTY = 0.25
+
+
+def auto_chunk_size(n_choices):
+    """Размер порции запросов, при котором матрица оценок укладывается в лимит"""
+    return max(1, MAX_CHUNK_CELLS // max(1, n_choices))
+
+
+def _effective_workers(workers):
+    """Число потоков для workers в смысле rapidfuzz (-1 - все ядра)"""
+    return (os.cpu_count() or 1) if workers is None or workers < 0 else max(1, workers)
+
+
+def _score_unique(queries, choices, threshold, workers, index):
+    """Лучший вариант для списка разных запросов: {запрос: (индекс, оценка)}"""
+    results = {}
+    if index is not None:
+        results = dict(zip(queries, index.match_many(queries, choices, threshold, workers)))
+    elif choices and queries and _effective_workers(workers) == 1:
+        # В один поток extractOne быстрее cdist: он поднимает порог по ходу
+        # перебора до лучшей найденной оценки, а cdist считает с постоянным
+        for query in queries:
+            extract = process.extractOne(query, choices, scorer=fuzz.WRatio, score_cutoff=threshold)
+            results[query] = (extract[2], extract[1]) if extract else (-1, 0.0)
+    elif choices and queries:
+        # Порог передаем в scorer: пары ниже порога не досчитываются
+        matrix = process.cdist(
+            queries,
+            choices,
+            scorer=fuzz.WRatio,
+            score_cutoff=threshold,
+            dtype=np.float32,
+            workers=workers
+        )
+        best = matrix.argmax(axis=1)
+        best_scores = matrix[np.arange(len(queries)), best]
+
+        for query, choice_idx, best_score in zip(queries, best, best_scores):
+            if threshold > 0 and best_score == 0:
+                results[query] = (-1, 0.0)
+            else:
+                # Точная оценка в float64, как у extractOne
+                results[query] = (int(choice_idx), fuzz.WRatio(query, choices[choice_idx]))
+    else:
+        results = dict.fromkeys(queries, (-1, 0.0))
+    return results
+
+
+def iter_best_matches(queries, choices, threshold=0, chunk_size=None, workers=-1, index=None, start_at=0,
+                      memo=None):
+    """Поиск лучшего совпадения для каждого запроса порциями.
+
+    Для каждой порции возвращает (start, match_idx, scores): индекс лучшего
+    варианта в choices (-1, если схожесть ниже порога) и его оценку WRatio.
+    Результат совпадает с process.extractOne(query, choices, scorer=fuzz.WRatio).
+    Если передан index (CandidateIndex или TfidfIndex), каждый запрос
+    сравнивается только со своими кандидатами. start_at позволяет продолжить с середины списка
+    запросов, start при этом остается позицией в полном списке.
+
+    Одинаковые запросы считаются один раз за вызов; memo (dict или
+    MatchMemo) позволяет переносить результаты между вызовами и запусками.
+    """
+    queries = list(queries)
+    choices = list(choices)
+    if chunk_size is None:
+        chunk_size = auto_chunk_size(len(choices))
+    known = memo if memo is not None else {}
+
+    for start in range(start_at, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+
+        results = {}
+        for query in dict.fromkeys(chunk):
+            found = known.get(query)
+            if found is not None:
+                results[query] = found
+        new = _score_unique([query for query in dict.fromkeys(chunk) if query not in results],
+                            choices, threshold, workers, index)
+        known.update(new)
+        results.update(new)
+
+        match_idx = np.fromiter((results[query][0] for query in chunk), dtype=np.int64, count=len(chunk))
+        scores = np.fromiter((results[query][1] for query in chunk), dtype=np.float64, count=len(chunk))
+        yield start, match_idx, scores
+
+
+def best_matches(queries, choices, threshold=0, chunk_size=None, workers=-1, index=None, memo=None):
+    """Лучшее совпадение для всех запросов: массивы (match_idx, scores)"""
+    parts = list(iter_best_matches(queries, choices, threshold, chunk_size, workers, index, memo=memo))
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    match_idx = np.concatenate([part[1] for part in parts])
+    scores = np.concatenate([part[2] for part in parts])
+    return match_idx, scores
+
+
+def numeric_agreement(query, choice):
+    """Доля общих чисел в двух очищенных названиях (1.0, если чисел нет хотя бы в одном)"""
+    query_numbers = numeric_tokens(query)
+    choice_numbers = numeric_tokens(choice)
+    if not query_numbers or not choice_numbers:
+        return 1.0
+    return len(query_numbers & choice_numbers) / len(query_numbers | choice_numbers)
+
+
+def rerank_score(query, choice):
+    """Оценка второго прохода: WRatio со штрафом за расхождение чисел"""
+    score = fuzz.WRatio(query, choice)
+    return score * (1 - NUMERIC_PENALTY * (1 - numeric_agreement(query, choice)))
+
+
+def iter_top_matches(queries, choices, top_k=5, threshold=0, prefilter='ratio', chunk_size=None,
+                     workers=-1, start_at=0, index=None):
+    """Несколько лучших вариантов для каждого запроса порциями.
+
+    Первый проход дешевым алгоритмом prefilter отбирает top_k кандидатов
+    из всего каталога, второй проход пересчитывает их через rerank_score и
+    упорядочивает. Для каждой порции возвращает (start, match_idx, scores)
+    формы (n, top_k); варианты ниже порога помечаются индексом -1.
+    С index (TfidfIndex) первым проходом служит поиск по TF-IDF.
+    """
+    queries = list(queries)
+    choices = list(choices)
+    scorer = PREFILTER_SCORERS[prefilter]
+    if chunk_size is None:
+        chunk_size = auto_chunk_size(len(choices))
+    k = min(top_k, len(choices))
+
+    for start in range(start_at, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        match_idx = np.full((len(chunk), top_k), -1, dtype=np.int64)
+        scores = np.zeros((len(chunk), top_k), dtype=np.float64)
+
+        if index is not None:
+            match_idx, scores = index.top_matches(chunk, choices, top_k, threshold, workers)
+        elif k:
+            matrix = process.cdist(chunk, choices, scorer=scorer, dtype=np.float32, workers=workers)
+            if k < len(choices):
+                candidates = np.argpartition(-matrix, k - 1, axis=1)[:, :k]
+            else:
+                candidates = np.tile(np.arange(len(choices)), (len(chunk), 1))
+
+            for i, query in enumerate(chunk):
+                # Сортировка по оценке, при равенстве - по позиции в каталоге
+                ranked = sorted(((rerank_score(query, choices[j]), int(j)) for j in candidates[i]),
+                                key=lambda item: (-item[0], item[1]))
+                ranked = [(score, j) for score, j in ranked if score >= threshold and score > 0]
+                for rank, (score, j) in enumerate(ranked):
+                    match_idx[i, rank] = j
+                    scores[i, rank] = score
+
+        yield start, match_idx, scores
+
+
+def match_chunks(queries, choices, threshold, index=None, top_k=1, prefilter='ratio', start_at=0,
+                 exact=None, site_key_values=(), memo=None, workers=-1):
+    """Порции результата движка: лучший вариант или top_k вариантов с повторной оценкой.
+
+    С exact (ExactMatcher) товары, найденные по ключу или точному названию,
+    в нечеткий поиск не попадают. memo (MatchMemo) хранит уже посчитанные названия.
+    """
+    if top_k > 1:
+        return iter_top_matches(queries, choices, top_k, threshold, prefilter, workers=workers, start_at=start_at,
+                                index=index)
+    if exact is not None:
+        return exact.iter_matches(queries, site_key_values, threshold, workers=workers, index=index,
+                                  start_at=start_at, memo=memo)
+    return iter_best_matches(queries, choices, threshold, workers=workers, index=index, start_at=start_at,
+                             memo=memo)
+
+
+def top_k_columns(top_k):
+    """Дополнительные колонки результата для режима нескольких вариантов"""
+    columns = ['отрыв от 2-го %']
+    for rank in range(2, top_k + 1):
+        columns += [f'id программа {rank}', f'наименование программа {rank}', f'схожесть {rank} %']
+    return columns
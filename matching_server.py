@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сервер сопоставления: каталог программы учета загружается один раз и
+держится в памяти, запросы принимаются по HTTP/JSON
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from normalizer import clean_series
+from matching_engine import best_matches, iter_top_matches
+from erp_cache import DEFAULT_CACHE_DIR, load_erp_catalog, load_candidate_index
+from catalog_io import shared_strings
+from product_matcher_cli import detect_columns
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_MAX_BATCH = 1000
+DEFAULT_BATCH_WINDOW_MS = 5
+DEFAULT_RELOAD_INTERVAL = 5
+# Больше вариантов на запрос не отдается: размер ответа и матрицы (n, top_k) ограничен
+MAX_TOP_K = 50
+
+
+def _json_value(value):
+    """Значения numpy в обычные типы Python для json"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ErpSnapshot:
+    """Подготовленный каталог программы учета: не меняется после создания,
+    при перезагрузке заменяется целиком"""
+
+    def __init__(self, erp_file, cache_dir, use_cache, blocking, max_candidates):
+        self.erp_file = erp_file
+        self.stat = _file_stat(erp_file)
+        df_erp, self.id_col, self.name_col, self.key, self.from_cache = load_erp_catalog(
+            erp_file,
+            lambda df: detect_columns(df, "программы учета"),
+            cache_dir=cache_dir,
+            use_cache=use_cache
+        )
+        self.choices = shared_strings(df_erp['clean'])
+        self.ids = [_json_value(value) for value in df_erp[self.id_col].tolist()]
+        self.names = df_erp[self.name_col].tolist()
+        self.index = (load_candidate_index(self.key, self.choices, max_candidates, cache_dir)
+                      if blocking else None)
+        self.loaded_at = datetime.now()
+
+    def match(self, names, threshold, top_k=1):
+        """Список результатов по одному на название: лучший вариант или None,
+        в режиме top_k > 1 дополнительно список вариантов"""
+        queries = clean_series(pd.Series(names, dtype=object)).tolist()
+        if top_k > 1:
+            parts = list(iter_top_matches(queries, self.choices, top_k, threshold))
+            match_idx = np.concatenate([part[1] for part in parts]) if parts else np.empty((0, top_k))
+            scores = np.concatenate([part[2] for part in parts]) if parts else np.empty((0, top_k))
+        else:
+            match_idx, scores = best_matches(queries, self.choices, threshold, index=self.index)
+
+        results = []
+        for idx_row, score_row in zip(match_idx, scores):
+            variants = [self._variant(i, score) for i, score in zip(np.atleast_1d(idx_row), np.atleast_1d(score_row))
+                        if i >= 0]
+            result = {'match': variants[0] if variants else None}
+            if top_k > 1:
+                result['candidates'] = variants
+            results.append(result)
+        return results
+
+    def _variant(self, i, score):
+        return {'id': self.ids[i], 'name': self.names[i], 'score': round(float(score), 1)}
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class MatchingService:
+    """Каталог в памяти, ограничение параллельных сопоставлений и
+    перезагрузка при изменении файла программы учета"""
+
+    def __init__(self, erp_file, threshold=60, cache_dir=DEFAULT_CACHE_DIR, use_cache=True, blocking=False,
+                 max_candidates=200, max_concurrent=DEFAULT_MAX_CONCURRENT, max_batch=DEFAULT_MAX_BATCH):
+        self.erp_file = erp_file
+        self.threshold = threshold
+        self.cache_dir = cache_dir
+        self.use_cache = use_cache
+        self.blocking = blocking
+        self.max_candidates = max_candidates
+        self.max_batch = max_batch
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.reload_lock = threading.Lock()
+        self.last_error = None
+        self.snapshot = self._load()
+
+    def _load(self):
+        return ErpSnapshot(self.erp_file, self.cache_dir, self.use_cache, self.blocking, self.max_candidates)
+
+    def reload(self, force=False):
+        """Перезагрузка каталога, если файл изменился. Пока новый каталог
+        готовится, запросы обслуживаются старым; при ошибке он остается"""
+        with self.reload_lock:
+            try:
+                if not force and _file_stat(self.erp_file) == self.snapshot.stat:
+                    return False
+                self.snapshot = self._load()
+                self.last_error = None
+                print(f"Каталог программы учета перезагружен: {len(self.snapshot.choices)} товаров")
+                return True
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Ошибка перезагрузки каталога: {e}")
+                return False
+
+    def watch(self, interval, stop_event):
+        """Проверка изменения файла раз в interval секунд (для фонового потока)"""
+        while not stop_event.wait(interval):
+            self.reload()
+
+    def match(self, names, threshold=None, top_k=1, timeout=None):
+        """Сопоставление списка названий; None, если все слоты заняты дольше timeout"""
+        if not self.slots.acquire(timeout=timeout):
+            return None
+        try:
+            return self.snapshot.match(names, self.threshold if threshold is None else threshold, top_k)
+        finally:
+            self.slots.release()
+
+    def health(self):
+        snapshot = self.snapshot
+        return {
+            'status': 'ok',
+            'erp_file': snapshot.erp_file,
+            'erp_rows': len(snapshot.choices),
+            'id_column': snapshot.id_col,
+            'name_column': snapshot.name_col,
+            'loaded_at': snapshot.loaded_at.isoformat(timespec='seconds'),
+            'blocking': snapshot.index is not None,
+            'threshold': self.threshold,
+            'last_reload_error': self.last_error,
+        }
+
+
+class MicroBatcher:
+    """Объединение одиночных запросов, пришедших почти одновременно,
+    в одно пакетное сопоставление (одна матрица cdist вместо многих)"""
+
+    def __init__(self, service, window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH):
+        self.service = service
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, name, threshold=None, top_k=1, timeout=None):
+        """Результат для одного названия; None, если сервис перегружен"""
+        item = {'name': name, 'options': (threshold, top_k, timeout), 'done': threading.Event(), 'result': None}
+        self.pending.put(item)
+        item['done'].wait()
+        if isinstance(item['result'], Exception):
+            raise item['result']
+        return item['result']
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # В одно сопоставление попадают только запросы с одинаковыми настройками
+            groups = {}
+            for item in batch:
+                groups.setdefault(item['options'], []).append(item)
+            for (threshold, top_k, timeout), items in groups.items():
+                try:
+                    results = self.service.match([item['name'] for item in items], threshold, top_k, timeout)
+                except Exception as e:
+                    results = [e] * len(items)
+                for item, result in zip(items, results or [None] * len(items)):
+                    item['result'] = result
+                    item['done'].set()
+
+
+class MatchingHandler(BaseHTTPRequestHandler):
+    """GET /health, POST /match, POST /match/batch, POST /reload"""
+
+    service = None
+    batcher = None
+    busy_timeout = 30
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, self.service.health())
+        else:
+            self._send(404, {'error': "неизвестный адрес"})
+
+    def do_POST(self):
+        if self.path == '/reload':
+            self._send(200, {'reloaded': self.service.reload(force=True), **self.service.health()})
+            return
+        if self.path not in ('/match', '/match/batch'):
+            self._send(404, {'error': "неизвестный адрес"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}')
+            threshold = body.get('threshold')
+            top_k = int(body.get('top_k', 1))
+        except (ValueError, TypeError, AttributeError):
+            self._send(400, {'error': "ожидается JSON-объект"})
+            return
+        if threshold is not None and (isinstance(threshold, bool) or not isinstance(threshold, (int, float))
+                                      or not 0 <= threshold <= 100):
+            self._send(400, {'error': "поле 'threshold' должно быть числом от 0 до 100"})
+            return
+        if not 1 <= top_k <= MAX_TOP_K:
+            self._send(400, {'error': f"поле 'top_k' должно быть от 1 до {MAX_TOP_K}"})
+            return
+
+        if self.path == '/match':
+            name = body.get('name')
+            if not isinstance(name, str):
+                self._send(400, {'error': "поле 'name' должно быть строкой"})
+                return
+            result = self.batcher.submit(name, threshold, top_k, timeout=self.busy_timeout)
+            if result is None:
+                self._send(503, {'error': "сервер перегружен, повторите запрос позже"})
+            else:
+                self._send(200, {'name': name, **result})
+            return
+
+        names = body.get('names')
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            self._send(400, {'error': "поле 'names' должно быть списком строк"})
+            return
+        if len(names) > self.service.max_batch:
+            self._send(413, {'error': f"в одном запросе не больше {self.service.max_batch} названий"})
+            return
+        results = self.service.match(names, threshold, top_k, timeout=self.busy_timeout)
+        if results is None:
+            self._send(503, {'error': "сервер перегружен, повторите запрос позже"})
+        else:
+            self._send(200, {'results': [{'name': name, **result} for name, result in zip(names, results)]})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Журнал каждого запроса мешает при нагрузке
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP-сервер сопоставления товаров с программой учета")
+    parser.add_argument('erp_file', help="файл программы учета")
+    parser.add_argument('--host', default='127.0.0.1', help="адрес (по умолчанию 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"порт (по умолчанию {DEFAULT_PORT})")
+    parser.add_argument('--threshold', type=int, default=60, help="порог схожести по умолчанию (60)")
+    parser.add_argument('--blocking', action='store_true', help="сравнивать только с кандидатами из индекса")
+    parser.add_argument('--max-candidates', type=int, default=200,
+                        help="число кандидатов на товар в быстром режиме (по умолчанию 200)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="не использовать кэш очищенного каталога программы учета")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f"каталог кэша (по умолчанию {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--max-concurrent', type=int, default=DEFAULT_MAX_CONCURRENT,
+                        help=f"одновременных сопоставлений (по умолчанию {DEFAULT_MAX_CONCURRENT})")
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help=f"названий в одном пакете (по умолчанию {DEFAULT_MAX_BATCH})")
+    parser.add_argument('--batch-window-ms', type=float, default=DEFAULT_BATCH_WINDOW_MS,
+                        help=f"ожидание одиночных запросов для объединения, мс (по умолчанию {DEFAULT_BATCH_WINDOW_MS})")
+    parser.add_argument('--reload-interval', type=float, default=DEFAULT_RELOAD_INTERVAL,
+                        help=f"проверка изменения файла, с; 0 - не проверять (по умолчанию {DEFAULT_RELOAD_INTERVAL})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.erp_file):
+        print(f"Ошибка: Файл {args.erp_file} не найден")
+        return
+
+    print("Загружаю каталог программы учета...")
+    service = MatchingService(args.erp_file, args.threshold, args.cache_dir, not args.no_cache, args.blocking,
+                              args.max_candidates, args.max_concurrent, args.max_batch)
+    print(f"Загружено {len(service.snapshot.choices)} товаров" + (" (из кэша)" if service.snapshot.from_cache else ""))
+
+    stop_event = threading.Event()
+    if args.reload_interval > 0:
+        threading.Thread(target=service.watch, args=(args.reload_interval, stop_event), daemon=True).start()
+
+    MatchingHandler.service = service
+    MatchingHandler.batcher = MicroBatcher(service, args.batch_window_ms, args.max_batch)
+    server = ThreadingHTTPServer((args.host, args.port), MatchingHandler)
+    print(f"Сервер запущен: http://{args.host}:{args.port} (Ctrl+C - остановка)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+        print("Сервер остановлен")
+
+
+if __name__ == "__main__":
+    main()
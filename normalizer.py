@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Общая очистка названий товаров для сопоставления
+"""
+
+import re
+from functools import lru_cache
+
+import pandas as pd
+from anyascii import anyascii
+
+# Версия правил очистки: увеличивать при любом изменении clean_name,
+# чтобы кэш каталога программы учета и состояние прошлых запусков пересобрались
+CLEAN_NAME_VERSION = 1
+
+# Страны в косых чертах /Беларусь/, /Германия/
+COUNTRY_RE = re.compile(r'/[^/]+/')
+# Все, кроме латинских букв, цифр и пробелов
+NON_ALNUM_RE = re.compile(r'[^a-zA-Z0-9\s]')
+NUMBER_RE = re.compile(r'\d+')
+
+
+class _AsciiTable(dict):
+    """Таблица для str.translate: транслитерация anyascii по одному символу с запоминанием"""
+
+    def __missing__(self, code):
+        value = anyascii(chr(code))
+        self[code] = value
+        return value
+
+
+ASCII_TABLE = _AsciiTable()
+
+
+@lru_cache(maxsize=200_000)
+def _clean(name):
+    name = COUNTRY_RE.sub(' ', name)
+    # Транслитерация для сопоставления RU/EN брендов
+    name = name.translate(ASCII_TABLE)
+    # Оставляем буквы и цифры
+    name = NON_ALNUM_RE.sub(' ', name).lower()
+    return " ".join(name.split())
+
+
+def clean_name(name):
+    """Очистка названия товара для сопоставления"""
+    if not isinstance(name, str):
+        return ""
+    return _clean(name)
+
+
+@lru_cache(maxsize=200_000)
+def numeric_tokens(clean):
+    """Числа из очищенного названия (объем, вес, размер, артикул) без ведущих нулей"""
+    return frozenset(number.lstrip('0') or '0' for number in NUMBER_RE.findall(clean))
+
+
+def clean_series(series):
+    """Очистка колонки названий целиком.
+
+    Каждое уникальное название очищается один раз строковыми операциями
+    pandas, затем результат раскладывается по всем строкам.
+    """
+    is_str = series.map(lambda value: isinstance(value, str))
+    names = series[is_str]
+    uniques = pd.Series(names.unique(), dtype=object)
+
+    cleaned = (uniques
+               .str.replace(COUNTRY_RE, ' ', regex=True)
+               .str.translate(ASCII_TABLE)
+               .str.replace(NON_ALNUM_RE, ' ', regex=True)
+               .str.lower()
+               .str.split()
+               .str.join(' '))
+
+    return names.map(dict(zip(uniques, cleaned))).reindex(series.index, fill_value="")
@@ -4,25 +4,30 @@
 Консольная версия программы сопоставления товаров
 """
 
+import numpy as np
 import pandas as pd
-from rapidfuzz import process, fuzz
-from anyascii import anyascii
-import re
-import sys
 import os
+import argparse
 
+from normalizer import CLEAN_NAME_VERSION, clean_series
+from matching_engine import PREFILTER_SCORERS, match_chunks, top_k_columns
+from candidate_index import format_recall_check, recall_check
+from erp_cache import DEFAULT_CACHE_DIR, cache_key as catalog_key, load_erp_catalog, load_candidate_index
+from incremental import state_path, changes_path, save_state, load_state, incremental_match, change_report
+from catalog_io import (DEFAULT_STREAM_CHUNK, RESULT_COLUMNS, ResultWriter, build_results, columnar_copy_path,
+                        file_format, iter_catalog_chunks, load_catalog, shared_strings, write_table)
+from checkpoint import DEFAULT_CHECKPOINT_INTERVAL, Checkpoint, checkpoint_path, run_fingerprint
+from instrumentation import RunReport, profiled, sample_query_times
+from exact_match import TIER_EXACT, TIER_FUZZY, TIER_KEY, build_exact_matcher, format_tier_counts
+from match_memo import MEMO_FILE, MatchMemo
+from sharding import (DEFAULT_STALE_AFTER, cleanup_shards, merge_shards, prepare_shards, run_sharded, run_worker,
+                      shard_dir_for, wait_for_plan)
+from tfidf_index import DEFAULT_TFIDF_CANDIDATES, TfidfIndex
+from score_store import (SWEEP_THRESHOLDS, apply_threshold, load_score_store, make_score_store, save_score_store,
+                         score_store_path, store_results, threshold_sweep)
+from assignment import ASSIGN_SOLVERS, DEFAULT_ASSIGN_CANDIDATES, assign, assignment_path, assignment_report
 
-def clean_name(name):
-    """Очистка названия товара для сопоставления"""
-    if not isinstance(name, str):
-        return ""
-    # Убираем страны в косых чертах /Беларусь/, /Германия/
-    name = re.sub(r'/[^/]+/', ' ', name)
-    # Транслитерация для сопоставления RU/EN брендов
-    name = anyascii(name)
-    # Оставляем буквы и цифры
-    name = re.sub(r'[^a-zA-Z0-9\s]', ' ', name).lower()
-    return " ".join(name.split())
+ENGINES = ('wratio', 'tfidf')
 
 
 def detect_columns(df, file_type):
@@ -53,18 +58,326 @@ def detect_columns(df, file_type):
     return id_col, name_col
 
 
+def parse_args(argv=None):
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Сопоставление товаров каталога сайта с программой учета")
+    parser.add_argument('site_file', nargs='?', help="файл каталога сайта")
+    parser.add_argument('erp_file', nargs='?', help="файл программы учета")
+    parser.add_argument('threshold', nargs='?', type=int, default=60,
+                        help="минимальный порог схожести (30-95, по умолчанию 60)")
+    parser.add_argument('--blocking', action='store_true',
+                        help="сравнивать только с кандидатами из индекса (быстрый режим для больших каталогов)")
+    parser.add_argument('--max-candidates', type=int, default=200,
+                        help="число кандидатов на товар в быстром режиме (по умолчанию 200)")
+    parser.add_argument('--engine', choices=ENGINES, default='wratio',
+                        help="алгоритм поиска: wratio - WRatio по всему каталогу или кандидатам --blocking, "
+                             "tfidf - отбор кандидатов по TF-IDF символьных триграмм (нужен scipy); "
+                             "по умолчанию wratio")
+    parser.add_argument('--tfidf-candidates', type=int, default=DEFAULT_TFIDF_CANDIDATES, metavar='N',
+                        help=f"число кандидатов TF-IDF на товар (по умолчанию {DEFAULT_TFIDF_CANDIDATES})")
+    parser.add_argument('--no-rescore', action='store_true',
+                        help="не пересчитывать кандидатов TF-IDF через WRatio: оценка - косинус x 100")
+    parser.add_argument('--recall-check', type=int, nargs='?', const=200, default=0, metavar='N',
+                        help="сравнить быстрый режим с полным перебором на выборке из N товаров")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="не использовать кэш очищенного каталога программы учета")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f"каталог кэша (по умолчанию {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--columnar-cache', action='store_true',
+                        help="один раз сохранить копию входных Excel-файлов в Parquet в каталоге кэша "
+                             "и читать ее в следующих запусках")
+    parser.add_argument('--output', default="результат_сопоставления.xlsx",
+                        help="файл результата: xlsx, csv, parquet или feather по расширению "
+                             "(по умолчанию результат_сопоставления.xlsx)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="пересчитать только товары, затронутые изменениями с прошлого запуска")
+    parser.add_argument('--stream', action='store_true',
+                        help="читать файл сайта и записывать результат порциями (xlsx, csv, parquet или feather)")
+    parser.add_argument('--top-k', type=int, default=1, metavar='K',
+                        help="сохранять K лучших вариантов на товар с повторной оценкой (по умолчанию 1)")
+    parser.add_argument('--prefilter', choices=sorted(PREFILTER_SCORERS), default='ratio',
+                        help="алгоритм первого прохода в режиме --top-k (по умолчанию ratio)")
+    parser.add_argument('--resume', action='store_true',
+                        help="продолжить прерванное сопоставление с последней контрольной точки")
+    parser.add_argument('--checkpoint-every', type=int, default=DEFAULT_CHECKPOINT_INTERVAL, metavar='SECONDS',
+                        help=f"интервал сохранения контрольной точки (по умолчанию {DEFAULT_CHECKPOINT_INTERVAL} с)")
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_STREAM_CHUNK,
+                        help=f"размер порции в потоковом режиме (по умолчанию {DEFAULT_STREAM_CHUNK})")
+    parser.add_argument('--no-fast-path', action='store_true',
+                        help="не искать совпадения по артикулу/штрихкоду и точному названию до нечеткого поиска")
+    parser.add_argument('--memo', nargs='?', const='', default=None, metavar='FILE',
+                        help=f"запоминать результаты для названий между запусками "
+                             f"(по умолчанию {MEMO_FILE} в каталоге кэша)")
+    parser.add_argument('--shards', type=int, default=0, metavar='N',
+                        help="разбить каталог сайта на N частей и сопоставлять их в отдельных процессах")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, metavar='W',
+                        help="число локальных процессов для --shards; 0 - только ждать воркеры на других машинах")
+    parser.add_argument('--shard-dir', metavar='DIR',
+                        help="общий каталог шардов (по умолчанию <результат>.shards рядом с результатом)")
+    parser.add_argument('--shard-worker', metavar='DIR',
+                        help="режим воркера: обрабатывать свободные шарды из общего каталога DIR и выйти")
+    parser.add_argument('--shard-stale', type=int, default=DEFAULT_STALE_AFTER, metavar='SECONDS',
+                        help=f"через сколько секунд без обновления шард считается брошенным "
+                             f"(по умолчанию {DEFAULT_STALE_AFTER})")
+    parser.add_argument('--scores', metavar='FILE',
+                        help="файл оценок всех товаров для смены порога без пересчета "
+                             "(по умолчанию <результат>.scores.pkl рядом с результатом)")
+    parser.add_argument('--score-floor', type=int, metavar='N',
+                        help="сохранять в файле оценок варианты от N%% и ниже порога, чтобы потом "
+                             "можно было снизить порог (сравнение медленнее)")
+    parser.add_argument('--rethreshold', type=int, metavar='N',
+                        help="не сопоставлять, а пересобрать результат с порогом N из файла оценок прошлого запуска")
+    parser.add_argument('--sweep', metavar='FILE',
+                        help=f"сохранить таблицу подбора порога: число совпадений и распределение оценок "
+                             f"для порогов {SWEEP_THRESHOLDS.start}-{SWEEP_THRESHOLDS.stop - 1} "
+                             f"с шагом {SWEEP_THRESHOLDS.step}")
+    parser.add_argument('--assign', choices=ASSIGN_SOLVERS, metavar='METHOD',
+                        help="не отдавать одну позицию программы учета нескольким товарам сайта: "
+                             "greedy - жадно по убыванию схожести, hungarian - максимум суммарной "
+                             "схожести (нужен scipy)")
+    parser.add_argument('--capacity', type=int, default=1, metavar='N',
+                        help="сколько товаров сайта может получить одну позицию при --assign (по умолчанию 1)")
+    parser.add_argument('--assign-candidates', type=int, default=DEFAULT_ASSIGN_CANDIDATES, metavar='C',
+                        help=f"сколько альтернатив искать товару, потерявшему свой вариант при --assign "
+                             f"(по умолчанию {DEFAULT_ASSIGN_CANDIDATES})")
+    parser.add_argument('--report', metavar='FILE',
+                        help="сохранить отчет о запуске по этапам (.json или .csv)")
+    parser.add_argument('--report-sample', type=int, default=200, metavar='N',
+                        help="замерить время отдельных товаров на выборке из N для отчета (по умолчанию 200)")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="профилировать запуск через cProfile и сохранить статистику в FILE")
+    return parser.parse_args(argv)
+
+
+def engine_options(args):
+    """Настройки алгоритма поиска для отпечатка запуска и памяти результатов"""
+    if args.engine == 'tfidf':
+        return {'engine': 'tfidf', 'tfidf_candidates': args.tfidf_candidates, 'rescore': not args.no_rescore}
+    return {'engine': 'wratio'}
+
+
+def state_options(args):
+    """Настройки поиска для файла состояния: состояние, сохраненное с другими, для --incremental не подходит"""
+    return {'blocking': args.blocking, 'max_candidates': args.max_candidates if args.blocking else None,
+            'top_k': args.top_k, 'prefilter': args.prefilter if args.top_k > 1 else None,
+            'fast_path': not args.no_fast_path, **engine_options(args)}
+
+
+def make_index(args, choices, cache_key, report):
+    """Индекс отбора кандидатов: TF-IDF, индекс --blocking или None для полного перебора"""
+    if args.engine == 'tfidf':
+        print("Строю TF-IDF матрицу программы учета...")
+        with report.stage('index'):
+            return TfidfIndex(choices, args.tfidf_candidates, rescore=not args.no_rescore)
+    if args.blocking and args.top_k <= 1:
+        print("Строю индекс кандидатов...")
+        with report.stage('index'):
+            return load_candidate_index(cache_key, choices, args.max_candidates, args.cache_dir)
+    return None
+
+
+def open_memo(args, erp_file, erp_key, threshold):
+    """Память результатов: только на время запуска или в SQLite с --memo"""
+    path = None
+    if args.memo is not None:
+        path = args.memo or os.path.join(args.cache_dir, MEMO_FILE)
+        erp_key = erp_key or catalog_key(erp_file)
+    if args.engine == 'tfidf':
+        scorer = f"tfidf{args.tfidf_candidates}/" + ("cosine" if args.no_rescore else "WRatio")
+    else:
+        scorer = f"WRatio/blocking{args.max_candidates}" if args.blocking else "WRatio"
+    return MatchMemo(erp_key, scorer, threshold, path)
+
+
+def report_memo(memo, report):
+    if memo.loaded:
+        print(f"Из памяти прошлых запусков: {memo.loaded} названий")
+    print(f"Посчитано названий: {memo.scored}, взято готовых результатов: {memo.reused}")
+    report.count('memo_scored', memo.scored)
+    report.count('memo_reused', memo.reused)
+
+
+def setup_fast_path(choices, df_erp, site_columns):
+    """ExactMatcher для быстрого прохода и пары колонок ключей (сайт, программа учета)"""
+    exact, key_pairs = build_exact_matcher(choices, df_erp, site_columns)
+    if key_pairs:
+        print("Ключи для быстрого поиска: " + ", ".join(f"'{site_col}' = '{erp_col}'"
+                                                       for site_col, erp_col in key_pairs))
+    return exact, key_pairs
+
+
+def report_fast_path(tier_counts, report):
+    print(f"Найдено {format_tier_counts(tier_counts)}")
+    report.count('tier_key', tier_counts.get(TIER_KEY, 0))
+    report.count('tier_exact', tier_counts.get(TIER_EXACT, 0))
+    report.count('tier_fuzzy', tier_counts.get(TIER_FUZZY, 0))
+
+
+def match_sharded(args, fingerprint, df_site, site_clean, df_erp, choices, threshold, key_pairs):
+    """Сопоставление по шардам: подготовка общего каталога, локальные процессы,
+    ожидание удаленных воркеров и объединение результатов по порядку шардов"""
+    shard_dir = args.shard_dir or shard_dir_for(args.output)
+    shards = prepare_shards(
+        shard_dir, fingerprint, args.shards, site_clean,
+        [df_site[site_col].tolist() for site_col, _ in key_pairs], choices,
+        [df_erp[erp_col].tolist() for _, erp_col in key_pairs], threshold,
+        {'blocking': args.blocking and args.top_k <= 1, 'max_candidates': args.max_candidates,
+         'top_k': args.top_k, 'prefilter': args.prefilter, 'fast_path': not args.no_fast_path and args.top_k <= 1,
+         **engine_options(args)}
+    )
+    print(f"Каталог шардов: {shard_dir} ({shards} шт.)")
+    if args.workers <= 0:
+        print(f"Запустите воркеры: python product_matcher_cli.py --shard-worker {shard_dir}")
+    run_sharded(shard_dir, shards, args.workers, args.shard_stale)
+    
+    match_indices, scores, tier_counts, tiers = merge_shards(shard_dir, shards)
+    cleanup_shards(shard_dir)
+    return match_indices, scores, tier_counts, tiers
+
+
+def write_sweep(store, path):
+    """Таблица подбора порога в файл и на экран"""
+    sweep = threshold_sweep(store)
+    write_table(sweep, path)
+    print("\nПодбор порога:")
+    print(sweep.to_string(index=False))
+    print(f"Таблица подбора порога сохранена в файл: {path}")
+
+
+def run_rethreshold(args, report):
+    """Пересборка результата с новым порогом из файла оценок прошлого запуска"""
+    path = args.scores or score_store_path(args.output)
+    try:
+        file_format(args.output)
+        with report.stage('load_scores'):
+            store = load_score_store(path)
+        with report.stage('build_results'):
+            results = store_results(store, args.rethreshold)
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return
+    report.params.update(scores=path, threshold=args.rethreshold)
+    report.count('site_rows', len(store['site_ids']))
+    report.count('matched', len(results))
+    with report.stage('write', rows=len(results)):
+        write_table(results, args.output)
+    print(f"Порог {args.rethreshold}%: найдено {len(results)} совпадений из {len(store['site_ids'])} товаров")
+    print(f"Результат сохранен в файл: {args.output}")
+    if args.sweep:
+        write_sweep(store, args.sweep)
+
+
+def match_streaming(site_file, df_erp, erp_id_col, erp_name_col, threshold, index, output_file, chunk_rows,
+                    report, top_k=1, prefilter='ratio', fast_path=True, memo=None):
+    """Потоковое сопоставление: файл сайта читается, а результат пишется порциями"""
+    choices = shared_strings(df_erp['clean'])
+    
+    site_id_col = site_name_col = None
+    exact = None
+    key_pairs = []
+    total = 0
+    matched_count = 0
+    examples = []
+    
+    print(f"Начинаю потоковое сопоставление с порогом {threshold}%...")
+    
+    columns = RESULT_COLUMNS + (top_k_columns(top_k) if top_k > 1 else [])
+    with ResultWriter(output_file, columns) as writer:
+        chunks = iter_catalog_chunks(site_file, chunk_rows)
+        while True:
+            with report.stage('load_site'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            
+            if site_id_col is None:
+                with report.stage('detect_columns'):
+                    site_id_col, site_name_col = detect_columns(chunk, "сайта")
+                if fast_path and top_k <= 1:
+                    exact, key_pairs = setup_fast_path(choices, df_erp, chunk.columns)
+            
+            with report.stage('normalize', rows=len(chunk)):
+                queries = shared_strings(clean_series(chunk[site_name_col]))
+            parts = []
+            with report.stage('score', rows=len(chunk)):
+                for start, match_indices, scores in match_chunks(queries, choices, threshold, index, top_k, prefilter,
+                                                                 exact=exact,
+                                                                 site_key_values=[chunk[col] for col, _ in key_pairs],
+                                                                 memo=memo):
+                    report.record_scores(match_indices, scores)
+                    end = start + len(match_indices)
+                    parts.append(build_results(chunk[site_id_col].iloc[start:end], chunk[site_name_col].iloc[start:end],
+                                               df_erp[erp_id_col], df_erp[erp_name_col], match_indices, scores))
+            results = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+            with report.stage('write', rows=len(results)):
+                writer.write(results)
+            
+            total += len(chunk)
+            matched_count += len(results)
+            examples.extend(results.head(5 - len(examples)).to_dict('records'))
+            print(f"Обработано {total} товаров, найдено {matched_count} совпадений...")
+    
+    report.count('site_rows', total)
+    report.count('matched', matched_count)
+    if exact is not None:
+        report_fast_path(exact.tier_counts, report)
+    if memo is not None:
+        report_memo(memo, report)
+    print(f"\nГотово! Найдено {matched_count} совпадений из {total} товаров")
+    print(f"Результат сохранен в файл: {output_file}")
+    
+    if examples:
+        print("\nПримеры найденных совпадений:")
+        for i, result in enumerate(examples):
+            print(f"{i+1}. {result['наименование сайт']} -> {result['наименование программа']} ({result['схожесть %']}%)")
+
+
 def main():
     print("=== Программа сопоставления товаров ===\n")
     
+    args = parse_args()
+    report = RunReport()
+    
+    with profiled(args.profile):
+        run_matching(args, report)
+    
+    if args.report:
+        report.write(args.report)
+        print("\nЭтапы запуска:")
+        print(report.summary())
+        print(f"Отчет о запуске сохранен в файл: {args.report}")
+
+
+def run_matching(args, report):
+    """Сопоставление по аргументам командной строки с замерами этапов в report"""
+    def detect(df, file_type):
+        with report.stage('detect_columns'):
+            return detect_columns(df, file_type)
+    
+    if args.shard_worker:
+        if not os.path.isdir(args.shard_worker):
+            print(f"Ошибка: Каталог шардов {args.shard_worker} не найден")
+            return
+        wait_for_plan(args.shard_worker)
+        done = run_worker(args.shard_worker, stale_after=args.shard_stale)
+        print(f"Обработано шардов: {done}")
+        return
+    
+    if args.rethreshold is not None:
+        run_rethreshold(args, report)
+        return
+    
     # Ввод путей к файлам
-    if len(sys.argv) >= 3:
-        site_file = sys.argv[1]
-        erp_file = sys.argv[2]
-        threshold = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+    if args.site_file and args.erp_file:
+        site_file = args.site_file
+        erp_file = args.erp_file
+        threshold = args.threshold
     else:
         site_file = input("Введите путь к файлу каталога сайта: ").strip()
         erp_file = input("Введите путь к файлу программы учета: ").strip()
         threshold = int(input("Введите минимальный порог схожести (30-95, по умолчанию 60): ") or "60")
+    # Сравнение идет с порогом score_floor, результат затем отбирается по threshold
+    score_floor = min(args.score_floor, threshold) if args.score_floor is not None else threshold
     
     # Проверка существования файлов
     if not os.path.exists(site_file):
@@ -75,73 +388,255 @@ def main():
         print(f"Ошибка: Файл {erp_file} не найден")
         return
     
+    # Формат результата проверяем до сопоставления, а не при записи
+    try:
+        file_format(args.output)
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return
+    
+    report.params.update(site_file=site_file, erp_file=erp_file, threshold=threshold, score_floor=score_floor,
+                         blocking=args.blocking, top_k=args.top_k, stream=args.stream,
+                         incremental=args.incremental, **engine_options(args))
+    
     try:
         print("\nЗагружаю файлы...")
         
         # Загрузка файлов
-        df_site = pd.read_excel(site_file)
-        df_erp = pd.read_excel(erp_file)
+        with report.stage('load_erp'):
+            df_erp, erp_id_col, erp_name_col, cache_key, from_cache = load_erp_catalog(
+                erp_file,
+                lambda df: detect(df, "программы учета"),
+                cache_dir=args.cache_dir,
+                use_cache=not args.no_cache,
+                columnar_cache=args.columnar_cache
+            )
+        report.count('erp_rows', len(df_erp))
+        print(f"Загружен файл программы учета: {len(df_erp)} товаров" + (" (из кэша)" if from_cache else ""))
+        if from_cache:
+            print(f"Файл программы учета: ID = '{erp_id_col}', Название = '{erp_name_col}'")
         
-        print(f"Загружен файл сайта: {len(df_site)} товаров")
-        print(f"Загружен файл программы учета: {len(df_erp)} товаров")
+        if args.stream:
+            if args.shards:
+                print("Режим --stream не поддерживает --shards, сопоставляю в одном процессе")
+            if args.score_floor is not None or args.sweep:
+                print("Режим --stream не сохраняет файл оценок, --score-floor и --sweep не используются")
+            if args.assign:
+                print("Режим --stream не поддерживает --assign: назначение требует всех товаров сразу")
+            index = make_index(args, shared_strings(df_erp['clean']), cache_key, report)
+            memo = open_memo(args, erp_file, cache_key, threshold) if args.top_k <= 1 else None
+            stream_file = site_file
+            if args.columnar_cache and file_format(site_file) == 'excel':
+                # Готовая колоночная копия читается порциями быстрее Excel
+                copy_path = columnar_copy_path(site_file, args.cache_dir)
+                if os.path.isfile(copy_path):
+                    stream_file = copy_path
+            try:
+                match_streaming(stream_file, df_erp, erp_id_col, erp_name_col, threshold, index,
+                                args.output, args.chunk_rows, report, args.top_k, args.prefilter,
+                                not args.no_fast_path, memo)
+            finally:
+                if memo is not None:
+                    memo.close()
+            return
         
-        # Определяем колонки автоматически
-        site_id_col, site_name_col = detect_columns(df_site, "сайта")
-        erp_id_col, erp_name_col = detect_columns(df_erp, "программы учета")
+        # Колонки определяются по заголовку, остальные колонки файла не читаются
+        with report.stage('load_site'):
+            df_site, site_id_col, site_name_col = load_catalog(
+                site_file, lambda df: detect(df, "сайта"), args.cache_dir if args.columnar_cache else None)
+        print(f"Загружен файл сайта: {len(df_site)} товаров")
+        report.count('site_rows', len(df_site))
         
         # Подготовка данных
         print("\nПодготавливаю данные для сопоставления...")
-        df_site['clean'] = df_site[site_name_col].apply(clean_name)
-        df_erp['clean'] = df_erp[erp_name_col].apply(clean_name)
+        with report.stage('normalize', rows=len(df_site)):
+            site_clean = shared_strings(clean_series(df_site[site_name_col]))
         
-        choices = df_erp['clean'].tolist()
-        results = []
+        choices = shared_strings(df_erp['clean'])
         
-        print(f"Начинаю сопоставление с порогом {threshold}%...")
+        if args.blocking and args.top_k > 1 and args.engine != 'tfidf':
+            print("В режиме --top-k быстрый режим не используется: кандидатов отбирает первый проход")
+        index = make_index(args, choices, cache_key, report)
+        if args.recall_check and index is not None and args.top_k <= 1:
+            with report.stage('recall_check', rows=args.recall_check):
+                check = recall_check(site_clean, choices, index, threshold, args.recall_check)
+            print(format_recall_check(check))
         
-        # Процесс сопоставления
         total = len(df_site)
-        matched_count = 0
+        output_file = args.output
+        
+        state = None
+        if args.incremental and args.shards:
+            print("Режим --incremental не поддерживает --shards, сопоставляю в одном процессе")
+        if args.incremental and args.top_k > 1:
+            print("Режим --incremental не поддерживает --top-k, выполняю полное сопоставление")
+        elif args.incremental:
+            state = load_state(state_path(output_file), score_floor, CLEAN_NAME_VERSION, state_options(args))
+            if state is None:
+                print("Нет совместимого состояния прошлого запуска, выполняю полное сопоставление")
+        
+        incremental = None
+        exact = None
+        key_pairs = []
+        # Способы, которыми найдены товары: по ним отмечаются совпадения по ключам
+        tiers = None
+        if not args.no_fast_path and args.top_k <= 1:
+            exact, key_pairs = setup_fast_path(choices, df_erp, df_site.columns)
+        if state is not None:
+            print("Ищу изменения с прошлого запуска...")
+            with report.stage('score', rows=total):
+                # Совпадения по ключам берутся из текущих файлов, как при полном запуске
+                key_matches = None
+                if key_pairs:
+                    key_idx, key_scores, tiers = exact.resolve(site_clean, [df_site[col] for col, _ in key_pairs])
+                    key_matches = (key_idx, key_scores, tiers == TIER_KEY)
+                incremental = incremental_match(state, df_site[site_id_col].tolist(), site_clean,
+                                                df_erp[erp_id_col].tolist(), choices, score_floor, index,
+                                                key_matches)
+            if incremental is None:
+                print("ID в файлах не уникальны, выполняю полное сопоставление")
         
-        for idx, row in df_site.iterrows():
-            if idx % 500 == 0:  # Обновляем прогресс каждые 500 товаров
-                print(f"Обработано {idx}/{total} товаров...")
+        if incremental is not None:
+            match_indices, scores, stats = incremental
+            print(f"Сайт: добавлено {stats['site_added']}, удалено {stats['site_removed']}, "
+                  f"изменено {stats['site_renamed']}")
+            print(f"Программа учета: добавлено {stats['erp_added']}, удалено {stats['erp_removed']}, "
+                  f"изменено {stats['erp_renamed']}")
+            print(f"Полностью пересчитано {stats['full_rows']} товаров, "
+                  f"сравнено с новыми позициями {stats['partial_rows']}, "
+                  f"найдено по артикулу/штрихкоду {stats['key_rows']}")
+        else:
+            fingerprint = run_fingerprint(site_file, erp_file, score_floor,
+                                          blocking=args.blocking, max_candidates=args.max_candidates,
+                                          top_k=args.top_k, prefilter=args.prefilter, fast_path=exact is not None,
+                                          **engine_options(args))
+        
+        # С --incremental шарды не используются, даже если состояния еще нет
+        if incremental is None and args.shards and not args.incremental:
+            print(f"Начинаю сопоставление по шардам с порогом {threshold}%...")
+            with report.stage('score', rows=total):
+                match_indices, scores, tier_counts, tiers = match_sharded(args, fingerprint, df_site, site_clean,
+                                                                          df_erp, choices, score_floor, key_pairs)
+            if tier_counts:
+                report_fast_path(tier_counts, report)
+        elif incremental is None:
+            memo = open_memo(args, erp_file, cache_key, score_floor) if args.top_k <= 1 else None
+            checkpoint = Checkpoint(checkpoint_path(output_file), fingerprint, interval=args.checkpoint_every)
             
-            extract = process.extractOne(
-                row['clean'],
-                choices,
-                scorer=fuzz.WRatio
-            )
+            resumed = checkpoint.load(total) if args.resume else None
+            if resumed is not None:
+                match_indices, scores, next_index = resumed
+                print(f"Продолжаю с контрольной точки: уже обработано {next_index}/{total} товаров")
+            else:
+                if args.resume:
+                    print("Подходящая контрольная точка не найдена, начинаю сначала")
+                shape = (total, args.top_k) if args.top_k > 1 else total
+                match_indices = np.full(shape, -1, dtype=np.int64)
+                scores = np.zeros(shape, dtype=np.float64)
+                next_index = 0
             
-            if extract and extract[1] >= threshold:
-                match_text, score, match_idx = extract
-                matched_row = df_erp.iloc[match_idx]
-                
-                results.append({
-                    'id сайт': row[site_id_col],
-                    'наименование сайт': row[site_name_col],
-                    'id программа': matched_row[erp_id_col],
-                    'наименование программа': matched_row[erp_name_col],
-                    'схожесть %': round(score, 1)
-                })
-                matched_count += 1
+            print(f"Начинаю сопоставление с порогом {threshold}%...")
+            
+            # Процесс сопоставления
+            try:
+                with report.stage('score', rows=total - next_index):
+                    for start, chunk_indices, chunk_scores in match_chunks(
+                            site_clean, choices, score_floor, index, args.top_k, args.prefilter, next_index,
+                            exact=exact, site_key_values=[df_site[col] for col, _ in key_pairs], memo=memo):
+                        next_index = start + len(chunk_indices)
+                        match_indices[start:next_index] = chunk_indices
+                        scores[start:next_index] = chunk_scores
+                        print(f"Обработано {next_index}/{total} товаров...")
+                        checkpoint.maybe_save(match_indices, scores, next_index)
+            except KeyboardInterrupt:
+                checkpoint.save(match_indices, scores, next_index)
+                print(f"\nПрервано на {next_index}/{total}. Для продолжения запустите с параметром --resume")
+                return
+            finally:
+                if memo is not None:
+                    memo.close()
+            checkpoint.remove()
+            if exact is not None:
+                tiers = exact.tiers
+                report_fast_path(exact.tier_counts, report)
+            if memo is not None:
+                report_memo(memo, report)
+        
+        # Файл оценок: результат с другим порогом собирается из него без пересчета
+        pinned = None
+        if exact is not None:
+            pinned = exact.key_matched(site_clean, [df_site[col] for col, _ in key_pairs], tiers)
+        with report.stage('save_scores'):
+            store = make_score_store(df_site[site_id_col], df_site[site_name_col], df_erp[erp_id_col],
+                                     df_erp[erp_name_col], match_indices, scores, score_floor, pinned)
+            save_score_store(args.scores or score_store_path(output_file), store)
+        result_indices, result_scores = apply_threshold(match_indices, scores, threshold, pinned)
+        if args.assign and args.top_k > 1:
+            print("Режим --top-k не поддерживает --assign, назначение не выполняется")
+        elif args.assign:
+            with report.stage('assign', rows=total):
+                assigned, assigned_scores, stats = assign(site_clean, choices, result_indices, result_scores,
+                                                          threshold, args.assign, args.capacity,
+                                                          args.assign_candidates, pinned, index)
+                df_assign = assignment_report(df_site[site_id_col].tolist(), df_site[site_name_col].tolist(),
+                                              df_erp[erp_id_col].tolist(), df_erp[erp_name_col].tolist(),
+                                              result_indices, result_scores, assigned, assigned_scores)
+                write_table(df_assign, assignment_path(output_file))
+            report.count('assign_changed', stats['changed'])
+            print(f"Назначение ({args.assign}, не больше {args.capacity} на позицию): позиций с конфликтом "
+                  f"{stats['conflicts']}, изменено {stats['changed']}, осталось без пары {stats['unassigned']}")
+            if stats['greedy_components']:
+                print(f"Слишком больших групп для венгерского метода: {stats['greedy_components']}, "
+                      f"для них использован жадный")
+            print(f"Отчет о назначении: {assignment_path(output_file)}")
+            result_indices, result_scores = assigned, assigned_scores
+        
+        report.record_scores(result_indices, result_scores)
+        if args.report and args.report_sample:
+            sample_query_times(report, site_clean, choices, score_floor, index, args.report_sample)
+        
+        with report.stage('build_results', rows=total):
+            results = build_results(df_site[site_id_col], df_site[site_name_col], df_erp[erp_id_col],
+                                    df_erp[erp_name_col], result_indices, result_scores)
+        matched_count = len(results)
+        report.count('matched', matched_count)
+        
+        # Дальше (состояние, отчет об изменениях) нужен только лучший вариант
+        if match_indices.ndim > 1:
+            match_indices, scores = match_indices[:, 0], scores[:, 0]
+        
+        if incremental is not None:
+            with report.stage('change_report'):
+                df_changes = change_report(state, df_site[site_id_col].tolist(), df_site[site_name_col].tolist(),
+                                           site_clean, df_erp[erp_id_col].tolist(), df_erp[erp_name_col].tolist(),
+                                           match_indices, scores)
+                write_table(df_changes, changes_path(output_file))
+            print(f"Изменений в совпадениях: {len(df_changes)}, отчет: {changes_path(output_file)}")
+        
+        with report.stage('save_state'):
+            save_state(state_path(output_file), df_site[site_id_col].tolist(), site_clean,
+                       df_erp[erp_id_col].tolist(), choices, match_indices, scores, score_floor, CLEAN_NAME_VERSION,
+                       pinned, state_options(args))
         
         # Сохранение результата
-        if results:
-            output_file = "результат_сопоставления.xlsx"
-            df_final = pd.DataFrame(results)
-            df_final.to_excel(output_file, index=False)
+        if len(results):
+            with report.stage('write', rows=len(results)):
+                write_table(results, output_file)
             
             print(f"\nГотово! Найдено {matched_count} совпадений из {total} товаров")
             print(f"Результат сохранен в файл: {output_file}")
+            print(f"Для смены порога без пересчета: --rethreshold N (оценки от {score_floor}%)")
             
             # Показываем несколько примеров
             print("\nПримеры найденных совпадений:")
-            for i, result in enumerate(results[:5]):
+            for i, result in enumerate(results.head(5).to_dict('records')):
                 print(f"{i+1}. {result['наименование сайт']} -> {result['наименование программа']} ({result['схожесть %']}%)")
                 
         else:
             print("Совпадений не найдено. Попробуйте снизить порог схожести.")
+        
+        if args.sweep:
+            write_sweep(store, args.sweep)
             
     except Exception as e:
         print(f"Ошибка: {str(e)}")
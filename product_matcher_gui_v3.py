@@ -1,18 +1,106 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import pandas as pd
-from rapidfuzz import process, fuzz
-from anyascii import anyascii
-import re
+from concurrent.futures import Future
 import os
+import queue
+import threading
 import time
 
+OUTPUT_FILE = "результат_сопоставления.xlsx"
+INPUT_FILETYPES = [("Каталоги", "*.xlsx *.xls *.csv *.parquet *.feather"), ("Excel files", "*.xlsx *.xls"),
+                   ("All files", "*.*")]
+# Интервал сохранения контрольной точки, секунд
+CHECKPOINT_INTERVAL = 30
+# Нижняя граница ползунка порога: от нее сохраняются оценки для смены порога
+MIN_THRESHOLD = 30
+
+def load_backend():
+    """Импорт модулей сопоставления (numpy, pandas, rapidfuzz, anyascii). Окно открывается
+    без них, импорт идет в фоне; методы импортируют модули по месту и получают уже загруженные"""
+    import numpy  # noqa: F401
+    import assignment  # noqa: F401
+    import candidate_index  # noqa: F401
+    import catalog_io  # noqa: F401
+    import checkpoint  # noqa: F401
+    import erp_cache  # noqa: F401
+    import exact_match  # noqa: F401
+    import matching_engine  # noqa: F401
+    import normalizer  # noqa: F401
+    import product_matcher_cli  # noqa: F401
+    import score_store  # noqa: F401
+    import tfidf_index  # noqa: F401
+
+
+def run_in_background(func, *args):
+    """Вызов func в фоновом потоке; результат или исключение - в возвращаемом Future.
+    Поток демонический: закрытие окна не ждет загрузки"""
+    future = Future()
+    
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def prepare_site(path, columnar_cache):
+    """Загрузка и нормализация каталога сайта (в фоновом потоке)"""
+    import catalog_io
+    import erp_cache
+    import normalizer
+    from product_matcher_cli import detect_columns
+    df_site, id_col, name_col = catalog_io.load_catalog(
+        path, lambda df: detect_columns(df, "сайта"), erp_cache.DEFAULT_CACHE_DIR if columnar_cache else None)
+    return df_site, id_col, name_col, catalog_io.shared_strings(normalizer.clean_series(df_site[name_col]))
+
+
+def prepare_erp(path, use_cache, columnar_cache):
+    """Загрузка каталога программы учета: из кэша или с нормализацией (в фоновом потоке)"""
+    import catalog_io
+    import erp_cache
+    from product_matcher_cli import detect_columns
+    df_erp, id_col, name_col, cache_key, from_cache = erp_cache.load_erp_catalog(
+        path, lambda df: detect_columns(df, "программы учета"), use_cache=use_cache, columnar_cache=columnar_cache)
+    return df_erp, id_col, name_col, cache_key, from_cache, catalog_io.shared_strings(df_erp['clean'])
+
+
+def prepare_index(erp_future, options):
+    """Индекс отбора кандидатов по подготовленному каталогу программы учета (в фоновом потоке);
+    None без options - полный перебор"""
+    if not options:
+        return None
+    _, _, _, cache_key, _, choices = erp_future.result()
+    if options['engine'] == 'tfidf':
+        import tfidf_index
+        return tfidf_index.TfidfIndex(choices, options['tfidf_candidates'], rescore=options['rescore'])
+    import erp_cache
+    return erp_cache.load_candidate_index(cache_key, choices, options['max_candidates'])
+
+
+def prepare_matching(site_future, erp_future, index_future, recall_floor=None, fast_path=False):
+    """Все, что нужно до первой порции (в фоновом потоке): оба файла, индекс, проверка
+    полноты индекса с порогом recall_floor и таблицы быстрого прохода"""
+    import candidate_index
+    import exact_match
+    site = site_future.result()
+    erp = erp_future.result()
+    index = index_future.result()
+    check = None
+    if index is not None and recall_floor is not None:
+        check = candidate_index.recall_check(site[3], erp[5], index, recall_floor)
+    exact = exact_match.build_exact_matcher(erp[5], erp[0], site[0].columns) if fast_path else (None, [])
+    return site, erp, index, check, exact
+
 
 class ProductMatcherGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Сопоставление товаров")
-        self.root.geometry("600x600")
+        self.root.geometry("600x920")
         
         # Переменные для хранения путей к файлам
         self.site_file_path = tk.StringVar()
@@ -24,15 +112,33 @@ class ProductMatcherGUI:
         self.df_site = None
         self.df_erp = None
         self.choices = None
-        self.results = []
+        self.site_clean = None
+        self.batches = None
+        self.worker = None
+        self.worker_queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.checkpoint = None
+        self.match_indices = None
+        self.scores = None
+        self.results = None
         self.matched_count = 0
         self.site_id_col = None
         self.site_name_col = None
         self.erp_id_col = None
         self.erp_name_col = None
         self.threshold = 60
+        self.top_k = 1
+        self.recall_info = ""
+        self.assign_info = ""
+        self.index = None
+        self.exact = None
+        self.output_file = OUTPUT_FILE
+        # Фоновая подготовка файлов: вид -> (ключ файла и настроек, Future)
+        self.prefetched = {}
         
         self.create_widgets()
+        self.backend = run_in_background(load_backend)
+        self.root.after(100, self.poll_backend)
         
     def create_widgets(self):
         # Заголовок
@@ -70,10 +176,88 @@ class ProductMatcherGUI:
         
         tk.Label(threshold_frame, text="Минимальный порог схожести (%):", width=30, anchor="w").pack(side="left")
         self.threshold_var = tk.IntVar(value=60)
-        threshold_scale = tk.Scale(threshold_frame, from_=30, to=95, orient="horizontal", 
+        threshold_scale = tk.Scale(threshold_frame, from_=MIN_THRESHOLD, to=95, orient="horizontal", 
                                  variable=self.threshold_var, length=200)
         threshold_scale.pack(side="left", padx=5)
         
+        # Быстрый режим: сравнение только с кандидатами из индекса
+        blocking_frame = tk.Frame(settings_frame)
+        blocking_frame.pack(fill="x", pady=5)
+        
+        self.blocking_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(blocking_frame, text="Быстрый режим (индекс кандидатов)",
+                       variable=self.blocking_var).pack(side="left")
+        tk.Label(blocking_frame, text="Кандидатов:").pack(side="left", padx=(10, 0))
+        self.max_candidates_var = tk.IntVar(value=200)
+        tk.Spinbox(blocking_frame, from_=10, to=5000, increment=10, width=6,
+                   textvariable=self.max_candidates_var).pack(side="left", padx=5)
+        
+        # Алгоритм поиска: WRatio или отбор кандидатов по TF-IDF (нужен scipy)
+        engine_frame = tk.Frame(settings_frame)
+        engine_frame.pack(fill="x", pady=5)
+        
+        tk.Label(engine_frame, text="Алгоритм:").pack(side="left")
+        self.engine_var = tk.StringVar(value='wratio')
+        ttk.Combobox(engine_frame, textvariable=self.engine_var, values=['wratio', 'tfidf'],
+                     state="readonly", width=8).pack(side="left", padx=5)
+        tk.Label(engine_frame, text="Кандидатов TF-IDF:").pack(side="left", padx=(10, 0))
+        # Значение по умолчанию и списки вариантов заполняются после фонового импорта
+        self.tfidf_candidates_var = tk.IntVar()
+        tk.Spinbox(engine_frame, from_=1, to=500, width=5,
+                   textvariable=self.tfidf_candidates_var).pack(side="left", padx=5)
+        self.rescore_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(engine_frame, text="Пересчитать через WRatio",
+                       variable=self.rescore_var).pack(side="left", padx=5)
+        
+        self.recall_check_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(settings_frame, text="Проверить полноту быстрого режима на выборке",
+                       variable=self.recall_check_var).pack(anchor="w")
+        
+        # Несколько вариантов на товар с повторной оценкой
+        top_k_frame = tk.Frame(settings_frame)
+        top_k_frame.pack(fill="x", pady=5)
+        
+        tk.Label(top_k_frame, text="Вариантов на товар:").pack(side="left")
+        self.top_k_var = tk.IntVar(value=1)
+        tk.Spinbox(top_k_frame, from_=1, to=10, width=4, textvariable=self.top_k_var).pack(side="left", padx=5)
+        tk.Label(top_k_frame, text="Первый проход:").pack(side="left", padx=(10, 0))
+        self.prefilter_var = tk.StringVar(value='ratio')
+        self.prefilter_box = ttk.Combobox(top_k_frame, textvariable=self.prefilter_var, values=['ratio'],
+                                          state="readonly", width=10)
+        self.prefilter_box.pack(side="left", padx=5)
+        
+        self.fast_path_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(settings_frame, text="Сначала искать по артикулу/штрихкоду и точному названию",
+                       variable=self.fast_path_var).pack(anchor="w")
+        
+        self.use_cache_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(settings_frame, text="Кэшировать подготовленный файл программы учета",
+                       variable=self.use_cache_var).pack(anchor="w")
+        
+        self.columnar_cache_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(settings_frame, text="Сохранять копию Excel-файлов в Parquet для быстрой загрузки",
+                       variable=self.columnar_cache_var).pack(anchor="w")
+        
+        self.score_floor_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(settings_frame, text=f"Сохранять оценки от {MIN_THRESHOLD}%, чтобы снижать порог без пересчета",
+                       variable=self.score_floor_var).pack(anchor="w")
+        
+        self.assign_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(settings_frame, text="Не отдавать одну позицию программы учета нескольким товарам сайта",
+                       variable=self.assign_var).pack(anchor="w")
+        
+        # Формат файла результата
+        output_frame = tk.Frame(settings_frame)
+        output_frame.pack(fill="x", pady=5)
+        
+        tk.Label(output_frame, text="Формат результата:").pack(side="left")
+        self.output_format_var = tk.StringVar(value='xlsx')
+        self.output_format_box = ttk.Combobox(output_frame, textvariable=self.output_format_var, values=['xlsx'],
+                                              state="readonly", width=10)
+        self.output_format_box.pack(side="left", padx=5)
+        tk.Button(output_frame, text="Применить порог к сохраненным оценкам",
+                  command=self.apply_threshold).pack(side="left", padx=5)
+        
         # Кнопки управления
         button_frame = tk.Frame(self.root)
         button_frame.pack(pady=10)
@@ -88,6 +272,11 @@ class ProductMatcherGUI:
                                     font=("Arial", 12, "bold"), height=2, width=15, state="disabled")
         self.stop_button.pack(side="left", padx=5)
         
+        self.continue_button = tk.Button(button_frame, text="Продолжить", 
+                                        command=self.continue_matching, bg="#2196F3", fg="white",
+                                        font=("Arial", 12, "bold"), height=2, width=12)
+        self.continue_button.pack(side="left", padx=5)
+        
         # Прогресс бар
         progress_frame = tk.Frame(self.root)
         progress_frame.pack(fill="x", padx=20, pady=5)
@@ -112,6 +301,22 @@ class ProductMatcherGUI:
         self.status_label = tk.Label(self.status_bar, text="Готов к работе", anchor=tk.W, padx=10, pady=2)
         self.status_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
+    def poll_backend(self):
+        """Заполнение настроек, зависящих от модулей сопоставления, когда они импортированы"""
+        if not self.backend.done():
+            self.root.after(100, self.poll_backend)
+            return
+        if self.backend.exception() is not None:
+            self.update_status_bar(f"Ошибка загрузки модулей: {self.backend.exception()}")
+            return
+        import catalog_io
+        import matching_engine
+        import tfidf_index
+        self.prefilter_box.config(values=sorted(matching_engine.PREFILTER_SCORERS))
+        self.output_format_box.config(values=catalog_io.OUTPUT_FORMATS)
+        if not self.tfidf_candidates_var.get():
+            self.tfidf_candidates_var.set(tfidf_index.DEFAULT_TFIDF_CANDIDATES)
+        
     def log(self, message):
         """Обновляет статус в строке статистики"""
         self.stats_label.config(text=message)
@@ -125,98 +330,194 @@ class ProductMatcherGUI:
     def select_site_file(self):
         filename = filedialog.askopenfilename(
             title="Выберите файл каталога сайта",
-            filetypes=[("Excel files", "*.xlsx *.xls"), ("All files", "*.*")]
+            filetypes=INPUT_FILETYPES
         )
         if filename:
             self.site_file_path.set(filename)
             self.log(f"Выбран файл сайта: {os.path.basename(filename)}")
-            self.update_status_bar(f"Выбран файл сайта: {os.path.basename(filename)}")
+            self.update_status_bar(f"Выбран файл сайта: {os.path.basename(filename)}, подготовка в фоне...")
+            self.prefetch('site')
             
     def select_erp_file(self):
         filename = filedialog.askopenfilename(
             title="Выберите файл программы учета",
-            filetypes=[("Excel files", "*.xlsx *.xls"), ("All files", "*.*")]
+            filetypes=INPUT_FILETYPES
         )
         if filename:
             self.erp_file_path.set(filename)
             self.log(f"Выбран файл программы учета: {os.path.basename(filename)}")
-            self.update_status_bar(f"Выбран файл программы учета: {os.path.basename(filename)}")
+            self.update_status_bar(f"Выбран файл программы учета: {os.path.basename(filename)}, подготовка в фоне...")
+            self.prefetch('erp')
+            if self.backend.done():
+                self.prefetch_index()
             
-    def clean_name(self, name):
-        """Очистка названия товара для сопоставления"""
-        if not isinstance(name, str):
-            return ""
-        # Убираем страны в косых чертах /Беларусь/, /Германия/
-        name = re.sub(r'/[^/]+/', ' ', name)
-        # Транслитерация для сопоставления RU/EN брендов
-        name = anyascii(name)
-        # Оставляем буквы и цифры
-        name = re.sub(r'[^a-zA-Z0-9\s]', ' ', name).lower()
-        return " ".join(name.split())
-        
-    def detect_columns(self, df, file_type):
-        """Автоматическое определение колонок ID и названия"""
-        columns = df.columns.tolist()
-        
-        # Ищем колонку ID
-        id_col = None
-        for col in columns:
-            if any(keyword in col.lower() for keyword in ['id', '_id_', 'код', 'артикул']):
-                id_col = col
-                break
-        
-        # Ищем колонку с названием
-        name_col = None
-        for col in columns:
-            if any(keyword in col.lower() for keyword in ['наименование', 'название', 'товар', 'name']):
-                name_col = col
-                break
+    def prefetch(self, kind):
+        """Future подготовки файла сайта ('site') или программы учета ('erp').
+        Подготовка запускается заново, если файл, его время изменения или настройки кэша другие"""
+        path = (self.site_file_path if kind == 'site' else self.erp_file_path).get()
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        columnar_cache = self.columnar_cache_var.get()
+        key = (path, mtime, columnar_cache) if kind == 'site' else (path, mtime, columnar_cache, self.use_cache_var.get())
+        if kind in self.prefetched and self.prefetched[kind][0] == key:
+            return self.prefetched[kind][1]
+        if kind == 'site':
+            future = run_in_background(prepare_site, path, columnar_cache)
+        else:
+            future = run_in_background(prepare_erp, path, self.use_cache_var.get(), columnar_cache)
+        self.prefetched[kind] = (key, future)
+        self.root.after(200, self.watch_prefetch, kind, future)
+        return future
+        
+    def prefetch_index(self):
+        """Future индекса кандидатов для текущего файла программы учета и настроек поиска.
+        Индекс строится после подготовки файла, заново - если файл или настройки другие"""
+        erp_future = self.prefetch('erp')
+        options = self.index_options()
+        key = (self.prefetched['erp'][0], tuple(sorted(options.items())) if options else None)
+        if 'index' in self.prefetched and self.prefetched['index'][0] == key:
+            return self.prefetched['index'][1]
+        future = run_in_background(prepare_index, erp_future, options)
+        self.prefetched['index'] = (key, future)
+        return future
+        
+    def watch_prefetch(self, kind, future):
+        """Сообщение в статус баре, когда файл подготовлен в фоне"""
+        if not future.done():
+            self.root.after(200, self.watch_prefetch, kind, future)
+            return
+        if self.processing or self.prefetched.get(kind, (None, None))[1] is not future:
+            return
+        name = "сайта" if kind == 'site' else "программы учета"
+        if future.exception() is not None:
+            self.update_status_bar(f"Ошибка подготовки файла {name}: {future.exception()}")
+        else:
+            self.update_status_bar(f"Файл {name} подготовлен: {len(future.result()[0])} товаров")
         
-        # Если не нашли, берем первые две колонки
-        if not id_col:
-            id_col = columns[0]
-        if not name_col:
-            name_col = columns[1] if len(columns) > 1 else columns[0]
-            
-        self.log(f"Файл {file_type}: ID = '{id_col}', Название = '{name_col}'")
-        return id_col, name_col
+    def continue_matching(self):
+        """Продолжение прерванного сопоставления с контрольной точки"""
+        self.start_matching(resume=True)
         
-    def start_matching(self):
-        """Запуск процесса сопоставления"""
+    def start_matching(self, resume=False):
+        """Запуск процесса сопоставления: файлы готовятся в фоне с момента выбора,
+        окно не блокируется, пока подготовка не закончится"""
+        if self.processing:
+            return
         if not self.site_file_path.get() or not self.erp_file_path.get():
             messagebox.showerror("Ошибка", "Пожалуйста, выберите оба файла")
             return
-            
+        
+        self.log("Начинаю загрузку файлов...")
+        self.update_status_bar("Загрузка файлов и подготовка индекса...")
+        self.processing = True
+        self.process_button.config(state="disabled")
+        self.continue_button.config(state="disabled")
+        self.submit_preparation(resume)
+        
+    def submit_preparation(self, resume):
+        """Фоновая подготовка индекса и быстрого прохода по текущим настройкам.
+        Настройки по умолчанию заполняются после импорта модулей, поэтому сначала ждем его"""
+        if not self.backend.done():
+            self.root.after(100, self.submit_preparation, resume)
+            return
+        self.threshold = self.threshold_var.get()
+        # Сравнение идет с порогом score_floor, результат затем отбирается по threshold
+        self.score_floor = min(MIN_THRESHOLD, self.threshold) if self.score_floor_var.get() else self.threshold
+        self.top_k = self.top_k_var.get()
+        recall_floor = self.score_floor if self.recall_check_var.get() and self.top_k == 1 else None
+        job = run_in_background(prepare_matching, self.prefetch('site'), self.prefetch('erp'), self.prefetch_index(),
+                                recall_floor, self.fast_path_var.get() and self.top_k == 1)
+        self.wait_prefetch(job, resume)
+        
+    def wait_prefetch(self, job, resume):
+        """Ожидание фоновой подготовки файлов и индекса без блокировки окна"""
+        if not job.done():
+            self.root.after(100, self.wait_prefetch, job, resume)
+            return
+        self.begin_matching(job, resume)
+        
+    def begin_matching(self, job, resume=False):
+        """Сопоставление подготовленных файлов"""
+        import numpy as np
+        import candidate_index
+        import checkpoint
+        import matching_engine
         try:
-            self.log("Начинаю загрузку файлов...")
-            self.update_status_bar("Загрузка файлов...")
-            self.root.update_idletasks()
-            
-            # Загрузка файлов
-            self.df_site = pd.read_excel(self.site_file_path.get())
-            self.df_erp = pd.read_excel(self.erp_file_path.get())
+            # Ошибка загрузки в фоне поднимается здесь
+            site, erp, index, check, (exact, key_pairs) = job.result()
+            self.df_site, self.site_id_col, self.site_name_col, self.site_clean = site
+            self.df_erp, self.erp_id_col, self.erp_name_col, _, from_cache, self.choices = erp
             
+            self.log(f"Файл сайта: ID = '{self.site_id_col}', Название = '{self.site_name_col}'")
+            self.log(f"Файл программы учета: ID = '{self.erp_id_col}', Название = '{self.erp_name_col}'")
             self.log(f"Загружен файл сайта: {len(self.df_site)} товаров")
-            self.log(f"Загружен файл программы учета: {len(self.df_erp)} товаров")
+            self.log(f"Загружен файл программы учета: {len(self.df_erp)} товаров" + (" (из кэша)" if from_cache else ""))
             self.update_status_bar(f"Загружены файлы: сайт {len(self.df_site)} товаров, программа {len(self.df_erp)} товаров")
             
-            # Определяем колонки автоматически
-            self.site_id_col, self.site_name_col = self.detect_columns(self.df_site, "сайта")
-            self.erp_id_col, self.erp_name_col = self.detect_columns(self.df_erp, "программы учета")
+            self.results = None
+            self.matched_count = 0
+            self.current_index = 0
+            
+            self.output_file = os.path.splitext(OUTPUT_FILE)[0] + "." + self.output_format_var.get()
             
-            # Подготовка данных
-            self.log("Подготавливаю данные для сопоставления...")
-            self.update_status_bar("Подготовка данных для сопоставления...")
-            self.root.update_idletasks()
+            total = len(self.df_site)
+            self.checkpoint = checkpoint.Checkpoint(
+                checkpoint.checkpoint_path(self.output_file),
+                checkpoint.run_fingerprint(self.site_file_path.get(), self.erp_file_path.get(), self.score_floor,
+                                           blocking=self.blocking_var.get(),
+                                           max_candidates=self.max_candidates_var.get(),
+                                           top_k=self.top_k, prefilter=self.prefilter_var.get(),
+                                           fast_path=self.fast_path_var.get() and self.top_k == 1,
+                                           **self.engine_options()),
+                interval=CHECKPOINT_INTERVAL
+            )
+            resumed = self.checkpoint.load(total) if resume else None
+            if resume and resumed is None:
+                self.processing = False
+                self.process_button.config(state="normal")
+                self.continue_button.config(state="normal")
+                self.log("Контрольная точка не найдена")
+                self.update_status_bar("Контрольная точка не найдена")
+                messagebox.showwarning("Внимание", "Контрольная точка для выбранных файлов и настроек не найдена")
+                return
             
-            self.df_site['clean'] = self.df_site[self.site_name_col].apply(self.clean_name)
-            self.df_erp['clean'] = self.df_erp[self.erp_name_col].apply(self.clean_name)
+            if resumed is not None:
+                self.match_indices, self.scores, self.current_index = resumed
+                self.matched_count = self.count_matched(self.match_indices[:self.current_index])
+                self.log(f"Продолжаю с контрольной точки: уже обработано {self.current_index}/{total} товаров")
+            else:
+                shape = (total, self.top_k) if self.top_k > 1 else total
+                self.match_indices = np.full(shape, -1, dtype=np.int64)
+                self.scores = np.zeros(shape, dtype=np.float64)
             
-            self.choices = self.df_erp['clean'].tolist()
-            self.results = []
-            self.matched_count = 0
-            self.current_index = 0
-            self.threshold = self.threshold_var.get()
+            self.recall_info = ""
+            self.assign_info = ""
+            self.exact, self.key_pairs = exact, key_pairs
+            if check is not None:
+                self.recall_info = candidate_index.format_recall_check(check)
+                self.log(self.recall_info)
+            
+            # Небольшие порции: чаще обновляется прогресс и быстрее срабатывает остановка
+            chunk_size = min(1000, matching_engine.auto_chunk_size(len(self.choices)))
+            if self.top_k > 1:
+                self.batches = matching_engine.iter_top_matches(self.site_clean, self.choices, self.top_k,
+                                                                self.score_floor, self.prefilter_var.get(),
+                                                                chunk_size=chunk_size, start_at=self.current_index,
+                                                                index=index)
+            elif self.exact is not None:
+                for site_col, erp_col in self.key_pairs:
+                    self.log(f"Ключ для быстрого поиска: '{site_col}' = '{erp_col}'")
+                self.batches = self.exact.iter_matches(self.site_clean,
+                                                       [self.df_site[site_col] for site_col, _ in self.key_pairs],
+                                                       self.score_floor, chunk_size=chunk_size, index=index,
+                                                       start_at=self.current_index)
+            else:
+                self.batches = matching_engine.iter_best_matches(self.site_clean, self.choices,
+                                                                 self.score_floor, chunk_size=chunk_size, index=index,
+                                                                 start_at=self.current_index)
+            self.index = index
             
             self.log(f"Начинаю сопоставление с порогом {self.threshold}%...")
             self.update_status_bar(f"Начинаю сопоставление с порогом {self.threshold}%...")
@@ -224,102 +525,232 @@ class ProductMatcherGUI:
             # Настройка интерфейса для процесса
             self.processing = True
             self.process_button.config(state="disabled")
+            self.continue_button.config(state="disabled")
             self.stop_button.config(state="normal")
             self.progress['maximum'] = len(self.df_site)
-            self.progress['value'] = 0
+            self.progress['value'] = self.current_index
             
-            # Запуск пошаговой обработки
-            self.process_next_batch()
+            # Запуск сопоставления в фоновом потоке
+            self.stop_event = threading.Event()
+            self.worker_queue = queue.Queue()
+            self.worker = threading.Thread(target=self.matching_worker,
+                                           args=(self.batches, self.stop_event, self.worker_queue),
+                                           daemon=True)
+            self.worker.start()
+            self.root.after(100, self.poll_worker)
             
         except Exception as e:
+            self.processing = False
+            self.process_button.config(state="normal")
+            self.continue_button.config(state="normal")
             self.log(f"Ошибка при загрузке: {str(e)}")
             self.update_status_bar(f"Ошибка: {str(e)}")
             messagebox.showerror("Ошибка", f"Ошибка при загрузке файлов: {str(e)}")
             
-    def process_next_batch(self):
-        """Обрабатывает следующую порцию товаров"""
-        if not self.processing:
-            return
-            
-        batch_size = 5  # Обрабатываем по 5 товаров за раз
-        end_index = min(self.current_index + batch_size, len(self.df_site))
-        
-        # Обрабатываем порцию
-        for idx in range(self.current_index, end_index):
-            row = self.df_site.iloc[idx]
-            
-            extract = process.extractOne(
-                row['clean'],
-                self.choices,
-                scorer=fuzz.WRatio
-            )
+    def index_options(self):
+        """Настройки индекса кандидатов или None для полного перебора"""
+        if self.engine_var.get() == 'tfidf':
+            return self.engine_options()
+        if self.blocking_var.get() and self.top_k_var.get() == 1:
+            return {'engine': 'blocking', 'max_candidates': self.max_candidates_var.get()}
+        return None
+        
+    def engine_options(self):
+        """Настройки алгоритма поиска для отпечатка контрольной точки"""
+        if self.engine_var.get() == 'tfidf':
+            return {'engine': 'tfidf', 'tfidf_candidates': self.tfidf_candidates_var.get(),
+                    'rescore': self.rescore_var.get()}
+        return {'engine': 'wratio'}
+        
+    @staticmethod
+    def count_matched(match_indices):
+        """Число товаров с найденным совпадением (по лучшему варианту)"""
+        best = match_indices[:, 0] if match_indices.ndim > 1 else match_indices
+        return int((best >= 0).sum())
+        
+    def key_matched(self, count):
+        """Маска первых count товаров, найденных по артикулу/штрихкоду, или None"""
+        if self.exact is None:
+            return None
+        # Способы по строкам уже известны из быстрого прохода; заново - только до продолжения
+        tiers = self.exact.tiers[:count] if self.exact.tiers is not None else None
+        return self.exact.key_matched(self.site_clean[:count],
+                                      [self.df_site[site_col].iloc[:count] for site_col, _ in self.key_pairs], tiers)
+        
+    def collect_results(self, count, pinned=None):
+        """Строит таблицу результата для первых count обработанных товаров"""
+        import catalog_io
+        import score_store
+        match_indices, scores = score_store.apply_threshold(self.match_indices[:count], self.scores[:count],
+                                                            self.threshold, pinned)
+        self.results = catalog_io.build_results(
+            self.df_site[self.site_id_col].iloc[:count],
+            self.df_site[self.site_name_col].iloc[:count],
+            self.df_erp[self.erp_id_col],
+            self.df_erp[self.erp_name_col],
+            match_indices,
+            scores
+        )
+        self.matched_count = len(self.results)
+        
+    def assign_results(self, pinned=None):
+        """Назначение один к одному для всех товаров и отчет о перераспределенных.
+        Выполняется в фоновом потоке, окно не трогает: возвращает (таблица результата, итог)"""
+        import assignment
+        import catalog_io
+        import score_store
+        match_indices, scores = score_store.apply_threshold(self.match_indices, self.scores, self.threshold, pinned)
+        assigned, assigned_scores, stats = assignment.assign(self.site_clean, self.choices, match_indices, scores,
+                                                             self.threshold, pinned=pinned, index=self.index)
+        results = catalog_io.build_results(self.df_site[self.site_id_col], self.df_site[self.site_name_col],
+                                           self.df_erp[self.erp_id_col], self.df_erp[self.erp_name_col],
+                                           assigned, assigned_scores)
+        report = assignment.assignment_report(self.df_site[self.site_id_col].tolist(),
+                                              self.df_site[self.site_name_col].tolist(),
+                                              self.df_erp[self.erp_id_col].tolist(),
+                                              self.df_erp[self.erp_name_col].tolist(),
+                                              match_indices, scores, assigned, assigned_scores)
+        catalog_io.write_table(report, assignment.assignment_path(self.output_file))
+        return results, (f"Назначение: изменено {stats['changed']}, осталось без пары {stats['unassigned']}, "
+                         f"отчет: {assignment.assignment_path(self.output_file)}")
+        
+    @staticmethod
+    def matching_worker(batches, stop_event, worker_queue):
+        """Фоновый поток: считает порции и передает их в очередь для интерфейса"""
+        try:
+            for batch in batches:
+                worker_queue.put(('batch', batch))
+                if stop_event.is_set():
+                    break
+            worker_queue.put(('done', None))
+        except Exception as e:
+            worker_queue.put(('error', e))
             
-            if extract and extract[1] >= self.threshold:
-                match_text, score, match_idx = extract
-                matched_row = self.df_erp.iloc[match_idx]
-                
-                self.results.append({
-                    'id сайт': row[self.site_id_col],
-                    'наименование сайт': row[self.site_name_col],
-                    'id программа': matched_row[self.erp_id_col],
-                    'наименование программа': matched_row[self.erp_name_col],
-                    'схожесть %': round(score, 1)
-                })
-                self.matched_count += 1
+    def poll_worker(self):
+        """Забирает готовые порции из очереди фонового потока и обновляет интерфейс"""
+        finished = False
+        error = None
+        while True:
+            try:
+                kind, payload = self.worker_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'batch':
+                start, match_indices, scores = payload
+                end_index = start + len(match_indices)
+                self.match_indices[start:end_index] = match_indices
+                self.scores[start:end_index] = scores
+                self.matched_count += self.count_matched(match_indices)
+                self.current_index = end_index
+            elif kind == 'error':
+                finished, error = True, payload
+            else:
+                finished = True
         
         # Обновляем прогресс
-        self.current_index = end_index
-        progress_percent = (self.current_index / len(self.df_site)) * 100
+        self.checkpoint.maybe_save(self.match_indices, self.scores, self.current_index)
+        total = len(self.df_site)
+        progress_percent = (self.current_index / total) * 100 if total else 100.0
         self.progress['value'] = self.current_index
         self.progress_label.config(text=f"{progress_percent:.1f}%")
         
         # Обновляем статистику и статус бар
-        if self.current_index < len(self.df_site):
-            stats_text = f"Обработано: {self.current_index}/{len(self.df_site)} | Найдено совпадений: {self.matched_count}"
+        if self.current_index < total:
+            stats_text = f"Обработано: {self.current_index}/{total} | Найдено совпадений: {self.matched_count}"
             self.stats_label.config(text=stats_text)
             self.update_status_bar(f"Обработка... {progress_percent:.1f}% | Найдено: {self.matched_count} совпадений")
         else:
-            stats_text = f"Завершено! Обработано: {self.current_index}/{len(self.df_site)} | Найдено совпадений: {self.matched_count}"
+            stats_text = f"Завершено! Обработано: {self.current_index}/{total} | Найдено совпадений: {self.matched_count}"
             self.stats_label.config(text=stats_text)
-            self.update_status_bar(f"Завершено! Найдено {self.matched_count} совпадений из {len(self.df_site)} товаров")
-        
-        # Логируем прогресс каждые 200 товаров
-        if self.current_index % 200 == 0 or self.current_index == len(self.df_site):
-            self.log(f"Обработано {self.current_index}/{len(self.df_site)} товаров ({progress_percent:.1f}%) | Найдено: {self.matched_count}")
+            self.update_status_bar(f"Завершено! Найдено {self.matched_count} совпадений из {total} товаров")
         
-        # Принудительно обновляем интерфейс
-        self.root.update_idletasks()
-        self.root.update()
+        if not finished:
+            self.root.after(100, self.poll_worker)
+            return
         
-        # Проверяем завершение
-        if self.current_index >= len(self.df_site):
-            self.finish_processing()
-        else:
-            # Планируем следующую порцию через 10мс
-            self.root.after(10, self.process_next_batch)
+        if error is not None:
+            self.checkpoint.save(self.match_indices, self.scores, self.current_index)
+            self.log(f"Ошибка при сопоставлении: {str(error)}")
+            self.update_status_bar(f"Ошибка: {str(error)}")
+            messagebox.showerror("Ошибка", f"Ошибка при сопоставлении: {str(error)}")
+        elif self.current_index < total:
+            # Остановлено пользователем: сохраняем место для «Продолжить»
+            self.checkpoint.save(self.match_indices, self.scores, self.current_index)
+            self.log("Процесс остановлен пользователем")
+            self.update_status_bar("Процесс остановлен пользователем")
+        self.finish_processing()
             
     def stop_matching(self):
-        """Остановка процесса сопоставления"""
-        self.processing = False
-        self.log("Процесс остановлен пользователем")
-        self.update_status_bar("Процесс остановлен пользователем")
-        self.finish_processing()
+        """Остановка процесса сопоставления: фоновый поток завершит текущую порцию"""
+        self.stop_event.set()
+        self.stop_button.config(state="disabled")
+        self.log("Останавливаю после текущей порции...")
+        self.update_status_bar("Остановка...")
         
     def finish_processing(self):
         """Завершение процесса обработки"""
+        import score_store
+        self.stop_button.config(state="disabled")
+        
+        if self.checkpoint and self.current_index >= len(self.df_site):
+            self.checkpoint.remove()
+        
+        pinned = self.key_matched(self.current_index)
+        self.collect_results(self.current_index, pinned)
+        
+        if self.current_index >= len(self.df_site):
+            # Файл оценок: порог меняется кнопкой «Применить порог» без пересчета
+            try:
+                store = score_store.make_score_store(
+                    self.df_site[self.site_id_col], self.df_site[self.site_name_col], self.df_erp[self.erp_id_col],
+                    self.df_erp[self.erp_name_col], self.match_indices, self.scores, self.score_floor, pinned)
+                score_store.save_score_store(score_store.score_store_path(self.output_file), store)
+            except Exception as e:
+                self.log(f"Не удалось сохранить файл оценок: {str(e)}")
+            if self.assign_var.get() and self.top_k == 1:
+                self.log("Назначение один к одному...")
+                self.update_status_bar("Назначение один к одному...")
+                self.wait_assignment(run_in_background(self.assign_results, pinned))
+                return
+        self.show_results()
+        
+    def wait_assignment(self, future):
+        """Ожидание фонового назначения без блокировки окна"""
+        if not future.done():
+            self.root.after(100, self.wait_assignment, future)
+            return
+        try:
+            self.results, self.assign_info = future.result()
+            self.matched_count = len(self.results)
+            self.log(self.assign_info)
+        except Exception as e:
+            self.log(f"Ошибка назначения: {str(e)}")
+        self.show_results()
+        
+    def show_results(self):
+        """Сохранение результата и сообщение о завершении"""
+        import catalog_io
         self.processing = False
         self.process_button.config(state="normal")
-        self.stop_button.config(state="disabled")
+        self.continue_button.config(state="normal")
         
-        if self.results:
+        if len(self.results):
             try:
-                output_file = "результат_сопоставления.xlsx"
-                df_final = pd.DataFrame(self.results)
-                df_final.to_excel(output_file, index=False)
+                output_file = self.output_file
+                catalog_io.write_table(self.results, output_file)
                 
                 success_message = (f"Сопоставление завершено!\n"
                                  f"Найдено совпадений: {self.matched_count} из {len(self.df_site)}\n"
                                  f"Результат сохранен в: {output_file}")
+                if self.recall_info:
+                    success_message += f"\n{self.recall_info}"
+                if self.assign_info:
+                    success_message += f"\n{self.assign_info}"
+                if self.exact is not None:
+                    success_message += f"\nНайдено {self.exact.summary()}"
+                    self.log(f"Найдено {self.exact.summary()}")
+                if self.current_index < len(self.df_site):
+                    success_message += "\nДля продолжения с места остановки нажмите «Продолжить»"
                 
                 self.log(f"Готово! Найдено {self.matched_count} совпадений из {len(self.df_site)} товаров")
                 self.log(f"Результат сохранен в файл: {output_file}")
@@ -338,6 +769,37 @@ class ProductMatcherGUI:
             messagebox.showwarning("Внимание", "Совпадений не найдено")
 
 
+    def apply_threshold(self):
+        """Пересборка результата с порогом ползунка из файла оценок последнего запуска"""
+        import catalog_io
+        import score_store
+        if self.processing:
+            return
+        output_file = os.path.splitext(OUTPUT_FILE)[0] + "." + self.output_format_var.get()
+        threshold = self.threshold_var.get()
+        try:
+            store = score_store.load_score_store(score_store.score_store_path(output_file))
+            results = score_store.store_results(store, threshold)
+            catalog_io.write_table(results, output_file)
+            sweep = score_store.threshold_sweep(store)
+            catalog_io.write_table(sweep, score_store.sweep_path(output_file))
+        except Exception as e:
+            self.log(f"Ошибка: {str(e)}")
+            self.update_status_bar(f"Ошибка: {str(e)}")
+            messagebox.showerror("Ошибка", str(e))
+            return
+        
+        total = len(store['site_ids'])
+        self.log(f"Порог {threshold}%: найдено {len(results)} совпадений из {total} товаров")
+        self.update_status_bar(f"Порог {threshold}%: результат сохранен в {output_file}")
+        counts = ", ".join(f"{row['порог %']}%: {row['найдено']}" for row in sweep.to_dict('records'))
+        messagebox.showinfo("Порог применен",
+                            f"Порог {threshold}%: найдено совпадений: {len(results)} из {total}\n"
+                            f"Результат сохранен в: {output_file}\n"
+                            f"Подбор порога сохранен в: {score_store.sweep_path(output_file)}\n"
+                            f"Найдено по порогам: {counts}")
+
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = ProductMatcherGUI(root)
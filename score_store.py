@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Файл оценок запуска: лучшие варианты всех товаров сайта с оценками,
+по которому результат пересобирается с другим порогом без пересчета
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from catalog_io import build_results
+
+SCORE_STORE_VERSION = 1
+# Пороги таблицы подбора: диапазон ползунка порога в GUI
+SWEEP_THRESHOLDS = range(30, 96, 5)
+
+
+def score_store_path(output_file):
+    """Файл оценок рядом с файлом результата"""
+    return os.path.splitext(output_file)[0] + ".scores.pkl"
+
+
+def sweep_path(output_file):
+    """Файл таблицы подбора порога рядом с файлом результата, в том же формате"""
+    base, ext = os.path.splitext(output_file)
+    return base + "_пороги" + (ext or ".xlsx")
+
+
+def apply_threshold(match_idx, scores, threshold, pinned=None):
+    """Отбрасывание вариантов ниже порога: (match_idx, scores) с -1 и 0.
+    Строки pinned (найденные по артикулу/штрихкоду) остаются при любом пороге"""
+    match_idx = np.asarray(match_idx)
+    scores = np.asarray(scores)
+    keep = (match_idx >= 0) & (scores >= threshold)
+    if pinned is not None and match_idx.ndim == 1:
+        keep |= (match_idx >= 0) & pinned
+    return np.where(keep, match_idx, -1), np.where(keep, scores, 0.0)
+
+
+def _series(values):
+    """Колонка в виде Series без индекса исходной таблицы (тип значений сохраняется)"""
+    if isinstance(values, pd.Series):
+        return values.reset_index(drop=True)
+    return pd.Series(list(values))
+
+
+def make_score_store(site_ids, site_names, erp_ids, erp_names, match_idx, scores, floor, pinned=None):
+    """Файл оценок в памяти. Из программы учета сохраняются только строки,
+    на которые есть ссылки, индексы пересчитываются на них"""
+    match_idx = np.asarray(match_idx)
+    used, inverse = np.unique(match_idx[match_idx >= 0], return_inverse=True)
+    compact_idx = np.full(match_idx.shape, -1, dtype=np.int32)
+    compact_idx[match_idx >= 0] = inverse
+    return {
+        'version': SCORE_STORE_VERSION,
+        'floor': floor,
+        'site_ids': _series(site_ids),
+        'site_names': _series(site_names),
+        'erp_ids': _series(erp_ids).iloc[used].reset_index(drop=True),
+        'erp_names': _series(erp_names).iloc[used].reset_index(drop=True),
+        'match_idx': compact_idx,
+        'scores': np.asarray(scores, dtype=np.float64),
+        'pinned': None if pinned is None else np.asarray(pinned, dtype=bool),
+    }
+
+
+def save_score_store(path, store):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_score_store(path):
+    """Файл оценок прошлого запуска; ValueError, если его нет или формат другой"""
+    if not os.path.isfile(path):
+        raise ValueError(f"Файл оценок {path} не найден: сначала выполните сопоставление")
+    with open(path, 'rb') as f:
+        store = pickle.load(f)
+    if not isinstance(store, dict) or store.get('version') != SCORE_STORE_VERSION:
+        raise ValueError(f"Файл оценок {path} создан другой версией программы")
+    return store
+
+
+def store_results(store, threshold):
+    """Таблица результата с новым порогом. Ниже порога, с которым считались
+    оценки, опуститься нельзя: таких вариантов в файле нет"""
+    if threshold < store['floor']:
+        raise ValueError(f"Оценки сохранены от {store['floor']}%, порог {threshold}% ниже: "
+                         f"нужен новый запуск с сохранением оценок от {threshold}%")
+    match_idx, scores = apply_threshold(store['match_idx'], store['scores'], threshold, store['pinned'])
+    return build_results(store['site_ids'], store['site_names'], store['erp_ids'], store['erp_names'],
+                         match_idx, scores)
+
+
+def threshold_sweep(store, thresholds=SWEEP_THRESHOLDS):
+    """Таблица подбора порога: число совпадений и распределение оценок
+    лучших вариантов для каждого порога не ниже сохраненного"""
+    match_idx, scores = store['match_idx'], store['scores']
+    if match_idx.ndim > 1:
+        match_idx, scores = match_idx[:, 0], scores[:, 0]
+    total = len(match_idx)
+    thresholds = [t for t in thresholds if t >= store['floor']]
+    rows = []
+    for i, threshold in enumerate(thresholds):
+        best_idx, best_scores = apply_threshold(match_idx, scores, threshold, store['pinned'])
+        found = best_scores[best_idx >= 0]
+        # Сколько совпадений отпадет при переходе к следующему порогу
+        dropped = None
+        if i + 1 < len(thresholds):
+            dropped = int(((found >= threshold) & (found < thresholds[i + 1])).sum())
+        rows.append({
+            'порог %': threshold,
+            'найдено': len(found),
+            'найдено %': round(len(found) / total * 100, 1) if total else 0.0,
+            'отпадет на следующем пороге': dropped,
+            'средняя схожесть': round(float(found.mean()), 1) if len(found) else None,
+            'медиана схожести': round(float(np.median(found)), 1) if len(found) else None,
+            'минимальная схожесть': round(float(found.min()), 1) if len(found) else None,
+        })
+    return pd.DataFrame(rows).astype({'отпадет на следующем пороге': 'Int64'})
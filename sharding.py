@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Сопоставление по частям (шардам) в нескольких процессах или на нескольких
+машинах через общий каталог
+"""
+
+import json
+import os
+import pickle
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from candidate_index import CandidateIndex
+from exact_match import ExactMatcher
+from matching_engine import match_chunks
+from tfidf_index import TfidfIndex
+
+SHARD_FORMAT_VERSION = 2
+# Шард, чей файл блокировки не обновлялся столько секунд, считается брошенным
+DEFAULT_STALE_AFTER = 600
+POLL_INTERVAL = 2
+
+
+def shard_dir_for(output_file):
+    """Каталог шардов по умолчанию рядом с файлом результата"""
+    return os.path.splitext(output_file)[0] + ".shards"
+
+
+def shard_ranges(total, shards):
+    """Разбиение [0, total) на shards почти равных непрерывных диапазонов"""
+    bounds = np.linspace(0, total, max(1, min(shards, total)) + 1).astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _dump_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def _result_path(shard_dir, shard):
+    return os.path.join(shard_dir, f"shard_{shard:05d}.pkl")
+
+
+def _lock_path(shard_dir, shard):
+    return os.path.join(shard_dir, f"shard_{shard:05d}.lock")
+
+
+def prepare_shards(shard_dir, fingerprint, shards, site_clean, site_key_values, choices, erp_key_values,
+                   threshold, options):
+    """Подготовка каталога шардов: план, очищенные названия и ключи обоих каталогов.
+
+    Если в каталоге уже есть план того же запуска, готовые шарды сохраняются
+    (продолжение после сбоя); иначе каталог очищается. Возвращает число шардов.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    plan_path = os.path.join(shard_dir, 'plan.json')
+    if os.path.isfile(plan_path):
+        try:
+            with open(plan_path, encoding='utf-8') as f:
+                plan = json.load(f)
+            if (plan.get('version') == SHARD_FORMAT_VERSION and plan.get('fingerprint') == fingerprint
+                    and plan.get('total') == len(site_clean)):
+                return len(plan['ranges'])
+        except (OSError, ValueError):
+            pass
+    _remove_shard_files(shard_dir)
+
+    _dump_atomic(os.path.join(shard_dir, 'data.pkl'), {
+        'site_clean': list(site_clean),
+        'site_key_values': [list(values) for values in site_key_values],
+        'choices': list(choices),
+        'erp_key_values': [list(values) for values in erp_key_values],
+    })
+    ranges = shard_ranges(len(site_clean), shards)
+    plan = {
+        'version': SHARD_FORMAT_VERSION,
+        'fingerprint': fingerprint,
+        'total': len(site_clean),
+        'ranges': ranges,
+        'threshold': threshold,
+        'options': options,
+    }
+    # План пишется последним: по нему воркеры понимают, что данные готовы
+    tmp_path = plan_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False)
+    os.replace(tmp_path, plan_path)
+    return len(ranges)
+
+
+def _remove_shard_files(shard_dir):
+    """Удаление только файлов запуска: в общем каталоге могут лежать чужие файлы"""
+    for name in os.listdir(shard_dir):
+        if name.startswith(('shard_', 'plan.json', 'data.pkl')):
+            os.remove(os.path.join(shard_dir, name))
+
+
+def cleanup_shards(shard_dir):
+    """Удаление файлов запуска после объединения; сам каталог - только если он опустел"""
+    _remove_shard_files(shard_dir)
+    try:
+        os.rmdir(shard_dir)
+    except OSError:
+        pass
+
+
+def _claim(shard_dir, shard, stale_after):
+    """Захват шарда файлом блокировки; брошенную блокировку можно перехватить"""
+    if os.path.isfile(_result_path(shard_dir, shard)):
+        return False
+    lock = _lock_path(shard_dir, shard)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock) < stale_after:
+                return False
+            os.remove(lock)
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(f"{socket.gethostname()} {os.getpid()}")
+    return True
+
+
+def wait_for_plan(shard_dir, verbose=True):
+    """Ожидание плана: воркер может стартовать раньше, чем координатор подготовит каталог"""
+    plan_path = os.path.join(shard_dir, 'plan.json')
+    if not os.path.isfile(plan_path) and verbose:
+        print(f"Жду план запуска в каталоге {shard_dir}...")
+    while not os.path.isfile(plan_path):
+        time.sleep(POLL_INTERVAL)
+
+
+def load_worker(shard_dir):
+    """План, данные и индексы для обработки шардов: (plan, data, index, exact)"""
+    with open(os.path.join(shard_dir, 'plan.json'), encoding='utf-8') as f:
+        plan = json.load(f)
+    with open(os.path.join(shard_dir, 'data.pkl'), 'rb') as f:
+        data = pickle.load(f)
+
+    options = plan['options']
+    choices = data['choices']
+    index = None
+    if options.get('engine') == 'tfidf':
+        index = TfidfIndex(choices, options['tfidf_candidates'], rescore=options['rescore'])
+    elif options['blocking']:
+        index = CandidateIndex(choices, options['max_candidates'])
+    exact = ExactMatcher(choices, data['erp_key_values']) if options['fast_path'] else None
+    return plan, data, index, exact
+
+
+def has_free_shard(shard_dir, shards, stale_after=DEFAULT_STALE_AFTER):
+    """Есть ли шард без результата, чья блокировка отсутствует или брошена"""
+    for shard in range(shards):
+        if os.path.isfile(_result_path(shard_dir, shard)):
+            continue
+        try:
+            if time.time() - os.path.getmtime(_lock_path(shard_dir, shard)) >= stale_after:
+                return True
+        except FileNotFoundError:
+            return True
+    return False
+
+
+def run_worker(shard_dir, threads=-1, stale_after=DEFAULT_STALE_AFTER, verbose=True, worker=None):
+    """Обработка свободных шардов, пока они есть. Возвращает число обработанных.
+
+    worker - уже загруженный load_worker(): при повторных вызовах данные
+    и индексы не читаются и не строятся заново.
+    """
+    plan, data, index, exact = worker or load_worker(shard_dir)
+    options = plan['options']
+    choices = data['choices']
+
+    done = 0
+    for shard, (start, end) in enumerate(plan['ranges']):
+        if not _claim(shard_dir, shard, stale_after):
+            continue
+        if verbose:
+            print(f"[{socket.gethostname()}:{os.getpid()}] шард {shard + 1}/{len(plan['ranges'])}: "
+                  f"товары {start}-{end}")
+        lock = _lock_path(shard_dir, shard)
+        if exact is not None:
+            exact.tier_counts = dict.fromkeys(exact.tier_counts, 0)
+
+        parts = []
+        for _, match_idx, scores in match_chunks(
+                data['site_clean'][start:end], choices, plan['threshold'], index, options['top_k'],
+                options['prefilter'], exact=exact,
+                site_key_values=[values[start:end] for values in data['site_key_values']], workers=threads):
+            parts.append((match_idx, scores))
+            # Обновление времени блокировки: шард еще в работе
+            os.utime(lock)
+
+        shape = (0, options['top_k']) if options['top_k'] > 1 else (0,)
+        _dump_atomic(_result_path(shard_dir, shard), {
+            'start': start,
+            'end': end,
+            'match_idx': np.concatenate([part[0] for part in parts]) if parts else np.empty(shape, np.int64),
+            'scores': np.concatenate([part[1] for part in parts]) if parts else np.empty(shape, np.float64),
+            'tier_counts': dict(exact.tier_counts) if exact is not None else None,
+            'tiers': exact.tiers if exact is not None else None,
+        })
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            # Блокировку посчитали брошенной и перехватили: результат уже записан
+            pass
+        done += 1
+    return done
+
+
+def shard_progress(shard_dir, shards):
+    """Число готовых шардов"""
+    return sum(os.path.isfile(_result_path(shard_dir, shard)) for shard in range(shards))
+
+
+def merge_shards(shard_dir, shards):
+    """Объединение результатов шардов по порядку: (match_idx, scores, tier_counts, tiers);
+    tiers - способ по каждой строке или None без быстрого прохода"""
+    parts = []
+    tier_counts = {}
+    for shard in range(shards):
+        with open(_result_path(shard_dir, shard), 'rb') as f:
+            part = pickle.load(f)
+        parts.append(part)
+        for tier, count in (part['tier_counts'] or {}).items():
+            tier_counts[tier] = tier_counts.get(tier, 0) + count
+    match_idx = np.concatenate([part['match_idx'] for part in parts])
+    scores = np.concatenate([part['scores'] for part in parts])
+    tiers = None
+    if parts and all(part['tiers'] is not None for part in parts):
+        tiers = np.concatenate([part['tiers'] for part in parts])
+    return match_idx, scores, tier_counts or None, tiers
+
+
+def run_sharded(shard_dir, shards, workers, stale_after=DEFAULT_STALE_AFTER):
+    """Обработка шардов локальными процессами и ожидание шардов,
+    захваченных воркерами на других машинах"""
+    if workers > 0:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_worker, shard_dir, threads, stale_after) for _ in range(workers)]
+            for future in futures:
+                future.result()
+
+    last = None
+    worker = None
+    while True:
+        ready = shard_progress(shard_dir, shards)
+        if ready != last:
+            print(f"Готово шардов: {ready}/{shards}")
+            last = ready
+        if ready == shards:
+            return
+        # Брошенные шарды дорабатываем сами, если есть локальные воркеры;
+        # данные загружаются только когда есть что захватить, и один раз
+        if workers > 0 and has_free_shard(shard_dir, shards, stale_after):
+            worker = worker or load_worker(shard_dir)
+            run_worker(shard_dir, -1, stale_after, worker=worker)
+        time.sleep(POLL_INTERVAL)
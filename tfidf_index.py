@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Поиск кандидатов по TF-IDF символьных n-грамм: названия обоих каталогов
+превращаются в разреженные матрицы, похожесть - косинус через умножение матриц
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import process, fuzz
+
+from matching_engine import auto_chunk_size, rerank_score
+
+NGRAM_SIZE = 3
+DEFAULT_TFIDF_CANDIDATES = 10
+# Меньше строк на поток не делим: накладные расходы больше выигрыша
+MIN_THREAD_ROWS = 256
+
+
+def _import_scipy_sparse():
+    try:
+        import scipy.sparse
+    except ImportError:
+        raise ImportError("Для алгоритма TF-IDF установите scipy: pip install scipy")
+    return scipy.sparse
+
+
+def char_ngrams(clean, size=NGRAM_SIZE):
+    """n-граммы символов по словам с пробелами по краям (как у триграмм индекса кандидатов)"""
+    grams = []
+    for token in clean.split():
+        padded = f" {token} "
+        grams += [padded[i:i + size] for i in range(max(1, len(padded) - size + 1))]
+    return grams
+
+
+class TfidfIndex:
+    """TF-IDF матрица названий программы учета (строки нормированы по L2).
+
+    Для каждой порции запросов считается матрица косинусов с каталогом
+    (разреженное умножение, части порции параллельно в потоках), и по
+    каждой строке разреженного результата берутся candidates лучших
+    вариантов. С rescore кандидаты пересчитываются через
+    WRatio, и оценки сопоставимы с полным перебором; без rescore оценка -
+    косинус x 100.
+    """
+
+    def __init__(self, choices, candidates=DEFAULT_TFIDF_CANDIDATES, rescore=True, ngram_size=NGRAM_SIZE):
+        sparse = _import_scipy_sparse()
+        self.size = len(choices)
+        self.candidates_count = candidates
+        self.rescore = rescore
+        self.ngram_size = ngram_size
+
+        grams = [char_ngrams(clean, ngram_size) for clean in choices]
+        codes, vocabulary = pd.factorize(pd.Series([gram for row in grams for gram in row], dtype=object))
+        self.vocabulary = {gram: i for i, gram in enumerate(vocabulary)}
+        rows = np.repeat(np.arange(len(grams)), [len(row) for row in grams])
+        counts = sparse.csr_matrix((np.ones(len(codes), dtype=np.float32), (rows, codes)),
+                                   shape=(self.size, len(vocabulary)))
+        counts.sum_duplicates()
+
+        # Сглаженный IDF, как у sklearn: редкие n-граммы весят больше
+        df = np.bincount(counts.indices, minlength=len(vocabulary))
+        self.idf = (np.log((1 + self.size) / (1 + df)) + 1).astype(np.float32)
+        # Транспонированная матрица: запросы (m x V) умножаются на нее (V x n)
+        self.matrix_t = self._weigh(counts).T.tocsr()
+
+    def _weigh(self, counts):
+        """TF x IDF с нормировкой строк по L2"""
+        weighted = counts.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return _import_scipy_sparse().diags(1 / norms).dot(weighted).astype(np.float32).tocsr()
+
+    def transform(self, queries):
+        """TF-IDF матрица запросов по словарю программы учета; незнакомые n-граммы отбрасываются"""
+        sparse = _import_scipy_sparse()
+        rows, cols = [], []
+        for i, clean in enumerate(queries):
+            for gram in char_ngrams(clean, self.ngram_size):
+                col = self.vocabulary.get(gram)
+                if col is not None:
+                    rows.append(i)
+                    cols.append(col)
+        counts = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                                   shape=(len(queries), len(self.vocabulary)))
+        counts.sum_duplicates()
+        return self._weigh(counts)
+
+    def top_candidates(self, queries, k=None, workers=-1):
+        """k лучших по косинусу вариантов на запрос: (индексы, косинусы) формы (m, k),
+        по убыванию косинуса; варианты без общих n-грамм помечаются -1"""
+        k = min(k or self.candidates_count, self.size)
+        queries = list(queries)
+        if not queries or not k:
+            return np.full((len(queries), k), -1, dtype=np.int64), np.zeros((len(queries), k), dtype=np.float32)
+
+        # Движок передает порции размера auto_chunk_size, поэтому для потоков
+        # порция делится еще раз
+        threads = (os.cpu_count() or 1) if workers is None or workers < 0 else max(1, workers)
+        chunk_size = min(auto_chunk_size(self.size),
+                         max(MIN_THREAD_ROWS, -(-len(queries) // threads)))
+        starts = range(0, len(queries), chunk_size)
+
+        def run(start):
+            cosines = (self.transform(queries[start:start + chunk_size]) @ self.matrix_t).tocsr()
+            top = np.full((cosines.shape[0], k), -1, dtype=np.int64)
+            values = np.zeros((cosines.shape[0], k), dtype=np.float32)
+            for i in range(cosines.shape[0]):
+                low, high = cosines.indptr[i], cosines.indptr[i + 1]
+                cols, row = cosines.indices[low:high], cosines.data[low:high]
+                if high - low > k:
+                    # Все варианты не хуже k-го, чтобы равные делились по позиции
+                    keep = row >= np.partition(row, high - low - k)[high - low - k]
+                    cols, row = cols[keep], row[keep]
+                # По убыванию косинуса, при равенстве - по позиции в каталоге
+                order = np.lexsort((cols, -row))[:k]
+                top[i, :len(order)] = cols[order]
+                values[i, :len(order)] = row[order]
+            top[values <= 0] = -1
+            return top, values
+
+        if threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                parts = list(pool.map(run, starts))
+        else:
+            parts = [run(start) for start in starts]
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+    def candidates(self, clean):
+        """Кандидаты одного запроса, отсортированные по возрастанию индекса"""
+        return self.candidates_many([clean])[0]
+
+    def candidates_many(self, queries, workers=-1):
+        """Кандидаты для списка запросов: одно умножение матриц на порцию, а не на запрос"""
+        top, _ = self.top_candidates(queries, workers=workers)
+        return [np.sort(ids[ids >= 0]) for ids in top]
+
+    def best_match(self, clean, choices, threshold=0):
+        """Лучшее совпадение: (индекс, оценка) или (-1, 0.0)"""
+        return self.match_many([clean], choices, threshold)[0]
+
+    def match_many(self, queries, choices, threshold=0, workers=-1):
+        """Лучшее совпадение для каждого запроса: список (индекс, оценка)"""
+        top, values = self.top_candidates(queries, workers=workers)
+        results = []
+        for query, ids, cosines in zip(queries, top, values):
+            if not self.rescore:
+                score = float(cosines[0]) * 100
+                results.append((int(ids[0]), score) if ids[0] >= 0 and score >= threshold else (-1, 0.0))
+                continue
+            # По возрастанию индекса: при равной оценке берется первый в каталоге, как в полном переборе
+            candidate_ids = np.sort(ids[ids >= 0])
+            extract = process.extractOne(query, [choices[i] for i in candidate_ids], scorer=fuzz.WRatio,
+                                         score_cutoff=threshold)
+            results.append((int(candidate_ids[extract[2]]), extract[1]) if extract else (-1, 0.0))
+        return results
+
+    def top_matches(self, queries, choices, top_k, threshold=0, workers=-1):
+        """top_k вариантов на запрос: (match_idx, scores) формы (m, top_k).
+        С rescore кандидаты упорядочиваются по rerank_score, как во втором проходе
+        режима нескольких вариантов"""
+        top, values = self.top_candidates(queries, max(top_k, self.candidates_count), workers)
+        match_idx = np.full((len(queries), top_k), -1, dtype=np.int64)
+        scores = np.zeros((len(queries), top_k), dtype=np.float64)
+        for i, query in enumerate(queries):
+            if self.rescore:
+                ranked = sorted(((rerank_score(query, choices[j]), int(j)) for j in top[i] if j >= 0),
+                                key=lambda item: (-item[0], item[1]))
+            else:
+                ranked = [(float(value) * 100, int(j)) for j, value in zip(top[i], values[i]) if j >= 0]
+            ranked = [(score, j) for score, j in ranked if score >= threshold and score > 0][:top_k]
+            for rank, (score, j) in enumerate(ranked):
+                match_idx[i, rank] = j
+                scores[i, rank] = score
+        return match_idx, scores